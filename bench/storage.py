@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+"""Benchmarks of the FileStorage engine
+
+Run from the root of the repository, in a temporary directory of its own:
+    python3 -m bench.storage grid [places]
+    python3 -m bench.storage format [places]
+    python3 -m bench.storage compression [places]
+
+grid times the GridIndex against the linear scan of models.engine.indexes
+(within() and nearest()) on places spread over the globe, plus a city of
+1% of them; format compares the size and the reload() time of the JSON
+and binary files; compression the size and the CPU time spent writing
+and reloading the files of each format with each codec.
+"""
+
+import atexit
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# importing models reloads file.json from the current directory
+os.chdir(tempfile.mkdtemp(prefix="bench-"))
+atexit.register(shutil.rmtree, os.getcwd(), True)
+
+from models.engine import compression, indexes  # noqa: E402
+from models.engine.file_storage import FileStorage  # noqa: E402
+from models.place import Place  # noqa: E402
+
+defaults = {
+    "grid": 1000000,
+    "format": 100000,
+    "compression": 50000,
+}
+
+
+def places(count, seed=0):
+    """Returns a dictionary of count places by key, spread uniformly over
+        the globe but for the last 1%, around Paris. They're built from
+        keyword arguments, so no storage knows about them"""
+    rand = random.Random(seed)
+    now = datetime.now().isoformat()
+    found = {}
+    for number in range(count):
+        if number < count - count // 100:
+            latitude = rand.uniform(-90, 90)
+            longitude = rand.uniform(-180, 180)
+        else:
+            latitude = rand.gauss(48.86, 0.1)
+            longitude = rand.gauss(2.35, 0.1)
+        place = Place(id="{:08}".format(number), created_at=now,
+                      updated_at=now, city_id="city-{}".format(number % 500),
+                      user_id="user-{}".format(number % 5000),
+                      name="Place {}".format(number),
+                      description="A quiet room near the station",
+                      number_rooms=rand.randint(1, 5),
+                      price_by_night=rand.randint(20, 400),
+                      latitude=latitude, longitude=longitude)
+        found["Place." + place.id] = place
+    return found
+
+
+def timed(function, *args, clock=time.perf_counter):
+    """Returns the seconds function(*args) took on clock, and its result"""
+    start = clock()
+    result = function(*args)
+    return clock() - start, result
+
+
+def table(header, rows):
+    """Prints the rows (tuples of strings) under header, aligned"""
+    widths = [max(len(row[column]) for row in [header] + rows)
+              for column in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(cell.rjust(width) if column else cell.ljust(width)
+                        for column, (cell, width)
+                        in enumerate(zip(row, widths))))
+
+
+def seconds(value):
+    """Returns value seconds as a readable string"""
+    if value < 1:
+        return "{:.1f} ms".format(value * 1000)
+    return "{:.2f} s".format(value)
+
+
+def megabytes(path):
+    """Returns the size of the file path in MB as a string"""
+    return "{:.1f} MB".format(os.path.getsize(path) / 1e6)
+
+
+def bench_grid(count):
+    """Times the grid index against the linear scan"""
+    objects = places(count)
+    grid = indexes.GridIndex("Place")
+    took, _ = timed(lambda: [grid.add(key, obj)
+                             for key, obj in objects.items()])
+    print("build the grid index of {} places: {}".format(count,
+                                                         seconds(took)))
+    cases = [
+        ("nearest, k=1", "nearest", (48.86, 2.35, 1)),
+        ("nearest, k=10", "nearest", (48.86, 2.35, 10)),
+        ("1x1 degree box", "within", (48.36, 1.85, 49.36, 2.85)),
+        ("box across antimeridian", "within", (-10, 170, 10, -170)),
+    ]
+    rows = []
+    for label, name, args in cases:
+        grid_took, found = timed(getattr(grid, name), *args)
+        scan_took, scanned = timed(getattr(indexes, name), objects, *args)
+        if name == "within":
+            assert found.keys() == scanned.keys()
+        else:
+            assert [f[1] for f in found] == [s[1] for s in scanned]
+        rows.append((label, str(len(found)), seconds(grid_took),
+                     seconds(scan_took)))
+    table(("query", "hits", "grid", "scan"), rows)
+
+
+def store(objects, **options):
+    """Writes objects to file.json with options, and returns the CPU
+        seconds the write took"""
+    storage = FileStorage()
+    storage._FileStorage__objects = objects
+    storage.configure(fsync=False, **options)
+    took, _ = timed(storage.snapshot, clock=time.process_time)
+    return took
+
+
+def reload(clock=time.perf_counter):
+    """Returns the seconds a new storage takes to reload file.json"""
+    took, _ = timed(FileStorage().reload, clock=clock)
+    return took
+
+
+def bench_format(count):
+    """Compares the size and the reload time of the JSON and binary files"""
+    objects = places(count)
+    rows = []
+    for format in ("json", "binary"):
+        wrote = store(objects, format=format)
+        rows.append((format, megabytes("file.json"), seconds(wrote),
+                     seconds(reload())))
+    print("{} places".format(count))
+    table(("format", "size", "write", "reload"), rows)
+
+
+def bench_compression(count):
+    """Compares the size and the CPU time of each format and codec"""
+    objects = places(count)
+    rows = []
+    for format in ("json", "binary"):
+        for codec in ("",) + compression.codecs:
+            wrote = store(objects, format=format, compression=codec)
+            rows.append((format, codec or "none", megabytes("file.json"),
+                         seconds(wrote),
+                         seconds(reload(clock=time.process_time))))
+    print("{} places, CPU time".format(count))
+    table(("format", "codec", "size", "write", "reload"), rows)
+
+
+def main(argv):
+    """Runs the benchmark named by argv[1] on argv[2] places, if given"""
+    if len(argv) not in (2, 3) or argv[1] not in defaults:
+        print("usage: python3 -m bench.storage {} [places]".format(
+            "|".join(defaults)))
+        return 2
+    count = int(argv[2]) if len(argv) == 3 else defaults[argv[1]]
+    globals()["bench_" + argv[1]](count)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -14,12 +14,31 @@ from models.review import Review
 import re
 
 
+def parse_value(text):
+    """Returns text as an int or a float if it reads as one, otherwise as
+        a string without its surrounding quotes"""
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    if len(text) > 1 and text[0] == text[-1] and text[0] in "\"'":
+        return text[1:-1]
+    return text
+
+
 class HBNBCommand(cmd.Cmd):
     """Console class"""
 
     prompt = "(hbnb) "
     model_classes = ["BaseModel", "User", "State", "City", "Place", "Amenity", "Review"]
 
+    def onecmd(self, line):
+        """Runs a command while holding the storage lock so a background
+            snapshot never sees a command half done"""
+        with storage.lock():
+            return super().onecmd(line)
+
     def do_quit(self, arg):
         """Quit command to exit the console"""
         return True
@@ -56,15 +75,17 @@ class HBNBCommand(cmd.Cmd):
         if len(args) == 1:
             print("** instance id missing **")
             return
-        key = "{}.{}".format(args[0], args[1])
-        obj = storage.all().get(key)
+        obj = storage.get(args[0], args[1])
         if obj is None:
             print("** no instance found **")
         else:
             print(obj)
 
     def do_destroy(self, arg):
-        """Deletes an instance based on the class name and id"""
+        """Deletes an instance based on the class name and id; with
+            cascade, also deletes the instances depending on it and prints
+            how many of each class were deleted:
+            destroy <class> <id> [cascade]"""
         args = arg.split()
         if len(args) == 0:
             print("** class name missing **")
@@ -75,12 +96,13 @@ class HBNBCommand(cmd.Cmd):
         if len(args) == 1:
             print("** instance id missing **")
             return
-        key = "{}.{}".format(args[0], args[1])
-        obj = storage.all().get(key)
+        obj = storage.get(args[0], args[1])
         if obj is None:
             print("** no instance found **")
+        elif len(args) > 2 and args[2] == "cascade":
+            print(storage.cascade(obj))
         else:
-            del storage.all()[key]
+            storage.delete(obj)
             storage.save()
 
     def do_all(self, arg):
@@ -90,7 +112,7 @@ class HBNBCommand(cmd.Cmd):
         if len(args) == 0:
             obj_list = [str(obj) for obj in storage.all().values()]
         elif args[0] in self.model_classes:
-            obj_list = [str(obj) for obj in storage.all().values() if type(obj).__name__ == args[0]]
+            obj_list = [str(obj) for obj in storage.all(args[0]).values()]
         else:
             print("** class doesn't exist **")
             return
@@ -108,8 +130,7 @@ class HBNBCommand(cmd.Cmd):
         if len(args) == 1:
             print("** instance id missing **")
             return
-        key = "{}.{}".format(args[0], args[1])
-        obj = storage.all().get(key)
+        obj = storage.get(args[0], args[1])
         if obj is None:
             print("** no instance found **")
             return
@@ -119,7 +140,22 @@ class HBNBCommand(cmd.Cmd):
         if len(args) == 3:
             print("** value missing **")
             return
-        setattr(obj, args[2], args[3])
+        value = args[3]
+        default = getattr(type(obj), args[2], None)
+        if type(default) in (int, float):
+            # keep numeric attributes numeric so range conditions apply
+            try:
+                value = type(default)(value)
+            except ValueError:
+                pass
+        try:
+            setattr(obj, args[2], value)
+        except AttributeError:
+            print("** attribute can't be set **")
+            return
+        except ValueError as e:
+            print("** {} **".format(e))
+            return
         storage.save()
 
     def do_count(self, arg):
@@ -131,8 +167,102 @@ class HBNBCommand(cmd.Cmd):
         if args[0] not in self.model_classes:
             print("** class doesn't exist **")
             return
-        count = sum(1 for obj in storage.all().values() if type(obj).__name__ == args[0])
-        print(count)
+        print(storage.count(args[0]))
+
+    def do_where(self, arg):
+        """Prints the instances of a class whose attributes match conditions"""
+        args = arg.split()
+        if len(args) == 0:
+            print("** class name missing **")
+            return
+        if args[0] not in self.model_classes:
+            print("** class doesn't exist **")
+            return
+        predicates = {}
+        for condition in args[1:]:
+            name, sep, value = condition.partition("=")
+            if not sep or not name:
+                print("** invalid condition: {} **".format(condition))
+                return
+            if name.endswith(("__in", "__all")):
+                predicates[name] = [parse_value(v) for v in value.split(",")]
+            else:
+                predicates[name] = parse_value(value)
+        try:
+            objs = storage.filter(args[0], **predicates)
+        except ValueError as e:
+            print("** {} **".format(e))
+            return
+        print([str(obj) for obj in objs.values()])
+
+    def do_search(self, arg):
+        """Prints the instances of a class whose text holds every word:
+            search <class> <word> ..."""
+        args = arg.split()
+        if len(args) == 0:
+            print("** class name missing **")
+            return
+        if args[0] not in self.model_classes:
+            print("** class doesn't exist **")
+            return
+        if len(args) == 1:
+            print("** words missing **")
+            return
+        objs = storage.search(args[0], " ".join(args[1:]))
+        print([str(obj) for obj in objs.values()])
+
+    def do_near(self, arg):
+        """Prints the instances of a class nearest to a point, nearest first:
+            near <class> <latitude> <longitude> [count]"""
+        args = arg.split()
+        if len(args) == 0:
+            print("** class name missing **")
+            return
+        if args[0] not in self.model_classes:
+            print("** class doesn't exist **")
+            return
+        if len(args) < 3:
+            print("** coordinates missing **")
+            return
+        try:
+            latitude, longitude = float(args[1]), float(args[2])
+            count = int(args[3]) if len(args) > 3 else 1
+            objs = storage.nearest(args[0], latitude, longitude, count)
+        except ValueError:
+            print("** invalid coordinates **")
+            return
+        print([str(obj) for obj in objs])
+
+    def do_within(self, arg):
+        """Prints the instances of a class inside a box:
+            within <class> <south> <west> <north> <east>"""
+        args = arg.split()
+        if len(args) == 0:
+            print("** class name missing **")
+            return
+        if args[0] not in self.model_classes:
+            print("** class doesn't exist **")
+            return
+        if len(args) < 5:
+            print("** coordinates missing **")
+            return
+        try:
+            box = [float(value) for value in args[1:5]]
+            objs = storage.within(args[0], *box)
+        except ValueError:
+            print("** invalid coordinates **")
+            return
+        print([str(obj) for obj in objs.values()])
+
+    def do_snapshot(self, arg):
+        """Writes a snapshot of all instances to the storage file now"""
+        if not hasattr(storage, "snapshot"):
+            print("** snapshots need the file storage **")
+            return
+        storage.snapshot()
+        stats = storage.snapshot_stats()
+        print("{} bytes written in {:.3f}s".format(stats["last_bytes"],
+                                                   stats["last_duration"]))
 
     def default(self, line):
         """Default behaviour if no command found"""
@@ -165,14 +295,20 @@ class HBNBCommand(cmd.Cmd):
         if class_id == "":
             print("** instance id missing **")
             return
-        key = "{}.{}".format(class_name, class_id)
-        obj = storage.all().get(key)
+        obj = storage.get(class_name, class_id)
         if obj is None:
             print("** no instance found **")
             return
         for k, v in arg_dict.items():
             if k != "id":
-                setattr(obj, k, v)
+                try:
+                    setattr(obj, k, v)
+                except AttributeError:
+                    print("** attribute can't be set **")
+                    return
+                except ValueError as e:
+                    print("** {} **".format(e))
+                    return
         storage.save()
 
 
@@ -1,7 +1,19 @@
 #!/usr/bin/python3
 """ init for class FileStorage """
 
-from models.engine import file_storage
+import os
 
-storage = file_storage.FileStorage()
+if os.getenv("HBNB_TYPE_STORAGE") == "db":
+    from models.engine import db_storage
+    storage = db_storage.DBStorage()
+else:
+    from models.engine import file_storage
+    storage = file_storage.FileStorage()
+for name, default in storage.options().items():
+    value = os.getenv("HBNB_STORAGE_" + name.upper())
+    if value is None:
+        continue
+    if type(default) is bool:
+        value = value.lower() in ("1", "true", "yes", "on")
+    storage.configure(**{name: type(default)(value)})
 storage.reload()
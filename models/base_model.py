@@ -10,19 +10,30 @@ class BaseModel:
     """BaseModel class defines common attributes/methods for other classes"""
 
     def __init__(self, *args, **kwargs):
-        """Initializes a new instance of BaseModel"""
+        """Initializes a new instance of BaseModel. Values named like a
+            relationship (saved before the class had it) are dropped.
+            Loading kwargs doesn't tell the storage: the instance isn't
+            stored yet"""
         if kwargs:
             for key, value in kwargs.items():
                 if key == "created_at" or key == "updated_at":
                     value = datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
-                if key != "__class__":
-                    setattr(self, key, value)
+                if key != "__class__" and \
+                        not isinstance(getattr(type(self), key, None),
+                                       Relation):
+                    super().__setattr__(key, value)
         else:
             self.id = str(uuid.uuid4())
             self.created_at = datetime.now()
             self.updated_at = self.created_at
             models.storage.new(self)
 
+    def __setattr__(self, name, value):
+        """Sets an attribute and tells the storage the instance changed"""
+        previous = (self.__dict__[name],) if name in self.__dict__ else ()
+        super().__setattr__(name, value)
+        models.storage.touch(self, name, previous)
+
     def __str__(self):
         """Returns a string representation of the instance"""
         classname = self.__class__.__name__
@@ -41,3 +52,90 @@ class BaseModel:
         new_dict["updated_at"] = self.updated_at.isoformat()
         return new_dict
 
+
+class Relation:
+    """Read-only property giving the instances of another class related to
+        an instance: those whose attribute holds the instance id or, with
+        listed set, those whose ids the instance lists in attribute.
+        Reading it returns a RelationView, which asks the storage (through
+        its indexes) each time it is iterated, so it is never out of date"""
+
+    def __init__(self, class_name, attribute, listed=False):
+        """Initializes the relation with the instances of class_name"""
+        self.class_name = class_name
+        self.attribute = attribute
+        self.listed = listed
+
+    def __get__(self, obj, owner=None):
+        """Returns the view of the instances related to obj"""
+        if obj is None:
+            return self
+        return RelationView(self, obj)
+
+    def __set__(self, obj, value):
+        """Refuses to change the relation: change the ids instead"""
+        raise AttributeError("relationships are read-only")
+
+
+class RelationView:
+    """Lazily evaluated collection of the instances related to obj"""
+
+    def __init__(self, relation, obj):
+        """Initializes the view of the instances related to obj"""
+        self.__relation = relation
+        self.__obj = obj
+
+    def __objects(self):
+        """Returns the list of the related instances"""
+        relation = self.__relation
+        if not relation.listed:
+            return list(models.storage.lookup(relation.class_name,
+                                              relation.attribute,
+                                              self.__obj.id).values())
+        found = []
+        for id in getattr(self.__obj, relation.attribute, None) or ():
+            obj = models.storage.get(relation.class_name, id)
+            if obj is not None:
+                found.append(obj)
+        return found
+
+    def __iter__(self):
+        """Iterates over the related instances"""
+        return iter(self.__objects())
+
+    def __len__(self):
+        """Returns the number of related instances"""
+        return len(self.__objects())
+
+    def __contains__(self, obj):
+        """Returns True if obj is one of the related instances, without
+            looking the others up"""
+        relation = self.__relation
+        if type(obj).__name__ != relation.class_name:
+            return False
+        if relation.listed:
+            return (obj.id in (getattr(self.__obj, relation.attribute, None)
+                               or ()) and
+                    models.storage.get(relation.class_name, obj.id) is obj)
+        return (getattr(obj, relation.attribute, None) == self.__obj.id and
+                models.storage.get(relation.class_name, obj.id) is obj)
+
+    def __repr__(self):
+        """Returns the list representation of the related instances"""
+        return repr(self.__objects())
+
+
+class ListAttribute:
+    """Default value of a list attribute: an instance that doesn't hold a
+        list yet gets its own empty one when the attribute is read, so
+        changing it in place never changes the list of another instance"""
+
+    def __set_name__(self, owner, name):
+        """Records the name of the attribute"""
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        """Returns the list of obj, giving it an empty one if needed"""
+        if obj is None:
+            return self
+        return obj.__dict__.setdefault(self.name, [])
@@ -1,9 +1,10 @@
 #!/usr/bin/python3
 """defines a City class"""
-from models.base_model import BaseModel
+from models.base_model import BaseModel, Relation
 
 
 class City(BaseModel):
     """represents a city"""
     state_id = ""
     name = ""
+    places = Relation("Place", "city_id")
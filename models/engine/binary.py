@@ -0,0 +1,339 @@
+#!/usr/bin/python3
+"""This module defines the compact binary format of FileStorage
+
+A binary file starts with MAGIC, then holds a sequence of frames: a
+one-byte kind, the varint length of the payload and the payload.
+    "S" adds a UTF-8 string to the string table
+    "C" adds a class name to the class table
+    "F" adds a field name to the field table of a class: the varint
+        number of the class, then the UTF-8 name
+    "R" is a record: the varint number of its class, then (varint field
+        number, value) pairs
+A string, class or field is defined by a frame once, before the first
+record using it, and referred to by its number (its position in its
+table) from then on. Values are a one-byte tag followed by:
+    None, False, True: nothing
+    int: its zigzag varint
+    float: its 8 bytes, little-endian
+    str: its varint length and its UTF-8 bytes, or the varint number of
+        the string in the string table for an interned one (any string
+        of up to INTERN_LIMIT characters: ids, foreign keys, names...)
+    datetime: the zigzag varint of its microseconds since 1970-01-01
+    list: its varint length and values
+    dict: its varint length and (key, value) pairs of values
+A varint holds 7 bits per byte, low bits first, the high bit set on all
+bytes but the last; the zigzag form maps 0, -1, 1, -2... to 0, 1, 2, 3...
+
+load() reads a file a chunk at a time. walk() goes over the frames of a
+buffer in place (a memory map of the file), where a reader can note the
+key and position of each record (Decoder.key()) and decode it later.
+"""
+
+import struct
+from datetime import datetime, timedelta
+
+MAGIC = b"\x00HBNB\x01\n"
+
+INTERN_LIMIT = 64  # longest strings put in the string table
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _INTERNED, _DATETIME, _LIST, \
+    _DICT = range(10)
+
+_INT_TAG, _FLOAT_TAG, _STR_TAG, _INTERNED_TAG, _DATETIME_TAG, _LIST_TAG, \
+    _DICT_TAG = (bytes((tag,)) for tag in range(_INT, _DICT + 1))
+
+_double = struct.Struct("<d")
+
+
+_SMALL = [bytes((number,)) for number in range(0x80)]  # 1-byte varints
+
+
+def _varint(number):
+    """Returns the varint bytes of the non-negative int number"""
+    if number < 0x80:
+        return _SMALL[number]
+    out = bytearray()
+    while number >= 0x80:
+        out.append(number & 0x7f | 0x80)
+        number >>= 7
+    out.append(number)
+    return bytes(out)
+
+
+def _read_varint(buf, pos):
+    """Returns the varint at pos in buf and the position after it"""
+    byte = buf[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+    number = byte & 0x7f
+    shift = 7
+    while True:
+        pos += 1
+        byte = buf[pos]
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, pos + 1
+        shift += 7
+
+
+def _zigzag(number):
+    """Returns the zigzag varint bytes of the int number"""
+    return _varint(number << 1 if number >= 0 else (-number << 1) - 1)
+
+
+def _frame(kind, payload):
+    """Returns the frame of kind (one byte) holding payload"""
+    return kind + _varint(len(payload)) + payload
+
+
+class Encoder:
+    """Encodes records as frames, keeping the string, class and field
+        tables of the file they are written to"""
+
+    def __init__(self):
+        """Initializes empty tables, for a new file"""
+        self.__strings = {}  # string -> its encoded reference
+        self.__classes = {}  # class name -> (varint, {field: varint})
+
+    def encode(self, class_name, values):
+        """Returns the frames of the record of class_name with the
+            attribute -> value dictionary values (the __dict__ of an
+            instance), preceded by those of the table entries it adds"""
+        out = []
+        entry = self.__classes.get(class_name)
+        if entry is None:
+            entry = self.__classes[class_name] = (
+                _varint(len(self.__classes)), {})
+            out.append(_frame(b"C", class_name.encode()))
+        number, fields = entry
+        strings = self.__strings
+        record = [number]
+        for name, value in values.items():
+            field = fields.get(name)
+            if field is None:
+                field = fields[name] = _varint(len(fields))
+                out.append(_frame(b"F", number + name.encode()))
+            record.append(field)
+            if type(value) is str and len(value) <= INTERN_LIMIT:
+                reference = strings.get(value)
+                if reference is None:
+                    reference = self.__intern(value, out)
+                record.append(reference)
+            else:
+                self.__value(value, record, out)
+        out.append(_frame(b"R", b"".join(record)))
+        return b"".join(out)
+
+    def __intern(self, value, out):
+        """Adds value to the string table, its frame to out, and returns
+            the encoded reference to it"""
+        reference = _INTERNED_TAG + _varint(len(self.__strings))
+        self.__strings[value] = reference
+        out.append(_frame(b"S", value.encode()))
+        return reference
+
+    def __value(self, value, record, out):
+        """Appends the encoding of value to record, and the frames of the
+            strings it interns to out"""
+        kind = type(value)
+        if kind is datetime:
+            record.append(_DATETIME_TAG)
+            record.append(_zigzag((value - EPOCH) // MICROSECOND))
+        elif kind is str:
+            if len(value) <= INTERN_LIMIT:
+                reference = self.__strings.get(value)
+                if reference is None:
+                    reference = self.__intern(value, out)
+                record.append(reference)
+                return
+            data = value.encode()
+            record.append(_STR_TAG + _varint(len(data)) + data)
+        elif value is None:
+            record.append(_SMALL[_NONE])
+        elif kind is bool:
+            record.append(_SMALL[_TRUE if value else _FALSE])
+        elif kind is int:
+            record.append(_INT_TAG)
+            record.append(_zigzag(value))
+        elif kind is float:
+            record.append(_FLOAT_TAG + _double.pack(value))
+        elif kind in (list, tuple):
+            record.append(_LIST_TAG + _varint(len(value)))
+            for item in value:
+                self.__value(item, record, out)
+        elif kind is dict:
+            record.append(_DICT_TAG + _varint(len(value)))
+            for key, item in value.items():
+                self.__value(key, record, out)
+                self.__value(item, record, out)
+        else:
+            raise TypeError("Object of type {} can't be stored".format(
+                kind.__name__))
+
+
+def dump(records, f):
+    """Writes the (class name, values) records to the binary file f"""
+    encoder = Encoder()
+    f.write(MAGIC)
+    for class_name, values in records:
+        f.write(encoder.encode(class_name, values))
+
+
+def frames(f, chunk_size=1 << 16):
+    """Yields the (kind, buffer, start, end) of each frame of the binary
+        file f after MAGIC, its payload being buffer[start:end], reading f
+        chunk_size bytes at a time"""
+    buf = b""
+    pos = 0
+    while True:
+        if pos < len(buf):
+            try:
+                length, start = _read_varint(buf, pos + 1)
+            except IndexError:  # the header goes on in the next chunk
+                start, length = len(buf), 1
+            if start + length <= len(buf):
+                yield buf[pos], buf, start, start + length
+                pos = start + length
+                continue
+        chunk = f.read(chunk_size)
+        if not chunk:
+            if pos < len(buf):
+                raise ValueError("truncated binary file")
+            return
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def walk(buf, pos=len(MAGIC)):
+    """Yields the (kind, buffer, start, end) of each frame of the contents
+        buf of a binary file (bytes, or a memory map of the file) from pos,
+        without copying them"""
+    size = len(buf)
+    while pos < size:
+        try:
+            length, start = _read_varint(buf, pos + 1)
+        except IndexError:
+            raise ValueError("truncated binary file") from None
+        if start + length > size:
+            raise ValueError("truncated binary file")
+        yield buf[pos], buf, start, start + length
+        pos = start + length
+
+
+class Decoder:
+    """Decodes the frames of one binary file into instances, keeping its
+        string, class and field tables"""
+
+    def __init__(self, classes):
+        """Initializes empty tables; classes maps class names to classes"""
+        self.__types = classes
+        self.__strings = []
+        self.__classes = []  # [class name, class, [field names]]
+
+    def decode(self, kind, buf, start, end, build=True):
+        """Reads the frame kind of payload buf[start:end] and returns the
+            (key, instance) of a record, (key, (start, end)) with build
+            unset, or None for a table entry"""
+        if kind == 0x52:  # "R"
+            if build:
+                return self.record(buf, start, end)
+            return self.key(buf, start, end), (start, end)
+        if kind == 0x53:  # "S"
+            self.__strings.append(buf[start:end].decode())
+        elif kind == 0x46:  # "F"
+            number, pos = _read_varint(buf, start)
+            self.__classes[number][2].append(buf[pos:end].decode())
+        elif kind == 0x43:  # "C"
+            name = buf[start:end].decode()
+            self.__classes.append([name, self.__types[name], []])
+        else:
+            raise ValueError("unknown frame kind {!r}".format(chr(kind)))
+        return None
+
+    def record(self, buf, start, end):
+        """Returns the (key, instance) of the record of payload
+            buf[start:end], once the table entries before it are read"""
+        if type(buf) is not bytes:  # a memory map is slower to index
+            buf, start, end = buf[start:end], 0, end - start
+        number, pos = _read_varint(buf, start)
+        name, cls, fields = self.__classes[number]
+        strings = self.__strings
+        values = {}
+        while pos < end:
+            field = buf[pos]
+            if field < 0x80:
+                pos += 1
+            else:
+                field, pos = _read_varint(buf, pos)
+            if buf[pos] == _INTERNED:  # the most common value
+                number, pos = _read_varint(buf, pos + 1)
+                values[fields[field]] = strings[number]
+            else:
+                values[fields[field]], pos = self.__value(buf, pos)
+        obj = cls.__new__(cls)
+        obj.__dict__.update(values)
+        return f"{name}.{values['id']}", obj
+
+    def key(self, buf, start, end):
+        """Returns the key of the record of payload buf[start:end], decoding
+            its values up to its id only (usually the first one)"""
+        number, pos = _read_varint(buf, start)
+        name, _, fields = self.__classes[number]
+        while pos < end:
+            field, pos = _read_varint(buf, pos)
+            value, pos = self.__value(buf, pos)
+            if fields[field] == "id":
+                return f"{name}.{value}"
+        raise ValueError("record of {} without an id".format(name))
+
+    def __value(self, buf, pos):
+        """Returns the value at pos in buf and the position after it"""
+        tag = buf[pos]
+        pos += 1
+        if tag == _INTERNED:
+            number, pos = _read_varint(buf, pos)
+            return self.__strings[number], pos
+        if tag == _DATETIME or tag == _INT:
+            number, pos = _read_varint(buf, pos)
+            number = -(number + 1 >> 1) if number & 1 else number >> 1
+            if tag == _INT:
+                return number, pos
+            return EPOCH + timedelta(microseconds=number), pos
+        if tag == _STR:
+            length, pos = _read_varint(buf, pos)
+            return buf[pos:pos + length].decode(), pos + length
+        if tag == _FLOAT:
+            return _double.unpack_from(buf, pos)[0], pos + 8
+        if tag <= _TRUE:
+            return (None, False, True)[tag], pos
+        if tag == _LIST:
+            length, pos = _read_varint(buf, pos)
+            items = []
+            for _ in range(length):
+                item, pos = self.__value(buf, pos)
+                items.append(item)
+            return items, pos
+        if tag == _DICT:
+            length, pos = _read_varint(buf, pos)
+            items = {}
+            for _ in range(length):
+                key, pos = self.__value(buf, pos)
+                items[key], pos = self.__value(buf, pos)
+            return items, pos
+        raise ValueError("unknown value tag {}".format(tag))
+
+
+def load(f, classes, chunk_size=1 << 16):
+    """Yields the (key, instance) records of the binary file f, building
+        the instances of classes (class name -> class) without calling
+        their __init__"""
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not a binary storage file")
+    decoder = Decoder(classes)
+    for frame in frames(f, chunk_size):
+        record = decoder.decode(*frame)
+        if record is not None:
+            yield record
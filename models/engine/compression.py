@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+"""This module defines the compression of the FileStorage files
+
+A file is compressed as a whole with one of the codecs of the standard
+library, zlib, gzip or lzma (xz), which writing() streams the file
+through. reader() finds the codec of a file from its first bytes, so a
+file reads back whatever codec (if any) it was written with; codec_of()
+finds the codec the name of a file asks for (file.json.gz, say).
+"""
+
+import gzip
+import io
+import lzma
+import os
+import zlib
+from contextlib import contextmanager
+
+codecs = ("zlib", "gzip", "lzma")
+
+# codec of the files with each extension
+extensions = {
+    ".zz": "zlib",
+    ".gz": "gzip",
+    ".xz": "lzma",
+}
+
+
+def codec_of(path):
+    """Returns the codec the extension of path names, or None"""
+    return extensions.get(os.path.splitext(path)[1])
+
+
+def detect(header):
+    """Returns the codec of a file starting with the bytes header (at
+        least 6 of them), or None if it isn't compressed"""
+    if header.startswith(b"\x1f\x8b"):
+        return "gzip"
+    if header.startswith(b"\xfd7zXZ\x00"):
+        return "lzma"
+    # CMF (deflate: low 4 bits of 8) and FLG bytes, a multiple of 31
+    if len(header) >= 2 and header[0] & 0x0f == 8 and \
+            (header[0] << 8 | header[1]) % 31 == 0:
+        return "zlib"
+    return None
+
+
+class ZlibFile(io.RawIOBase):
+    """File object compressing what is written to it into the binary file
+        f ("wb" mode), or reading the decompressed bytes of f ("rb"), in
+        the zlib format. Closing it leaves f open"""
+
+    def __init__(self, f, mode="rb"):
+        """Initializes the stream starting at the current position of f"""
+        super().__init__()
+        self.__file = f
+        self.__mode = mode
+        self.__start = f.tell() if mode == "rb" else 0
+        self.__position = 0  # of the uncompressed stream
+        self.__zlib = (zlib.decompressobj() if mode == "rb" else
+                       zlib.compressobj())
+
+    def readable(self):
+        """Returns True in "rb" mode"""
+        return self.__mode == "rb"
+
+    def writable(self):
+        """Returns True in "wb" mode"""
+        return self.__mode == "wb"
+
+    def seekable(self):
+        """Returns True in "rb" mode, where seek(0) starts over"""
+        return self.__mode == "rb"
+
+    def tell(self):
+        """Returns the position in the uncompressed stream"""
+        return self.__position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Goes back to the start of the stream, the only seek supported"""
+        if (offset, whence) == (self.__position, io.SEEK_SET) or \
+                (offset, whence) == (0, io.SEEK_CUR):
+            return self.__position
+        if (offset, whence) != (0, io.SEEK_SET) or not self.readable():
+            raise io.UnsupportedOperation("can only seek to the start")
+        self.__file.seek(self.__start)
+        self.__zlib = zlib.decompressobj()
+        self.__position = 0
+        return 0
+
+    def readinto(self, buffer):
+        """Reads up to len(buffer) decompressed bytes into buffer and
+            returns their number, 0 at the end of the stream"""
+        while not self.__zlib.eof:
+            data = self.__zlib.unconsumed_tail
+            if not data:
+                data = self.__file.read(io.DEFAULT_BUFFER_SIZE)
+                if not data:
+                    raise EOFError("compressed file ended before the "
+                                   "end-of-stream marker was reached")
+            out = self.__zlib.decompress(data, len(buffer))
+            if out:
+                buffer[:len(out)] = out
+                self.__position += len(out)
+                return len(out)
+        return 0
+
+    def write(self, data):
+        """Compresses data into the file and returns its length"""
+        self.__file.write(self.__zlib.compress(data))
+        self.__position += len(data)
+        return len(data)
+
+    def close(self):
+        """Ends the compressed stream, in "wb" mode"""
+        if not self.closed and self.writable():
+            self.__file.write(self.__zlib.flush())
+        super().close()
+
+
+def reader(f):
+    """Returns a file object reading the decompressed bytes of the binary
+        file f, or f itself if it isn't compressed"""
+    start = f.tell()
+    codec = detect(f.read(6))
+    f.seek(start)
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    if codec == "lzma":
+        return lzma.LZMAFile(f, "rb")
+    if codec == "zlib":
+        return io.BufferedReader(ZlibFile(f, "rb"))
+    return f
+
+
+@contextmanager
+def writing(f, codec=None):
+    """Context manager giving a binary file object that compresses what is
+        written to it into the binary file f with codec (f itself when
+        None), and ends the compressed stream on exit; f stays open"""
+    if codec is None:
+        yield f
+        return
+    if codec == "gzip":
+        # the level of zlib and of the gzip tool, not the slower 9
+        out = gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6)
+    elif codec == "lzma":
+        out = lzma.LZMAFile(f, "wb")
+    elif codec == "zlib":
+        out = io.BufferedWriter(ZlibFile(f, "wb"))
+    else:
+        raise ValueError("unknown compression codec '{}'".format(codec))
+    try:
+        yield out
+    finally:
+        out.close()
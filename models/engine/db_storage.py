@@ -0,0 +1,465 @@
+#!/usr/bin/python3
+"""This module defines the class DBStorage"""
+
+import json
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+from datetime import datetime
+from models.engine import indexes, query
+from models.engine.file_storage import classes
+from models.engine.indexes import foreign_keys, numeric_attributes
+from models.engine.indexes import time_attributes, unique_attributes
+
+# attributes with an index on (cls, json_extract(data, '$.<attribute>'))
+indexed_attributes = sorted({attribute for indexed in (foreign_keys,
+                                                       unique_attributes,
+                                                       numeric_attributes)
+                             for names in indexed.values()
+                             for attribute in names} | set(time_attributes))
+
+sql_operators = {"eq": "=", "ne": "!=", "lt": "<", "lte": "<=", "gt": ">",
+                 "gte": ">="}
+
+
+class DBStorage:
+    """This class stores instances in a SQLite database, one row per
+        instance, and only keeps in memory the instances that were asked for
+
+    Rows are keyed by (class name, id), so all(cls), count(cls) and get()
+    use the primary key index instead of reading every row. __objects maps
+    each row to its instance for as long as the instance is in use, so a
+    row is never loaded as two instances. save() only writes the instances
+    created, changed (reported through touch()) or deleted since the last
+    save.
+    """
+
+    __options = {
+        "db_path": "hbnb.db",  # path to the SQLite database file
+    }
+
+    def __init__(self):
+        """Initializes an unconnected storage"""
+        self.__lock = threading.RLock()
+        self.__connection = None
+        self.__objects = weakref.WeakValueDictionary()  # key -> obj in use
+        self.__dirty = {}  # changes not saved yet: key -> obj, None if deleted
+        self.__batch = 0  # depth of nested batch() blocks
+
+    def lock(self):
+        """Returns the lock serializing access to the database"""
+        return self.__lock
+
+    def options(self):
+        """Returns the current storage options"""
+        return dict(self.__options)
+
+    def configure(self, **options):
+        """Updates the storage options"""
+        for name in options:
+            if name not in self.__options:
+                raise TypeError("unknown storage option '{}'".format(name))
+        self.__options = dict(self.__options, **options)
+
+    def all(self, cls=None):
+        """Returns a dictionary of all objects, or of the objects of one
+            class (class or class name) when cls is given"""
+        with self.__lock:
+            if cls is None:
+                rows = self.__db().execute(
+                    "SELECT cls, id, data FROM objects")
+            else:
+                rows = self.__db().execute(
+                    "SELECT cls, id, data FROM objects WHERE cls = ?",
+                    (self.__class_name(cls),))
+            new_dict = {}
+            for name, id, data in rows:
+                key = f"{name}.{id}"
+                if key not in self.__dirty:
+                    new_dict[key] = self.__load(key, data)
+            for key, obj in self.__dirty.items():
+                if obj is not None and (cls is None or key.startswith(
+                        self.__class_name(cls) + ".")):
+                    new_dict[key] = obj
+            return new_dict
+
+    def count(self, cls=None):
+        """Returns the number of objects, or of objects of one class"""
+        with self.__lock:
+            if cls is None:
+                query = "SELECT COUNT(*) FROM objects"
+                params = ()
+            else:
+                query = "SELECT COUNT(*) FROM objects WHERE cls = ?"
+                params = (self.__class_name(cls),)
+            number = self.__db().execute(query, params).fetchone()[0]
+            for key, obj in self.__dirty.items():
+                name, id = key.split(".", 1)
+                if cls is not None and name != self.__class_name(cls):
+                    continue
+                stored = self.__fetch(name, id) is not None
+                if obj is None and stored:
+                    number -= 1
+                elif obj is not None and not stored:
+                    number += 1
+            return number
+
+    def get(self, cls, id):
+        """Returns the object of class cls (class or class name) with this
+            id, or None if there's none"""
+        with self.__lock:
+            name = self.__class_name(cls)
+            key = f"{name}.{id}"
+            if key in self.__dirty:
+                return self.__dirty[key]
+            obj = self.__objects.get(key)
+            if obj is not None:
+                return obj
+            data = self.__fetch(name, id)
+            return None if data is None else self.__load(key, data)
+
+    def lookup(self, cls, attribute, value):
+        """Returns a dictionary of the objects of class cls (class or class
+            name) whose attribute equals value"""
+        return self.filter(cls, **{attribute + "__eq": value})
+
+    def filter(self, cls, **predicates):
+        """Returns a dictionary of the objects of class cls (class or class
+            name) matching all predicates (see models.engine.query). The
+            conditions run in the database; an equality on a foreign key
+            or a range on a numeric attribute goes through its index"""
+        conditions = query.parse(predicates)
+        name = self.__class_name(cls)
+        where = []
+        params = [name]
+        hint = None
+        for attribute, op, value in conditions:
+            if not attribute.isidentifier():
+                raise ValueError(
+                    "invalid attribute name '{}'".format(attribute))
+            if op in ("contains", "all"):
+                # json_each() of a scalar gives the scalar: only arrays
+                where.append("json_type(data, '$.{}') = 'array'".format(
+                    attribute))
+                for item in [value] if op == "contains" else list(value):
+                    where.append("EXISTS (SELECT 1 FROM json_each(data, "
+                                 "'$.{}') WHERE value = ?)".format(attribute))
+                    params.append(item)
+                continue
+            values = list(value) if op == "in" else [value]
+            # datetimes are stored in their isoformat, which sorts in order
+            values = [v.isoformat() if isinstance(v, datetime) else v
+                      for v in values]
+            # attributes left to their class default aren't in the data
+            default = getattr(classes.get(name), attribute, None)
+            if type(default) not in (str, int, float, bool):
+                default = None
+            column = "json_extract(data, '$.{}')".format(attribute)
+            # rows without the attribute can only be skipped, and the index
+            # used, when the default doesn't meet the condition
+            if (attribute in indexed_attributes and op != "ne"
+                    and not query.test(default, op, value)):
+                if hint is None or (op in ("eq", "in")
+                                    and hint[1] not in ("eq", "in")):
+                    hint = (attribute, op)
+            else:
+                column = "coalesce({}, ?)".format(column)
+                params.append(default)
+            if op == "in":
+                where.append("{} IN ({})".format(
+                    column, ", ".join("?" * len(values))))
+            else:
+                where.append("{} {} ?".format(column, sql_operators[op]))
+            params.extend(values)
+        with self.__lock:
+            rows = self.__db().execute(
+                "SELECT id, data FROM objects {}WHERE cls = ?{}".format(
+                    "" if hint is None else
+                    "INDEXED BY objects_{} ".format(hint[0]),
+                    "".join(" AND " + w for w in where)), params)
+            new_dict = {}
+            for id, data in rows:
+                key = f"{name}.{id}"
+                if key not in self.__dirty:
+                    new_dict[key] = self.__load(key, data)
+            for key, obj in self.__dirty.items():
+                if (obj is not None and key.startswith(name + ".")
+                        and query.matches(obj, conditions)):
+                    new_dict[key] = obj
+            return new_dict
+
+    def within(self, cls, south, west, north, east):
+        """Returns a dictionary of the objects of class cls (class or class
+            name) whose latitude and longitude lie inside the box, which
+            crosses the antimeridian when west > east"""
+        indexes.check_box(south, west, north, east)
+        if west > east:
+            found = self.within(cls, south, west, north, 180)
+            found.update(self.within(cls, south, -180, north, east))
+            return found
+        return self.filter(cls, latitude__gte=south, latitude__lte=north,
+                           longitude__gte=west, longitude__lte=east)
+
+    def nearest(self, cls, latitude, longitude, count=1):
+        """Returns a list of the count objects of class cls (class or class
+            name) nearest to the point, nearest first, by scanning them"""
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError("coordinates out of range")
+        found = indexes.nearest(self.all(cls), latitude, longitude, count)
+        return [obj for _, _, obj in found]
+
+    def search(self, cls, text):
+        """Returns a dictionary of the objects of class cls (class or class
+            name) whose text attributes hold every word of text, by
+            scanning them"""
+        name = self.__class_name(cls)
+        return indexes.find(self.all(name), text,
+                            indexes.text_attributes.get(name))
+
+    def newest(self, cls=None, count=10, attribute="updated_at"):
+        """Returns the count objects (of class cls, class or class name,
+            when given) with the latest attribute (created_at or
+            updated_at), latest first"""
+        with self.__lock:
+            # dirty rows are left out, so ask for enough to make up for them
+            found = self.__timeline(cls, attribute, [], "DESC LIMIT {}".format(
+                count + len(self.__dirty)))
+            found.sort(key=lambda entry: entry[:2], reverse=True)
+            return [obj for _, _, obj in found[:count]]
+
+    def since(self, timestamp, cls=None, attribute="updated_at", until=None):
+        """Returns the objects (of class cls, class or class name, when
+            given) whose attribute (created_at or updated_at) is after the
+            datetime timestamp, and not after until when given, oldest
+            first"""
+        conditions = [("gt", timestamp)]
+        if until is not None:
+            conditions.append(("lte", until))
+        with self.__lock:
+            found = self.__timeline(cls, attribute, conditions)
+            found.sort(key=lambda entry: entry[:2])
+            return [obj for _, _, obj in found]
+
+    def get_by(self, cls, **attributes):
+        """Returns the object of class cls (class or class name) whose
+            attributes equal the given values, or None if there's none"""
+        for obj in self.filter(cls, **attributes).values():
+            return obj
+        return None
+
+    def new(self, obj):
+        """Adds obj to the objects to save. Raises ValueError if obj shares
+            the value of a unique attribute with another object"""
+        with self.__lock:
+            key = f"{obj.__class__.__name__}.{obj.id}"
+            self.__check(key, obj)
+            self.__objects[key] = obj
+            self.__dirty[key] = obj
+
+    def touch(self, obj, name=None, previous=()):
+        """Marks obj as changed since it was last saved. If the change
+            breaks a unique attribute, the previous value is put back and
+            ValueError is raised"""
+        key = f"{obj.__class__.__name__}.{getattr(obj, 'id', None)}"
+        with self.__lock:
+            if (self.__objects.get(key) is obj
+                    and self.__dirty.get(key, obj) is not None):
+                try:
+                    self.__check(key, obj, name)
+                except ValueError:
+                    if previous:
+                        obj.__dict__[name] = previous[0]
+                    elif name is not None:
+                        obj.__dict__.pop(name, None)
+                    raise
+                self.__dirty[key] = obj
+
+    def delete(self, obj=None):
+        """Deletes obj from the objects if it's inside"""
+        if obj is None:
+            return
+        with self.__lock:
+            key = f"{obj.__class__.__name__}.{obj.id}"
+            self.__dirty[key] = None
+
+    def cascade(self, obj):
+        """Deletes obj and the objects depending on it, found through their
+            foreign keys (the cities of a state, the places of those
+            cities, their reviews...), in one batch written at once.
+            Returns the number of objects deleted by class name"""
+        counts = {}
+        with self.batch():
+            stack = [obj]
+            while stack:
+                obj = stack.pop()
+                name = obj.__class__.__name__
+                # a review is reached through both its place and its user
+                if self.get(name, obj.id) is None:
+                    continue
+                self.delete(obj)
+                counts[name] = counts.get(name, 0) + 1
+                for child, attribute in indexes.dependents(name):
+                    stack.extend(self.lookup(child, attribute,
+                                             obj.id).values())
+        return counts
+
+    def save(self):
+        """Writes the objects created, changed or deleted since the last
+            save to the database, in one transaction"""
+        with self.__lock:
+            if self.__batch or not self.__dirty:
+                return
+            puts = []
+            deletes = []
+            for key, obj in self.__dirty.items():
+                name, id = key.split(".", 1)
+                if obj is None:
+                    deletes.append((name, id))
+                    self.__objects.pop(key, None)
+                else:
+                    puts.append((name, id, json.dumps(obj.to_dict())))
+            with self.__db():
+                self.__db().executemany(
+                    "INSERT OR REPLACE INTO objects (cls, id, data) "
+                    "VALUES (?, ?, ?)", puts)
+                self.__db().executemany(
+                    "DELETE FROM objects WHERE cls = ? AND id = ?", deletes)
+            self.__dirty = {}
+
+    def reload(self):
+        """Connects to the database, creating it if needed, and forgets
+            the objects loaded so far"""
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+            self.__connection = sqlite3.connect(self.__options["db_path"],
+                                                check_same_thread=False)
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS objects ("
+                "cls TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (cls, id)) WITHOUT ROWID")
+            for attribute in indexed_attributes:
+                self.__connection.execute(
+                    "CREATE INDEX IF NOT EXISTS objects_{0} ON objects "
+                    "(cls, json_extract(data, '$.{0}'))".format(attribute))
+            self.__objects = weakref.WeakValueDictionary()
+            self.__dirty = {}
+
+    @contextmanager
+    def batch(self):
+        """Context manager that defers save() to the end of the with block.
+            If the block raises, the objects it created, changed or deleted
+            are put back as they are in the database and nothing is saved"""
+        with self.__lock:
+            if self.__batch == 0:
+                self.save()
+            self.__batch += 1
+            try:
+                yield self
+            except BaseException:
+                self.__batch -= 1
+                if self.__batch == 0:
+                    self.__rollback()
+                raise
+            self.__batch -= 1
+            self.save()
+
+    def __rollback(self):
+        """Puts the unsaved objects back as they are in the database"""
+        dirty, self.__dirty = self.__dirty, {}
+        for key, obj in dirty.items():
+            name, id = key.split(".", 1)
+            data = self.__fetch(name, id)
+            current = self.__objects.pop(key, None)
+            if data is None:
+                continue
+            obj = current or obj or self.__build(data)
+            obj.__dict__.clear()
+            obj.__dict__.update(self.__build(data).__dict__)
+            self.__objects[key] = obj
+
+    def __timeline(self, cls, attribute, conditions, order=""):
+        """Returns the (value, key, obj) of the objects (of class cls when
+            given) whose datetime attribute meets the (operator, datetime)
+            conditions, the rows sorted by the database then limited by
+            order ("DESC LIMIT n", say)"""
+        if not attribute.isidentifier():
+            raise ValueError("invalid attribute name '{}'".format(attribute))
+        column = "json_extract(data, '$.{}')".format(attribute)
+        where = ["{} {} ?".format(column, sql_operators[op])
+                 for op, _ in conditions]
+        values = [value.isoformat() for _, value in conditions]
+        hint = ""
+        if cls is not None:
+            where.insert(0, "cls = ?")
+            values.insert(0, self.__class_name(cls))
+            if attribute in indexed_attributes:
+                hint = "INDEXED BY objects_{} ".format(attribute)
+        rows = self.__db().execute(
+            "SELECT cls, id, data FROM objects {}{}ORDER BY {} {}".format(
+                hint, "WHERE " + " AND ".join(where) + " " if where else "",
+                column, order), values)
+        found = []
+        for name, id, data in rows:
+            key = f"{name}.{id}"
+            if key not in self.__dirty:
+                obj = self.__load(key, data)
+                found.append((getattr(obj, attribute), key, obj))
+        conditions = [(attribute, op, value) for op, value in conditions]
+        for key, obj in self.__dirty.items():
+            if (obj is not None and isinstance(getattr(obj, attribute, None),
+                                               datetime)
+                    and (cls is None or key.startswith(
+                        self.__class_name(cls) + "."))
+                    and query.matches(obj, conditions)):
+                found.append((getattr(obj, attribute), key, obj))
+        return found
+
+    def __check(self, key, obj, attribute=None):
+        """Raises ValueError if obj, stored under key, shares the value of
+            a unique attribute (attribute, or any when None) with another
+            object of its class"""
+        name = obj.__class__.__name__
+        for unique in unique_attributes.get(name, ()):
+            value = getattr(obj, unique, None)
+            if (attribute not in (None, unique) or not value
+                    or type(value) not in (str, int, float)):
+                continue
+            for other in self.filter(name, **{unique: value}):
+                if other != key:
+                    raise ValueError("{}.{} '{}' is already used by {}".format(
+                        name, unique, value, other))
+
+    def __db(self):
+        """Returns the database connection, connecting if needed"""
+        if self.__connection is None:
+            self.reload()
+        return self.__connection
+
+    def __fetch(self, name, id):
+        """Returns the JSON data of the row of class name with this id"""
+        row = self.__db().execute(
+            "SELECT data FROM objects WHERE cls = ? AND id = ?",
+            (name, id)).fetchone()
+        return None if row is None else row[0]
+
+    def __load(self, key, data):
+        """Returns the instance of the row key, building it from its JSON
+            data unless it was loaded already"""
+        obj = self.__objects.get(key)
+        if obj is None:
+            obj = self.__build(data)
+            self.__objects[key] = obj
+        return obj
+
+    @staticmethod
+    def __build(data):
+        """Returns a new instance built from the JSON data of a row"""
+        value = json.loads(data)
+        return classes[value["__class__"]](**value)
+
+    @staticmethod
+    def __class_name(cls):
+        """Returns the name of cls, which may be a class or a class name"""
+        return cls if type(cls) is str else cls.__name__
@@ -1,7 +1,22 @@
 #!/usr/bin/python3
 """This module defines the class FileStorage"""
 
+import atexit
+import codecs
+import io
 import json
+import mmap
+import multiprocessing
+import os
+import re
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import chain, repeat
 from models.base_model import BaseModel
 from models.user import User
 from models.state import State
@@ -9,48 +24,1560 @@ from models.city import City
 from models.place import Place
 from models.amenity import Amenity
 from models.review import Review
+from models.engine import binary, compression, indexes, key_index, query
+from models.engine.indexes import default_indexes
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_DECODER = json.JSONDecoder()
+_STAMP_SIZE = 64  # bytes of the first line of <file>.indexes
+
+classes = {
+    "BaseModel": BaseModel,
+    "User": User,
+    "State": State,
+    "City": City,
+    "Place": Place,
+    "Amenity": Amenity,
+    "Review": Review,
+}
+
+
+def iter_json_object(f, chunk_size, raw=False, spans=False):
+    """Yields the (key, value) pairs of the JSON object in the text file f,
+        reading it chunk_size characters at a time. With raw set, values
+        are yielded as their JSON text, with spans set as the (start, end)
+        character positions of that text in f"""
+    decoder = json.JSONDecoder()
+    buf = ""
+    base = 0  # position of buf in f
+    pos = 0
+    eof = False
+    state = "{"  # what comes next: "{", "key}", "key", ":", "value", ",}"
+    key = None
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            if eof:
+                raise ValueError("unexpected end of JSON file")
+            base += len(buf)
+            buf = f.read(chunk_size)
+            pos = 0
+            eof = buf == ""
+            continue
+        char = buf[pos]
+        if state in ("key", "value"):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = len(buf)
+            if end == len(buf) and not eof:
+                # the item may go on in the next chunk
+                chunk = f.read(chunk_size)
+                eof = chunk == ""
+                base += pos
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            if state == "key" and type(item) is not str:
+                raise ValueError("JSON object key expected")
+            if state == "key":
+                key = item
+                state = ":"
+            else:
+                if spans:
+                    yield key, (base + pos, base + end)
+                else:
+                    yield key, buf[pos:end] if raw else item
+                state = ",}"
+            pos = end
+            continue
+        if state == "key}" and char != "}":
+            state = "key"
+            continue
+        if char not in state:
+            raise ValueError("unexpected {!r} in JSON file".format(char))
+        pos += 1
+        if char == "}":
+            return
+        state = {"{": "key}", ":": "value", ",": "key"}[char]
+
+
+def iter_records(f, chunk_size, raw=False):
+    """Yields the (key, value) records of the storage file f, opened in
+        binary mode and compressed or not: instances from a binary file
+        (see models.engine.binary), dictionaries (or their JSON text with
+        raw set) from a JSON file"""
+    f = compression.reader(f)
+    is_binary = f.read(len(binary.MAGIC)) == binary.MAGIC
+    f.seek(0)
+    if is_binary:
+        yield from binary.load(f, classes, chunk_size)
+    else:
+        yield from iter_json_object(io.TextIOWrapper(f), chunk_size, raw)
+
+
+def iter_mapped(buf, decoder=None, chunk_size=1 << 16, spans=False):
+    """Yields the (key, value) records of the memory map buf of an
+        uncompressed storage file: instances built by the binary.Decoder
+        decoder from a binary file, dictionaries from a JSON file, or with
+        spans set the (start, end) of each value in buf (of a JSON file
+        only if it's ASCII, where characters and bytes line up)"""
+    if decoder is not None:
+        for kind, _, start, end in binary.walk(buf):
+            record = decoder.decode(kind, buf, start, end, not spans)
+            if record is not None:
+                yield record
+        return
+    buf.seek(0)
+    text = codecs.getreader("ascii" if spans else "utf-8")(buf)
+    yield from iter_json_object(text, chunk_size, spans=spans)
+
+
+def write_json(f, value, depth=1):
+    """Writes value as JSON to the text file f, the items of dictionaries
+        nested up to depth deep one at a time, so that the whole text is
+        never held in memory"""
+    if depth == 0 or type(value) is not dict:
+        f.write(json.dumps(value))
+        return
+    f.write("{")
+    separator = ""
+    for key, item in value.items():
+        f.write(separator + json.dumps(key) + ": ")
+        write_json(f, item, depth - 1)
+        separator = ", "
+    f.write("}")
+
+
+def read_shard(path, raw=False, chunk_size=1 << 16):
+    """Returns the list of (key, instance) records of the shard file path,
+        or of (key, JSON text) with raw set for a JSON file. Run by the
+        processes that read the shards at reload, which send the
+        instances back"""
+    with open(path, "rb") as f:
+        return [(key, value if raw or isinstance(value, BaseModel) else
+                 classes[value["__class__"]](**value))
+                for key, value in iter_records(f, chunk_size, raw)]
+
+
+def convert(source, target, format="binary", codec=None):
+    """Writes the records of the storage file source (JSON or binary,
+        compressed or not, not a shard manifest) to the file target in
+        format, "json" or "binary", compressed with codec when given (see
+        models.engine.compression), one record at a time"""
+    if format not in ("json", "binary"):
+        raise ValueError("unknown storage format '{}'".format(format))
+    with open(source, "rb") as f, open(target + ".tmp", "wb") as raw, \
+            compression.writing(raw, codec) as out:
+        records = iter_records(f, 1 << 16)
+        if format == "binary":
+            out.write(binary.MAGIC)
+            encoder = binary.Encoder()
+        else:
+            out = io.TextIOWrapper(out)
+            out.write("{")
+        for number, (key, value) in enumerate(records):
+            if key == "__shards__":
+                raise ValueError("convert the shards of {} by saving them "
+                                 "with the format option".format(source))
+            if not isinstance(value, BaseModel):
+                value = classes[value["__class__"]](**value)
+            if format == "binary":
+                out.write(encoder.encode(value.__class__.__name__,
+                                         value.__dict__))
+            else:
+                out.write((", " if number else "") + json.dumps(key) + ": "
+                          + json.dumps(value.to_dict()))
+        if format == "json":
+            out.write("}")
+            out.flush()
+            out.detach()
+    os.replace(target + ".tmp", target)
 
 
 class FileStorage:
     """This class serializes instances to a JSON file and deserializes JSON
-        file to instances"""
+        file to instances
+
+    With the "journal" option set, save() only appends the objects that
+    changed since the last save to <__file_path>.journal, one JSON record
+    per line, and reload() replays that journal on top of the JSON file.
+    The journal is folded back into the JSON file once it holds more than
+    "journal_limit" records.
+
+    With the "snapshot" option set, save() only counts the change and a
+    background thread writes a point-in-time snapshot of __objects once
+    "snapshot_changes" changes are pending or the oldest pending change is
+    "snapshot_interval" seconds old, which bounds what a crash can lose.
+    A snapshot that fails (a full disk, say) leaves its changes pending
+    and is tried again on the next trigger, at most once an interval;
+    snapshot_stats() counts the failures and keeps the last error.
+
+    The JSON file is never written in place: a snapshot goes to <file>.tmp,
+    is synced and renamed to <file>.ready once complete, then replaces the
+    file, so a crash leaves either the old or the new file in place.
+
+    With the "shards" option set, the records go to one file per class in
+    the <file>.d directory instead (or, for a class of more than
+    "shard_size" records when that is set, to several files by hash of
+    the key), and the JSON file only holds the {"__shards__": {shard:
+    file name}} manifest. A snapshot only writes the shards holding a
+    record that changed since the last one, each to a new file, then
+    replaces the manifest as above and removes the files it no longer
+    names. reload() reads either layout, the shards in parallel with
+    "shard_workers" processes once they add up to __parallel_size bytes.
+
+    With the "format" option set to "binary", snapshots are written in the
+    compact format of models.engine.binary instead of JSON (the journal
+    and the shard manifest stay JSON); reload() reads either, and
+    convert() turns a file of one format into the other.
+
+    The files written (JSON or binary, the shards and their manifest too)
+    are compressed as a whole with the codec of the "compression" option,
+    or else of the extension of __file_path (file.json.gz, say), and read
+    back whatever codec their first bytes show (see
+    models.engine.compression). The journal and <file>.indexes aren't.
+
+    With the "lazy" option set, reload() only keeps the JSON text of each
+    record (which save() writes back as is) and an instance is built the
+    first time all(), all(cls) or get() asks for it.
+
+    With the "mmap" option set, reload() parses an uncompressed file (the
+    shards aside) from a memory map of it instead of read buffers. In
+    lazy mode it then keeps the (start, end) offsets of each record in the
+    map rather than its text, and decodes the record from the map when
+    it's asked for (binary records included). The map stays valid after
+    a snapshot replaces the file, which is only ever renamed over.
+
+    With the "key_index" option set, every snapshot of a single
+    uncompressed JSON file also writes <file>.keys, the offsets of the
+    records in it (see models.engine.key_index), stamped like
+    <file>.indexes. reload() then only opens that index (and reads the
+    journal), get() reads the one record asked for through it, and the
+    first call needing more (all(), new(), delete(), a full save...)
+    reads the whole file, keeping the instances get() gave out.
+
+    Objects report attribute assignments through touch(); the JSON encoding
+    of every object that hasn't changed since it was last written is kept
+    in __encoded, so a save only encodes the objects that changed. Changes
+    that don't assign an attribute (appending to a list attribute, say)
+    need a touch() or new() call to be picked up.
+
+    Secondary indexes (models.engine.indexes) follow new(), touch() and
+    delete(); by default the foreign keys (City.state_id, Place.city_id,
+    ...) and User.email (unique: new() and touch() reject duplicates)
+    have a hash index and the numeric attributes of Place a sorted one for
+    ranges, which filter(), lookup() and get_by() use. The created_at and
+    updated_at of every class have a sorted index too, which also answers
+    newest() and since(). A grid index on
+    Place.latitude/longitude answers within() and nearest(), and a text
+    index on Place.name/description and Review.text answers search().
+    Indexes that can be dumped (the text indexes) are written to
+    <file>.indexes by the snapshots taken after they changed, and the
+    first line of the file, stamped with the size and mtime of the JSON
+    file, is rewritten in place by the others. reload() reads them back
+    instead of rebuilding them when the stamp still matches.
+    """
 
     __file_path = "file.json"  # path to the JSON file
+    __chunk_size = 1 << 16  # characters read or written at a time
     __objects = {}  # dictionary that stores all objects by <class name>.id
+    __options = {
+        "journal": False,  # append changes to the journal instead of rewriting
+        "journal_limit": 10000,  # journal records kept before compaction
+        "snapshot": False,  # write snapshots from a background thread
+        "snapshot_changes": 1000,  # pending changes that trigger a snapshot
+        "snapshot_interval": 5.0,  # max seconds a change waits for a snapshot
+        "commit_window": 0.0,  # seconds a save waits for others to join it
+        "fsync": True,  # flush writes to the disk before save() returns
+        "lazy": False,  # build instances on first access instead of reload
+        "shards": False,  # write one file per class (see shard_size)
+        "shard_size": 0,  # records per shard file of a class, 0: no limit
+        "shard_workers": 0,  # processes reading shards, 0: one per CPU
+        "format": "json",  # format of the files written: json or binary
+        "compression": "",  # codec of the files written: zlib, gzip, lzma
+        "mmap": False,  # reload() through a memory map of the file
+        "key_index": False,  # write <file>.keys, get() through it after reload
+    }
+    __parallel_size = 1 << 20  # bytes of shards worth reading in parallel
+    __classes = {}  # index of __objects by class name: name -> {key: obj}
+    __indexed = None  # the __objects dictionary __classes was built from
+    __raw = {}  # lazy mode: class name -> keys of records not loaded yet
+    __restored = []  # indexes reload() read back from <file>.indexes
+    __dumped = None  # index name -> (index, version) in <file>.indexes
+    __encoded = {}  # key -> '"<key>": <JSON of to_dict()>' of clean objects
+    __pending = {}  # changes not saved yet: key -> obj (put) or None (delete)
+    __journal_size = 0  # number of records in the journal file
+    __shards = {}  # shard name -> file name, as of the last snapshot taken
+    __unwritten = None  # keys changed since that snapshot, None: all of them
+    __mapped = None  # (memory map, binary Decoder or None) of the last reload
+    __spans = {}  # lazy mode: key -> (start, end) of a record in __mapped
+    __deferred = None  # (KeyIndex, journal changes) until the file is read
+
+    def __init__(self):
+        """Initializes the lock shared with the snapshot thread"""
+        self.__lock = threading.Condition()
+        self.__write_lock = threading.Lock()  # one snapshot write at a time
+        self.__taken = 0  # number of the last snapshot taken
+        self.__written = 0  # number of the last snapshot written
+        self.__requested = 0  # number of the last save() call
+        self.__committed = 0  # number of the last save() call written
+        self.__committing = False
+        self.__undo = None  # key -> (obj, existed, {name: old}) in batch()
+        self.__changes = 0  # changes not part of a snapshot yet
+        self.__since = None  # time of the oldest of those changes
+        self.__writer = None
+        self.__stats = {"snapshots": 0, "last_duration": 0.0,
+                        "last_bytes": 0, "total_bytes": 0,
+                        "failures": 0, "last_error": None}
+        self.__indexes = {}  # class name -> secondary indexes of the class
+        self.__unbuilt = set()  # indexes left empty by reload() until used
+        for index in default_indexes(classes):
+            self.add_index(index)
+
+    def add_index(self, index):
+        """Adds a secondary index (see models.engine.indexes), kept up to
+            date from then on with the objects of its class"""
+        name = index.class_name
+        self.__materialize(name)
+        for key, obj in self.__class_index().get(name, {}).items():
+            index.add(key, obj)
+        self.__indexes.setdefault(name, []).append(index)
+
+    def lock(self):
+        """Returns the lock that keeps snapshots consistent: hold it while
+            changing several objects that must be saved together"""
+        return self.__lock
+
+    def options(self):
+        """Returns the current storage options"""
+        return dict(self.__options)
 
-    def all(self):
-        """Returns the dictionary __objects"""
-        return self.__objects
+    def configure(self, **options):
+        """Updates the storage options"""
+        for name in options:
+            if name not in self.__options:
+                raise TypeError("unknown storage option '{}'".format(name))
+        if options.get("format", "json") not in ("json", "binary"):
+            raise ValueError("unknown storage format '{}'".format(
+                options["format"]))
+        if options.get("compression") not in ("", None) + compression.codecs:
+            raise ValueError("unknown compression codec '{}'".format(
+                options["compression"]))
+        self.__options = dict(self.__options, **options)
+
+    def all(self, cls=None):
+        """Returns the dictionary __objects, or a dictionary of the objects
+            of one class (class or class name) when cls is given"""
+        index = self.__class_index()
+        if cls is None:
+            for name in list(self.__raw):
+                self.__materialize(name)
+            return self.__objects
+        name = self.__class_name(cls)
+        self.__materialize(name)
+        return dict(index.get(name, {}))
+
+    def count(self, cls=None):
+        """Returns the number of objects, or of objects of one class"""
+        self.__class_index()
+        if cls is None:
+            return len(self.__objects) + sum(map(len, self.__raw.values()))
+        name = self.__class_name(cls)
+        return (len(self.__classes.get(name, {}))
+                + len(self.__raw.get(name, ())))
+
+    def get(self, cls, id):
+        """Returns the object of class cls (class or class name) with this
+            id, or None if there's none"""
+        name = self.__class_name(cls)
+        key = f"{name}.{id}"
+        if self.__deferred is not None:
+            return self.__get_deferred(name, key)
+        self.__class_index()
+        self.__materialize(name, key)
+        return self.__objects.get(key)
+
+    def lookup(self, cls, attribute, value):
+        """Returns a dictionary of the objects of class cls (class or class
+            name) whose attribute equals value"""
+        return self.filter(cls, **{attribute + "__eq": value})
+
+    def filter(self, cls, **predicates):
+        """Returns a dictionary of the objects of class cls (class or class
+            name) matching all predicates (see models.engine.query), only
+            checking those that the most selective usable index returns"""
+        conditions = query.parse(predicates)
+        name = self.__class_name(cls)
+        self.__materialize(name)
+        objs = query.plan(self.__built(self.__indexes.get(name, ())),
+                          conditions,
+                          self.__class_index().get(name, {}))
+        return {key: obj for key, obj in objs.items()
+                if query.matches(obj, conditions)}
+
+    def within(self, cls, south, west, north, east):
+        """Returns a dictionary of the objects of class cls (class or class
+            name) whose latitude and longitude lie inside the box, which
+            crosses the antimeridian when west > east"""
+        indexes.check_box(south, west, north, east)
+        name = self.__class_name(cls)
+        self.__materialize(name)
+        grid = self.__grid(name)
+        if grid is None:
+            return indexes.within(self.__class_index().get(name, {}), south,
+                                  west, north, east)
+        return grid.within(south, west, north, east)
+
+    def nearest(self, cls, latitude, longitude, count=1):
+        """Returns a list of the count objects of class cls (class or class
+            name) nearest to the point, nearest first"""
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError("coordinates out of range")
+        name = self.__class_name(cls)
+        self.__materialize(name)
+        grid = self.__grid(name)
+        if grid is None:
+            found = indexes.nearest(self.__class_index().get(name, {}),
+                                    latitude, longitude, count)
+        else:
+            found = grid.nearest(latitude, longitude, count)
+        return [obj for _, _, obj in found]
+
+    def search(self, cls, text):
+        """Returns a dictionary of the objects of class cls (class or class
+            name) whose text attributes hold every word of text"""
+        name = self.__class_name(cls)
+        index = self.__text(name)
+        if index is None:
+            self.__materialize(name)
+            return indexes.find(self.__class_index().get(name, {}), text)
+        self.__class_index()
+        if index not in self.__restored:
+            self.__materialize(name)
+        found = {}
+        for key in index.find(text):
+            self.__materialize(name, key)
+            obj = self.__objects.get(key)
+            if obj is not None:
+                found[key] = obj
+        return found
+
+    def newest(self, cls=None, count=10, attribute="updated_at"):
+        """Returns the count objects (of class cls, class or class name,
+            when given) with the latest attribute (created_at or
+            updated_at), latest first"""
+        found = []
+        for name in self.__names(cls):
+            found.extend(self.__timeline(name, attribute, (), count, True))
+        found.sort(key=lambda entry: entry[:2], reverse=True)
+        return [obj for _, _, obj in found[:count]]
+
+    def since(self, timestamp, cls=None, attribute="updated_at", until=None):
+        """Returns the objects (of class cls, class or class name, when
+            given) whose attribute (created_at or updated_at) is after the
+            datetime timestamp, and not after until when given, oldest
+            first: since(t0, until=t1), since(t1, until=t2)... export each
+            change once"""
+        conditions = [("gt", timestamp)]
+        if until is not None:
+            conditions.append(("lte", until))
+        found = []
+        for name in self.__names(cls):
+            found.extend(self.__timeline(name, attribute, conditions))
+        found.sort(key=lambda entry: entry[:2])
+        return [obj for _, _, obj in found]
+
+    def get_by(self, cls, **attributes):
+        """Returns the object of class cls (class or class name) whose
+            attributes equal the given values, or None if there's none"""
+        for obj in self.filter(cls, **attributes).values():
+            return obj
+        return None
 
     def new(self, obj):
-        """Sets in __objects the obj with key <obj class name>.id"""
-        key = f"{obj.__class__.__name__}.{obj.id}"
-        self.__objects[key] = obj
+        """Sets in __objects the obj with key <obj class name>.id. Raises
+            ValueError if obj breaks a unique index"""
+        name = obj.__class__.__name__
+        key = f"{name}.{obj.id}"
+        with self.__lock:
+            self.__class_index()
+            self.__materialize(name, key)
+            self.__check(name, key, obj)
+            self.__put(name, key, obj)
+
+    def __put(self, name, key, obj):
+        """Sets obj in __objects and the indexes, recording it for batch()
+            and the next save"""
+        with self.__lock:
+            if self.__undo is not None and key not in self.__undo:
+                old = self.__objects.get(key)
+                self.__undo[key] = (old or obj, old is not None, {})
+            self.__class_index().setdefault(name, {})[key] = obj
+            self.__objects[key] = obj
+            for index in self.__kept(name):
+                index.add(key, obj)
+            self.__encoded.pop(key, None)
+            self.__pending[key] = obj
+            self.__unwrite(key)
+
+    def touch(self, obj, name=None, previous=()):
+        """Marks obj as changed since it was last written. An attribute
+            assignment also passes the attribute name and its previous
+            value as a 1-tuple (empty if it wasn't set) for batch(). Only
+            the indexes on that attribute are updated, and those on lists,
+            which may have changed in place before a save().
+            If the change breaks a unique index, the previous value is put
+            back and ValueError is raised"""
+        key = f"{obj.__class__.__name__}.{getattr(obj, 'id', None)}"
+        with self.__lock:
+            if self.__objects.get(key) is obj:
+                try:
+                    self.__check(obj.__class__.__name__, key, obj, name)
+                except ValueError:
+                    if previous:
+                        obj.__dict__[name] = previous[0]
+                    elif name is not None:
+                        obj.__dict__.pop(name, None)
+                    raise
+                self.__encoded.pop(key, None)
+                self.__pending[key] = obj
+                self.__unwrite(key)
+                for index in self.__kept(obj.__class__.__name__):
+                    if name is None or name in index.attributes or \
+                            getattr(index, "mutable", False):
+                        index.add(key, obj)
+                if self.__undo is not None and name is not None:
+                    undo = self.__undo.setdefault(key, (obj, True, {}))
+                    undo[2].setdefault(name, previous)
+
+    def delete(self, obj=None):
+        """Deletes obj from __objects if it's inside"""
+        if obj is None:
+            return
+        name = obj.__class__.__name__
+        key = f"{name}.{obj.id}"
+        with self.__lock:
+            if self.__undo is not None and key in self.__objects:
+                self.__undo.setdefault(key, (self.__objects[key], True, {}))
+            self.__class_index().get(name, {}).pop(key, None)
+            for index in self.__kept(name):
+                index.remove(key)
+            self.__encoded.pop(key, None)
+            if self.__objects.pop(key, None) is not None:
+                self.__pending[key] = None
+                self.__unwrite(key)
+
+    def cascade(self, obj):
+        """Deletes obj and the objects depending on it, found through their
+            foreign keys (the cities of a state, the places of those
+            cities, their reviews...), in one batch written at once.
+            Returns the number of objects deleted by class name"""
+        counts = {}
+        with self.batch():
+            stack = [obj]
+            while stack:
+                obj = stack.pop()
+                name = obj.__class__.__name__
+                # a review is reached through both its place and its user
+                if self.get(name, obj.id) is None:
+                    continue
+                self.delete(obj)
+                counts[name] = counts.get(name, 0) + 1
+                for child, attribute in indexes.dependents(name):
+                    stack.extend(self.lookup(child, attribute,
+                                             obj.id).values())
+        return counts
 
     def save(self):
-        """Serializes __objects to the JSON file (path: __file_path)"""
-        new_dict = {key: value.to_dict() for key, value in self.__objects.items()}
-        with open(self.__file_path, "w") as f:
-            json.dump(new_dict, f)
+        """Serializes __objects to the JSON file (path: __file_path).
+            Saves that come in from other threads while a write is under
+            way (or within "commit_window" seconds of the first one) are
+            committed together by one write: the changes are captured with
+            the lock held, but written without it."""
+        if self.__undo is not None:
+            return
+        if self.__options["snapshot"]:
+            self.__schedule_snapshot()
+            return
+        with self.__lock:
+            self.__requested += 1
+            ticket = self.__requested
+        while True:
+            with self.__lock:
+                while self.__committing and self.__committed < ticket:
+                    self.__lock.wait()
+                if self.__committed >= ticket:
+                    return
+                self.__committing = True
+                try:
+                    if self.__options["commit_window"] > 0:
+                        self.__lock.wait(self.__options["commit_window"])
+                    covered = self.__requested
+                    write = self.__commit()
+                except BaseException:
+                    self.__committing = False
+                    self.__lock.notify_all()
+                    raise
+            try:
+                write()
+            except BaseException:
+                with self.__lock:
+                    self.__committing = False
+                    self.__lock.notify_all()
+                raise
+            with self.__lock:
+                self.__committing = False
+                self.__committed = covered
+                self.__lock.notify_all()
+
+    @contextmanager
+    def batch(self):
+        """Context manager that defers save() to the end of the with block,
+            where everything is written at once. If the block raises, the
+            objects created, deleted or changed in it are put back as they
+            were and nothing is written. A nested batch joins the outer one.
+            Other threads can't save until the block is over."""
+        with self.__lock:
+            if self.__undo is not None:
+                yield self
+                return
+            self.__undo = {}
+            try:
+                yield self
+            except BaseException:
+                self.__rollback()
+                raise
+            finally:
+                self.__undo = None
+            self.save()
+
+    def __rollback(self):
+        """Undoes the changes recorded in __undo (lock held)"""
+        undo, self.__undo = self.__undo, None
+        for key, (obj, existed, attributes) in undo.items():
+            for name, previous in attributes.items():
+                if previous:
+                    obj.__dict__[name] = previous[0]
+                else:
+                    obj.__dict__.pop(name, None)
+            current = self.__objects.get(key)
+            if current is not None and (current is not obj or not existed):
+                self.delete(current)
+            if existed:
+                self.__put(key.split(".")[0], key, obj)
+
+    def __commit(self):
+        """Captures the pending changes for the journal, or all of
+            __objects for the JSON file (lock held), and returns the
+            function writing them"""
+        if self.__options["journal"]:
+            limit = self.__options["journal_limit"]
+            if self.__journal_size + len(self.__pending) <= limit:
+                return self.__capture_journal()
+        return self.__capture_snapshot()
+
+    def snapshot(self):
+        """Writes all of __objects to the JSON file right away"""
+        with self.__lock:
+            write = self.__capture_snapshot()
+        write()
+
+    def __capture_snapshot(self):
+        """Takes the write lock and a snapshot of __objects (lock held) and
+            returns the function writing it, which releases the write lock.
+            Taken in order, so the next snapshot may reuse these shards"""
+        self.__write_lock.acquire()
+        try:
+            number, start = self.__start_snapshot()
+            entries = self.__entries()
+            states = self.__index_states()
+        except BaseException:
+            self.__write_lock.release()
+            raise
+
+        def write():
+            try:
+                self.__write_snapshot(number, start, entries, states)
+            finally:
+                self.__write_lock.release()
+        return write
+
+    def snapshot_stats(self):
+        """Returns the snapshot counters and the number of pending changes"""
+        with self.__lock:
+            return dict(self.__stats, pending_changes=self.__changes)
 
     def reload(self):
         """Deserializes the JSON file to __objects (only if the JSON file
-            (__file_path) exists; otherwise, do nothing."""
-        try:
-            with open(self.__file_path, "r") as f:
-                new_dict = json.load(f)
-            class_dict = {
-                "BaseModel": BaseModel,
-                "User": User,
-                "State": State,
-                "City": City,
-                "Place": Place,
-                "Amenity": Amenity,
-                "Review": Review,
-            }
-            self.__objects = {
-                key: class_dict[value["__class__"]](**value) for key, value in new_dict.items()
-            }
+            (__file_path) exists; otherwise, do nothing.
+            The file is parsed one object at a time, so only the instances
+            and a small read buffer are held in memory. A binary file is
+            read the same way, whatever the "format" option says, and
+            either is parsed from a memory map of it with the "mmap"
+            option. With the "key_index" option, the file is only read
+            once get() isn't enough."""
+        self.__load(self.__options["key_index"])
+
+    def __load(self, deferring=False):
+        """Reads the JSON file (see reload()), or with deferring set only
+            its key index when there's an up to date one"""
+        self.__deferred = None
+        self.__dumped = None
+        if os.path.exists(self.__file_path + ".ready"):
+            self.__install_snapshot()
+        journal = self.__read_journal()
+        changes = {}  # key -> value from the journal, None when deleted
+        for record in journal or []:
+            if "put" in record:
+                changes.update(record["put"])
+            else:
+                changes[record["delete"]] = None
+        changed = list(changes)
+        stamp = self.__stamp()
+        keys = deferring and key_index.load(self.__file_path + ".keys", stamp)
+        if keys:
+            self.__objects = {}
+            self.__class_index()
+            self.__pending = {}
+            self.__journal_size = len(journal or [])
+            self.__shards = {}
+            self.__deferred = (keys, changes)
+            return
+        lazy = self.__options["lazy"]
+        new_objects = {}
+        raw = {}
+        encoded = {}
+        spans = {}
+        shards = {}
+        mapped = None
+        try:
+            with open(self.__file_path, "rb") as f:
+                if self.__options["mmap"]:
+                    mapped = self.__map(f, lazy)
+                if mapped is not None:
+                    records = iter_mapped(*mapped, self.__chunk_size, lazy)
+                else:
+                    records = iter_records(f, self.__chunk_size, lazy)
+                first = next(records, None)
+                if first is not None and first[0] == "__shards__":
+                    shards = first[1]
+                    if type(shards) is tuple:
+                        shards = mapped[0][shards[0]:shards[1]]
+                    shards = json.loads(shards) if lazy else shards
+                    records = self.__read_shards(shards, lazy)
+                elif first is not None:
+                    records = chain([first], records)
+                for key, value in records:
+                    if key in changes:
+                        value = changes.pop(key)
+                        if value is not None and lazy:
+                            value = json.dumps(value)
+                    if value is None:
+                        continue
+                    if isinstance(value, BaseModel):
+                        new_objects[key] = value  # from binary or a shard
+                    elif type(value) is tuple:
+                        raw.setdefault(key.split(".")[0], set()).add(key)
+                        spans[key] = value
+                    elif lazy:
+                        raw.setdefault(key.split(".")[0], set()).add(key)
+                        encoded[key] = json.dumps(key) + ": " + value
+                    else:
+                        new_objects[key] = classes[value["__class__"]](**value)
+        except FileNotFoundError:
+            if journal is None:
+                return
+        for key, value in changes.items():
+            if value is not None:
+                new_objects[key] = classes[value["__class__"]](**value)
+        self.__objects = new_objects
+        restored = self.__restore_indexes(stamp)
+        self.__class_index(restored)
+        self.__raw = raw
+        self.__encoded = encoded
+        self.__spans = spans
+        self.__mapped = mapped if spans else None
+        self.__pending = {}
+        self.__journal_size = len(journal or [])
+        self.__shards = shards
+        self.__unwritten = set(changed)  # the shards don't have them yet
+        if restored:
+            self.__reindex(restored, changed)
+
+    def __get_deferred(self, name, key):
+        """Returns the object of key, read through the key index while the
+            file isn't read"""
+        if key in self.__objects:
+            return self.__objects[key]
+        keys, changes = self.__deferred
+        if key in changes:
+            value = changes[key]
+        else:
+            value = None
+            with open(self.__file_path, "rb") as f:
+                for start, end in keys.find(key):
+                    f.seek(start)
+                    found = json.loads(f.read(end - start))
+                    if "{}.{}".format(found.get("__class__"),
+                                      found.get("id")) == key:
+                        value = found
+                        break
+        if value is None:
+            return None
+        obj = classes[value["__class__"]](**value)
+        self.__objects[key] = obj
+        self.__classes.setdefault(name, {})[key] = obj
+        for index in self.__kept(name):
+            index.add(key, obj)
+        return obj
+
+    def __undefer(self):
+        """Reads the file after get() calls through the key index, keeping
+            the instances they gave out and their pending changes"""
+        built, pending = self.__objects, self.__pending
+        journal_size = self.__journal_size  # the snapshot may have reset it
+        self.__load()
+        self.__journal_size = journal_size
+        self.__class_index()
+        for key, obj in built.items():
+            name = key.split(".")[0]
+            self.__raw.get(name, set()).discard(key)
+            self.__spans.pop(key, None)
+            self.__encoded.pop(key, None)
+            self.__classes.setdefault(name, {})[key] = obj
+            self.__objects[key] = obj
+            for index in self.__kept(name):
+                index.add(key, obj)
+        self.__pending.update(pending)
+        for key in pending:
+            self.__unwrite(key)
+
+    def __materialize(self, name, key=None):
+        """Builds the instance of the not yet loaded record key, or of all
+            records of the class named name when key is None"""
+        if self.__deferred is not None:
+            self.__undefer()
+        keys = self.__raw.get(name)
+        if not keys:
+            return
+        if key is None:
+            todo = list(keys)
+            del self.__raw[name]
+        elif key in keys:
+            todo = [key]
+            keys.discard(key)
+        else:
+            return
+        bucket = self.__classes.setdefault(name, {})
+        for record in todo:
+            obj = self.__build(record)
+            self.__objects[record] = obj
+            bucket[record] = obj
+            for index in self.__kept(name):
+                index.add(record, obj)
+
+    def __build(self, key):
+        """Returns a new instance of the not yet loaded record key, from its
+            JSON text or its span of the memory map"""
+        span = self.__spans.pop(key, None)
+        if span is None:
+            entry = self.__encoded[key]
+            value = json.loads(entry[len(json.dumps(key)) + 2:])
+        else:
+            buf, decoder = self.__mapped
+            if decoder is not None:
+                return decoder.record(buf, *span)[1]
+            value = json.loads(buf[span[0]:span[1]])
+        return classes[value["__class__"]](**value)
+
+    def __raw_entry(self, key):
+        """Returns the '"<key>": <JSON>' entry of the not yet loaded record
+            key, leaving it unloaded"""
+        entry = self.__encoded.get(key)
+        if entry is not None:
+            return entry
+        return self.__mapped_entry(self.__mapped, key, *self.__spans[key])
+
+    @staticmethod
+    def __mapped_entry(mapped, key, start, end):
+        """Returns the '"<key>": <JSON>' entry of the record of key at
+            start:end of the (memory map, binary Decoder or None) mapped"""
+        buf, decoder = mapped
+        if decoder is not None:
+            value = json.dumps(decoder.record(buf, start, end)[1].to_dict())
+        else:
+            value = buf[start:end].decode()
+        return json.dumps(key) + ": " + value
+
+    def __map(self, f, spans):
+        """Returns the memory map of the open storage file f and the
+            binary.Decoder of its records (None for JSON), or None if it
+            can't be read through one: empty, compressed, or in JSON that
+            isn't ASCII when spans are asked for"""
+        header = f.read(len(binary.MAGIC))
+        f.seek(0)
+        if not header or compression.detect(header):
+            return None
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if header == binary.MAGIC:
+            return buf, binary.Decoder(classes)
+        step = 1 << 20
+        if spans and not all(buf[start:start + step].isascii()
+                             for start in range(0, len(buf), step)):
+            buf.close()
+            return None
+        return buf, None
+
+    def __encode(self, key, obj):
+        """Returns the cached '"<key>": <JSON>' entry of obj"""
+        entry = self.__encoded.get(key)
+        if entry is None:
+            entry = json.dumps(key) + ": " + json.dumps(obj.to_dict())
+            self.__encoded[key] = entry
+        return entry
+
+    def __names(self, cls):
+        """Returns the names of the classes cls (class, class name or None
+            for all) stands for"""
+        if cls is not None:
+            return [self.__class_name(cls)]
+        return list(set(self.__class_index()) | set(self.__raw))
+
+    def __timeline(self, name, attribute, conditions, count=None,
+                   reverse=False):
+        """Returns the (value, key, obj) of the objects of class name whose
+            attribute meets the (operator, value) conditions, in order of
+            value, through its sorted index if it has one"""
+        self.__materialize(name)
+        for index in self.__indexes.get(name, ()):
+            if hasattr(index, "ordered") and index.attribute == attribute:
+                self.__built([index])
+                return index.ordered(conditions, count, reverse)
+        conditions = [(attribute, op, value) for op, value in conditions]
+        found = [(getattr(obj, attribute), key, obj) for key, obj in
+                 self.__class_index().get(name, {}).items()
+                 if isinstance(getattr(obj, attribute, None), datetime)
+                 and query.matches(obj, conditions)]
+        found.sort(key=lambda entry: entry[:2], reverse=reverse)
+        return found[:count]
+
+    def __check(self, name, key, obj, attribute=None):
+        """Raises ValueError if obj, stored under key, shares the value of
+            a unique attribute (attribute, or any when None) with another
+            object of the class name"""
+        checks = [index for index in self.__indexes.get(name, ())
+                  if hasattr(index, "check") and
+                  (attribute is None or attribute in index.attributes)]
+        if checks:
+            self.__materialize(name)
+        for index in self.__built(checks):
+            index.check(key, obj)
+
+    def __text(self, name):
+        """Returns the text index of the class name, if it has one"""
+        for index in self.__indexes.get(name, ()):
+            if hasattr(index, "find"):
+                return self.__built([index])[0]
+        return None
+
+    def __grid(self, name):
+        """Returns the spatial index of the class name, if it has one"""
+        for index in self.__indexes.get(name, ()):
+            if hasattr(index, "nearest"):
+                return self.__built([index])[0]
+        return None
+
+    @staticmethod
+    def __class_name(cls):
+        """Returns the name of cls, which may be a class or a class name"""
+        return cls if type(cls) is str else cls.__name__
+
+    def __class_index(self, restored=()):
+        """Returns __classes, rebuilt if __objects was replaced since it
+            was built (reload, or a caller assigning a new dictionary).
+            The secondary indexes are emptied too, except the restored
+            ones reload() read back, and only built again once a query
+            needs them (see __built())"""
+        if self.__deferred is not None:
+            self.__undefer()
+        if self.__indexed is not self.__objects:
+            self.__classes = {}
+            for key, obj in self.__objects.items():
+                name = obj.__class__.__name__
+                self.__classes.setdefault(name, {})[key] = obj
+            self.__indexed = self.__objects
+            self.__encoded = {}
+            self.__raw = {}
+            self.__spans = {}
+            self.__unwritten = None
+            self.__restored = list(restored)
+            self.__unbuilt = set()
+            for indexes in self.__indexes.values():
+                for index in indexes:
+                    if index not in self.__restored:
+                        index.clear()
+                        self.__unbuilt.add(index)
+        return self.__classes
+
+    def __built(self, indexes):
+        """Builds those of the indexes left unbuilt since the last reload
+            from the objects of their class, and returns indexes"""
+        for index in indexes:
+            if index in self.__unbuilt:
+                self.__unbuilt.discard(index)
+                for key, obj in self.__classes.get(index.class_name,
+                                                   {}).items():
+                    index.add(key, obj)
+        return indexes
+
+    def __kept(self, name):
+        """Returns the indexes of the class name that changes must update:
+            the built ones"""
+        indexes = self.__indexes.get(name, ())
+        if not self.__unbuilt:
+            return indexes
+        return [index for index in indexes if index not in self.__unbuilt]
+
+    def __schedule_snapshot(self):
+        """Counts a change and wakes the snapshot thread when needed"""
+        with self.__lock:
+            self.__changes += 1
+            if self.__writer is None:
+                self.__writer = threading.Thread(target=self.__snapshot_loop,
+                                                 daemon=True)
+                self.__writer.start()
+                atexit.register(self.__flush)
+            if self.__since is None:
+                self.__since = time.monotonic()
+                self.__lock.notify_all()
+            elif self.__changes >= self.__options["snapshot_changes"]:
+                self.__lock.notify_all()
+
+    def __snapshot_loop(self):
+        """Background thread: takes a snapshot when a threshold is hit. A
+            snapshot that fails leaves its changes pending, to be retried"""
+        while True:
+            with self.__lock:
+                while True:
+                    if self.__since is None:
+                        self.__lock.wait()
+                        continue
+                    interval = self.__options["snapshot_interval"]
+                    waited = time.monotonic() - self.__since
+                    if (self.__changes >= self.__options["snapshot_changes"]
+                            or waited >= interval):
+                        break
+                    self.__lock.wait(interval - waited)
+                taken = (self.__changes, self.__pending)
+                try:
+                    write = self.__capture_snapshot()
+                except Exception as error:
+                    self.__snapshot_failed(error, *taken)
+                    continue
+            try:
+                write()
+            except Exception as error:
+                with self.__lock:
+                    self.__snapshot_failed(error, *taken)
+
+    def __snapshot_failed(self, error, changes, pending):
+        """Records the error of a snapshot of changes (the pending ones)
+            and puts them back (lock held), then waits for the next trigger
+            or snapshot_interval before a new try"""
+        self.__stats = dict(self.__stats,
+                            failures=self.__stats["failures"] + 1,
+                            last_error=repr(error))
+        self.__changes += changes
+        self.__since = time.monotonic()
+        pending.update(self.__pending)
+        self.__pending = pending
+        self.__shards = {}
+        self.__unwritten = None  # write every shard again
+        self.__lock.wait(self.__options["snapshot_interval"])
+
+    def __start_snapshot(self):
+        """Resets the change counters for a new snapshot (lock held) and
+            returns its number and start time"""
+        self.__changes = 0
+        self.__since = None
+        self.__pending = {}
+        self.__journal_size = 0
+        self.__taken += 1
+        return self.__taken, time.monotonic()
+
+    def __entries(self):
+        """Returns the encoded entries of every object, as an iterator or,
+            with the "shards" option, as a dictionary of shard name -> list
+            of entries, None for the shards unchanged since the last
+            snapshot (lock held)"""
+        objects = self.__class_index()
+        is_binary = self.__options["format"] == "binary"
+        if is_binary:
+            for name in list(self.__raw):
+                self.__materialize(name)
+        unwritten, self.__unwritten = self.__unwritten, set()
+        if not self.__options["shards"]:
+            self.__shards = {}
+            if is_binary:
+                return self.__binary_entries(list(self.__objects.values()))
+            return self.__all_entries()
+        names = set(objects) | set(self.__raw)
+        buckets = {name: self.__buckets(len(objects.get(name, ()))
+                                        + len(self.__raw.get(name, ())))
+                   for name in names}
+        changed = set()  # shards holding a changed record
+        for key in unwritten or ():
+            name = key.split(".")[0]
+            changed.add(self.__shard(key, buckets.get(name, 1)))
+        previous = {}  # class name -> its shards in the last snapshot
+        for shard in self.__shards:
+            previous.setdefault(shard.split(".")[0], []).append(shard)
+        entries = {}
+        for name in sorted(names):
+            if unwritten is not None and previous.get(name) and \
+                    not any(shard.split(".")[0] == name for shard in changed):
+                entries.update(dict.fromkeys(previous[name]))
+                continue
+            shards = {}
+            for key in chain(objects.get(name, ()),
+                             sorted(self.__raw.get(name, ()))):
+                shards.setdefault(self.__shard(key, buckets[name]),
+                                  []).append(key)
+            for shard, keys in shards.items():
+                if is_binary and (unwritten is None or shard in changed or
+                                  shard not in self.__shards):
+                    entries[shard] = list(self.__binary_entries(
+                        [self.__objects[key] for key in keys]))
+                elif unwritten is None or shard in changed or \
+                        shard not in self.__shards:
+                    entries[shard] = [self.__raw_entry(key) if key not in
+                                      self.__objects else
+                                      self.__encode(key, self.__objects[key])
+                                      for key in keys]
+                else:
+                    entries[shard] = None
+        return entries
+
+    def __all_entries(self):
+        """Returns an iterator over the encoded entry of every object. The
+            objects are encoded now (lock held), but the records not loaded
+            from the memory map are only read as the iterator gets to them,
+            once the lock is released, so their text is never all held in
+            memory"""
+        entries = [self.__encode(key, obj)
+                   for key, obj in self.__objects.items()]
+        unread, spans = [], []  # records still only in the memory map
+        for keys in self.__raw.values():
+            for key in keys:
+                entry = self.__encoded.get(key)
+                if entry is None:
+                    unread.append(key)
+                    spans.append(self.__spans[key])
+                else:
+                    entries.append(entry)
+        mapped = self.__mapped
+        return chain(entries, (self.__mapped_entry(mapped, key, *span)
+                               for key, span in zip(unread, spans)))
+
+    @staticmethod
+    def __binary_entries(objs):
+        """Yields the chunks of a binary file holding objs, encoding each
+            one from a copy of its attributes as the iterator gets to it"""
+        encoder = binary.Encoder()
+        yield binary.MAGIC
+        for obj in objs:
+            yield encoder.encode(obj.__class__.__name__, dict(obj.__dict__))
+
+    def __buckets(self, size):
+        """Returns the number of shards of a class of size records: the
+            smallest power of two giving at most "shard_size" per shard"""
+        limit = self.__options["shard_size"]
+        buckets = 1
+        while limit > 0 and buckets * limit < size:
+            buckets *= 2
+        return buckets
+
+    @staticmethod
+    def __shard(key, buckets):
+        """Returns the name of the shard of key in a class split in buckets:
+            the class name, or <class name>.<hash bucket>of<buckets>"""
+        name = key.split(".")[0]
+        if buckets == 1:
+            return name
+        bucket = zlib.crc32(key.encode()) % buckets
+        return "{}.{}of{}".format(name, bucket, buckets)
+
+    def __unwrite(self, key):
+        """Records that key changed since the last snapshot"""
+        if self.__unwritten is not None:
+            self.__unwritten.add(key)
+
+    def __write_snapshot(self, number, start, entries, states):
+        """Writes the entries of snapshot number to the JSON file and the
+            index states to <file>.indexes (write lock held), a chunk at a
+            time, unless a newer one is there"""
+        if number < self.__written:
+            return
+        try:
+            size = 0
+            shards = {}
+            if type(entries) is dict:
+                size, shards = self.__write_shards(entries)
+                entries = ['"__shards__": ' + json.dumps(shards)]
+            spans = [] if self.__options["key_index"] and not shards else None
+            size += self.__write_entries(self.__file_path + ".tmp", entries,
+                                         spans)
+        except BaseException:
+            self.__shards = {}  # whatever it wrote can't be reused
+            raise
+        os.replace(self.__file_path + ".tmp", self.__file_path + ".ready")
+        self.__install_snapshot()
+        self.__remove_shards(shards.values())
+        if spans:  # a plain JSON file was written
+            key_index.write(self.__file_path + ".keys", self.__stamp(), spans)
+        self.__write_indexes(states)
+        self.__written = number
+        stats = self.__stats
+        self.__stats = dict(stats, snapshots=stats["snapshots"] + 1,
+                            last_duration=time.monotonic() - start,
+                            last_bytes=size,
+                            total_bytes=stats["total_bytes"] + size)
+
+    def __write_entries(self, path, entries, spans=None):
+        """Writes the entries as a JSON object (or the chunks of a binary
+            file as they are) to the file path, a chunk at a time, syncs it
+            and returns the number of bytes written. The (key, start, end)
+            bytes of each value of an uncompressed JSON file are appended
+            to the list spans when given"""
+        entries = iter(entries)
+        first = next(entries, None)
+        if type(first) is bytes:
+            return self.__write_chunks(path, chain([first], entries))
+        entries = chain([] if first is None else [first], entries)
+        codec = self.__codec()
+        if codec is not None:
+            spans = None  # positions in the file wouldn't be of any use
+        with open(path, "wb") as raw:
+            with compression.writing(raw, codec) as out:
+                f = io.TextIOWrapper(out)
+                parts = []
+                buffered = 0
+                position = 0  # bytes written before the entry
+                separator = "{"
+                for entry in entries:
+                    parts.append(separator)
+                    parts.append(entry)
+                    if spans is not None:
+                        position += len(separator)
+                        position = self.__span(entry, position, spans)
+                    separator = ", "
+                    buffered += len(entry) + 2
+                    if buffered >= self.__chunk_size:
+                        f.write("".join(parts))
+                        parts = []
+                        buffered = 0
+                parts.append("{}" if separator == "{" else "}")
+                f.write("".join(parts))
+                f.flush()
+                f.detach()
+            self.__sync(raw)
+            return raw.tell()
+
+    @staticmethod
+    def __span(entry, position, spans):
+        """Appends the (key, start, end) of the value of entry, written at
+            the byte position, to spans and returns the position after it"""
+        key, end = _DECODER.raw_decode(entry)
+        end += len(": ")
+        if entry.isascii():
+            spans.append((key, position + end, position + len(entry)))
+            return position + len(entry)
+        start = position + len(entry[:end].encode())
+        position += len(entry.encode())
+        spans.append((key, start, position))
+        return position
+
+    def __write_chunks(self, path, chunks):
+        """Writes the bytes chunks to the file path, a few at a time, syncs
+            it and returns the number of bytes written"""
+        with open(path, "wb") as raw:
+            with compression.writing(raw, self.__codec()) as f:
+                parts = []
+                buffered = 0
+                for chunk in chunks:
+                    parts.append(chunk)
+                    buffered += len(chunk)
+                    if buffered >= self.__chunk_size:
+                        f.write(b"".join(parts))
+                        parts = []
+                        buffered = 0
+                f.write(b"".join(parts))
+            self.__sync(raw)
+            return raw.tell()
+
+    def __codec(self):
+        """Returns the codec to compress the files written with, or None"""
+        return (self.__options["compression"]
+                or compression.codec_of(self.__file_path))
+
+    def __write_shards(self, entries):
+        """Writes the changed shards of entries (see __entries) to new files
+            in <file>.d and returns the number of bytes written and
+            the shard name -> file name manifest (write lock held)"""
+        directory = self.__file_path + ".d"
+        os.makedirs(directory, exist_ok=True)
+        size = 0
+        shards = {}
+        for shard, shard_entries in entries.items():
+            if shard_entries is None:
+                shards[shard] = self.__shards[shard]
+                continue
+            shards[shard] = "{}.{}.{}".format(
+                shard, uuid.uuid4().hex[:12],
+                "bin" if type(shard_entries[0]) is bytes else "json")
+            size += self.__write_entries(
+                os.path.join(directory, shards[shard]), shard_entries)
+        if self.__options["fsync"]:
+            self.__sync_directory(directory)
+        self.__shards = shards
+        return size, shards
+
+    def __remove_shards(self, kept):
+        """Removes the files of <file>.d but the kept ones: the shards of
+            older snapshots, and of snapshots a crash interrupted"""
+        directory = self.__file_path + ".d"
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        kept = set(kept)
+        for name in names:
+            if name not in kept:
+                os.remove(os.path.join(directory, name))
+        if not kept:
+            os.rmdir(directory)
+
+    def __read_shards(self, manifest, raw):
+        """Yields the (key, instance or, with raw set, JSON text) records
+            of the shard files of the manifest in the order of the shard
+            names, read by a pool of processes if the files are large"""
+        directory = self.__file_path + ".d"
+        paths = [os.path.join(directory, manifest[shard])
+                 for shard in sorted(manifest)]
+        workers = min(len(paths),
+                      self.__options["shard_workers"] or os.cpu_count() or 1)
+        try:
+            size = sum(map(os.path.getsize, paths))
+            if (workers > 1 and size >= self.__parallel_size
+                    and "fork" in multiprocessing.get_all_start_methods()):
+                context = multiprocessing.get_context("fork")
+                with ProcessPoolExecutor(workers, mp_context=context) as pool:
+                    for records in pool.map(read_shard, paths, repeat(raw),
+                                            repeat(self.__chunk_size)):
+                        yield from records
+            else:
+                for path in paths:
+                    yield from read_shard(path, raw, self.__chunk_size)
+        except FileNotFoundError as e:
+            raise ValueError("missing shard file {}".format(e.filename))
+
+    def __index_states(self):
+        """Returns the versions and the dump() of every index that has one
+            and holds all the objects of its class (restored, or built with
+            none of them left unloaded), by index name, None when
+            <file>.indexes has them already, or {} when there are none or
+            they are empty (lock held)"""
+        dumped = [index for kept in self.__indexes.values() for index in kept
+                  if hasattr(index, "dump") and
+                  (index in self.__restored or index not in self.__unbuilt
+                   and not self.__raw.get(index.class_name))]
+        versions = {index.name: (index, index.version) for index in dumped}
+        if versions == self.__dumped:
+            return None
+        if not any(len(index) for index in dumped):
+            return {}
+        return versions, {index.name: index.dump() for index in dumped}
+
+    def __write_indexes(self, states):
+        """Writes the (versions, states) of __index_states() to
+            <file>.indexes, an index a word at a time, or when None only
+            stamps the file for the JSON file just written. Empty indexes
+            ({}) are rebuilt for nothing, so the file is removed (write
+            lock held)"""
+        path = self.__file_path + ".indexes"
+        stamp = json.dumps({"stamp": self.__stamp()})
+        stamp = stamp.ljust(_STAMP_SIZE - 1) + "\n"
+        if states == {}:
+            self.__dumped = None
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
+        if states is None:
+            if self.__dumped:
+                try:
+                    with open(path, "r+") as f:
+                        f.write(stamp)
+                except FileNotFoundError:
+                    self.__dumped = None
+            return
+        versions, states = states
+        with open(path + ".tmp", "w") as f:
+            f.write(stamp)
+            write_json(f, {"indexes": states}, 4)
+        os.replace(path + ".tmp", path)
+        self.__dumped = versions
+
+    def __restore_indexes(self, stamp):
+        """Loads the indexes saved in <file>.indexes if they were written
+            with the JSON file of this stamp, and returns them"""
+        try:
+            with open(self.__file_path + ".indexes", "r") as f:
+                if stamp is None or \
+                        json.loads(f.readline()).get("stamp") != stamp:
+                    return []
+                saved = json.load(f)
+        except (OSError, ValueError, AttributeError):
+            return []
+        restored = []
+        for kept in self.__indexes.values():
+            for index in kept:
+                state = saved["indexes"].get(getattr(index, "name", None))
+                if state is None or not hasattr(index, "load"):
+                    continue
+                try:
+                    index.load(state)
+                except (LookupError, TypeError, ValueError):
+                    index.clear()  # written in another format: rebuild it
+                    continue
+                restored.append(index)
+        self.__dumped = {index.name: (index, index.version)
+                         for index in restored}
+        return restored
+
+    def __reindex(self, restored, keys):
+        """Brings the restored indexes up to date with the records of keys,
+            which the journal changed after the indexes were saved"""
+        for key in keys:
+            name = key.split(".")[0]
+            stale = [index for index in restored if index.class_name == name]
+            for index in stale:
+                index.remove(key)
+            self.__materialize(name, key)
+            obj = self.__objects.get(key)
+            if obj is None:
+                continue
+            for index in stale:
+                index.add(key, obj)
+
+    def __stamp(self):
+        """Returns the [size, mtime] of the JSON file, or None without one"""
+        try:
+            stat = os.stat(self.__file_path)
+        except FileNotFoundError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def __flush(self):
+        """Writes the changes still pending when the interpreter exits"""
+        if self.__changes:
+            self.snapshot()
+
+    def __capture_journal(self):
+        """Takes the write lock and one journal record per pending change
+            (lock held), and returns the function appending them to the
+            journal file, which releases the write lock. If that fails, the
+            journal is cut back to its size before the append, so that no
+            partial line is left for the next append to follow, and the
+            changes are pending again"""
+        lines = []
+        for key, obj in self.__pending.items():
+            if obj is None:
+                lines.append('{"delete": ' + json.dumps(key) + "}\n")
+            elif self.__objects.get(key) is obj:
+                lines.append('{"put": {' + self.__encode(key, obj) + "}}\n")
+        self.__write_lock.acquire()
+        pending, self.__pending = self.__pending, {}
+        self.__journal_size += len(lines)
+
+        def write():
+            path = self.__file_path + ".journal"
+            size = None
+            try:
+                if lines:
+                    with open(path, "a") as f:
+                        size = f.tell()
+                        f.writelines(lines)
+                        self.__sync(f)
+            except BaseException:
+                if size is not None:
+                    try:
+                        os.truncate(path, size)
+                    except OSError:
+                        pass
+                self.__write_lock.release()
+                with self.__lock:
+                    pending.update(self.__pending)
+                    self.__pending = pending
+                    self.__journal_size -= len(lines)
+                raise
+            self.__write_lock.release()
+        return write
+
+    def __sync(self, f):
+        """Makes sure what was written to f is on the disk"""
+        f.flush()
+        if self.__options["fsync"]:
+            os.fsync(f.fileno())
+
+    def __install_snapshot(self):
+        """Replaces the JSON file with the complete snapshot <file>.ready.
+            The journal goes first: its changes are all in the snapshot,
+            and replaying it over a newer snapshot would undo changes.
+            reload() finishes this if a crash interrupted it."""
+        try:
+            os.remove(self.__file_path + ".journal")
         except FileNotFoundError:
             pass
+        os.replace(self.__file_path + ".ready", self.__file_path)
+        if self.__options["fsync"]:
+            self.__sync_directory(
+                os.path.dirname(os.path.abspath(self.__file_path)))
 
+    @staticmethod
+    def __sync_directory(path):
+        """Makes sure the files created in the directory path are on the
+            disk"""
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __read_journal(self):
+        """Returns the list of journal records, or None without a journal.
+            A partly written last line (interrupted append) is ignored and
+            cut off the file, so that the next append starts a new line.
+            A damaged complete line is skipped, keeping the records after
+            it."""
+        path = self.__file_path + ".journal"
+        try:
+            with open(path, "rb") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return None
+        if lines and not lines[-1].endswith(b"\n"):
+            os.truncate(path, sum(map(len, lines)) - len(lines.pop()))
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return records
@@ -0,0 +1,796 @@
+#!/usr/bin/python3
+"""This module defines the secondary indexes kept by the storage engines"""
+
+import heapq
+import re
+from bisect import bisect_left, insort
+from datetime import datetime
+from math import asin, cos, degrees, inf, radians, sin, sqrt
+
+# attributes of each class that hold the id of another object
+foreign_keys = {
+    "City": ("state_id",),
+    "Place": ("city_id", "user_id"),
+    "Review": ("place_id", "user_id"),
+}
+
+# class of the objects each foreign key holds the id of
+references = {
+    "state_id": "State",
+    "city_id": "City",
+    "place_id": "Place",
+    "user_id": "User",
+}
+
+# attributes of each class no two objects may share a value of
+unique_attributes = {
+    "User": ("email",),
+}
+
+# timestamps of every class, searched by range and by order
+time_attributes = ("created_at", "updated_at")
+
+# numeric attributes of each class searched by range
+numeric_attributes = {
+    "Place": ("number_rooms", "number_bathrooms", "max_guest",
+              "price_by_night"),
+}
+
+# (latitude, longitude) attributes of each class searched by position
+coordinates = {
+    "Place": ("latitude", "longitude"),
+}
+
+# list attributes of each class searched by the items they hold
+list_attributes = {
+    "Place": ("amenity_ids",),
+}
+
+# text attributes of each class searched by words
+text_attributes = {
+    "Place": ("name", "description"),
+    "Review": ("text",),
+}
+
+earth_radius = 6371.0088  # mean radius of the Earth in km
+
+
+def dependents(class_name):
+    """Returns the (class name, foreign key) pairs of the objects that hold
+        the id of an object of class_name, and depend on it"""
+    return [(name, attribute) for name, attributes in foreign_keys.items()
+            for attribute in attributes
+            if references.get(attribute) == class_name]
+
+
+def distance(latitude1, longitude1, latitude2, longitude2):
+    """Returns the great-circle distance in km between two points"""
+    phi1, phi2 = radians(latitude1), radians(latitude2)
+    a = (sin((phi2 - phi1) / 2) ** 2 + cos(phi1) * cos(phi2)
+         * sin(radians(longitude2 - longitude1) / 2) ** 2)
+    return 2 * earth_radius * asin(min(1.0, sqrt(a)))
+
+
+def position(obj, attributes=("latitude", "longitude")):
+    """Returns the (latitude, longitude) of obj, or None if they aren't
+        numbers within [-90, 90] and [-180, 180]"""
+    latitude, longitude = (getattr(obj, a, None) for a in attributes)
+    for value, limit in ((latitude, 90), (longitude, 180)):
+        if type(value) not in (int, float) or not -limit <= value <= limit:
+            return None
+    return latitude, longitude
+
+
+def check_box(south, west, north, east):
+    """Raises ValueError unless the latitudes and longitudes of the box are
+        in range"""
+    if not (-90 <= south <= 90 and -90 <= north <= 90 and
+            -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError("coordinates out of range")
+
+
+def within(objects, south, west, north, east,
+           attributes=("latitude", "longitude")):
+    """Returns a dictionary of the objects (a dictionary) inside the box,
+        which crosses the antimeridian when west > east, by scanning them"""
+    found = {}
+    for key, obj in objects.items():
+        point = position(obj, attributes)
+        if point is not None and south <= point[0] <= north and (
+                west <= point[1] <= east if west <= east
+                else point[1] >= west or point[1] <= east):
+            found[key] = obj
+    return found
+
+
+def nearest(objects, latitude, longitude, count=1,
+            attributes=("latitude", "longitude")):
+    """Returns the (distance, key, obj) of the count objects (a dictionary)
+        nearest to the point, nearest first, by scanning them"""
+    found = []
+    for key, obj in objects.items():
+        point = position(obj, attributes)
+        if point is not None:
+            found.append((distance(latitude, longitude, *point), key, obj))
+    return heapq.nsmallest(count, found, key=lambda f: f[:2])
+
+
+class HashIndex:
+    """Maps each value of one attribute of the objects of one class to
+        those objects, so finding the objects with a given value costs
+        O(number of matches)"""
+
+    def __init__(self, class_name, attribute):
+        """Initializes an empty index on class_name.attribute"""
+        self.class_name = class_name
+        self.attribute = attribute
+        self.attributes = (attribute,)  # the attributes the index reads
+        self.__objects = {}  # value -> {key: obj}
+        self.__values = {}  # key -> value the object is indexed under
+
+    def add(self, key, obj):
+        """Indexes obj under key, or re-indexes it if its value changed"""
+        value = getattr(obj, self.attribute, None)
+        try:
+            hash(value)
+        except TypeError:
+            value = None
+        if key in self.__values:
+            if self.__values[key] == value:
+                self.__objects[value][key] = obj
+                return
+            self.remove(key)
+        self.__objects.setdefault(value, {})[key] = obj
+        self.__values[key] = value
+
+    def remove(self, key):
+        """Removes the object indexed under key, if any"""
+        if key not in self.__values:
+            return
+        value = self.__values.pop(key)
+        bucket = self.__objects[value]
+        del bucket[key]
+        if not bucket:
+            del self.__objects[value]
+
+    def clear(self):
+        """Removes every object from the index"""
+        self.__objects = {}
+        self.__values = {}
+
+    def lookup(self, value):
+        """Returns a dictionary of the objects whose attribute equals value"""
+        return dict(self.__objects.get(value, {}))
+
+    def estimate(self, conditions):
+        """Returns the number of objects search(conditions) returns, or
+            None if the index can't answer any of the (operator, value)
+            conditions on its attribute (see models.engine.query)"""
+        sizes = [size for size, _, _ in self.__answers(conditions)]
+        return min(sizes) if sizes else None
+
+    def search(self, conditions):
+        """Returns a dictionary of the objects matching the "eq" or "in"
+            condition that matches the fewest objects"""
+        _, op, value = min(self.__answers(conditions), key=lambda a: a[0])
+        if op == "eq":
+            return self.lookup(value)
+        found = {}
+        for v in value:
+            found.update(self.__objects.get(v, {}))
+        return found
+
+    def __answers(self, conditions):
+        """Returns the (size, operator, value) of the conditions the index
+            can answer"""
+        answers = []
+        for op, value in conditions:
+            try:
+                if op == "eq":
+                    size = len(self.__objects.get(value, ()))
+                elif op == "in":
+                    size = sum(len(self.__objects.get(v, ())) for v in value)
+                else:
+                    continue
+            except TypeError:
+                continue
+            answers.append((size, op, value))
+        return answers
+
+
+class UniqueIndex(HashIndex):
+    """HashIndex on an attribute whose non-empty values must be unique;
+        the storage engines call check() before adding or changing an
+        object"""
+
+    def check(self, key, obj):
+        """Raises ValueError if another object than key already holds the
+            attribute value of obj"""
+        value = getattr(obj, self.attribute, None)
+        if not value:
+            return
+        try:
+            holders = self.lookup(value)
+        except TypeError:
+            return
+        for other in holders:
+            if other != key:
+                raise ValueError("{}.{} '{}' is already used by {}".format(
+                    self.class_name, self.attribute, value, other))
+
+
+class BitmapIndex:
+    """Maps each item of a list attribute of the objects of one class to a
+        bitmap of the objects holding it, bit n standing for the object
+        numbered n, so finding the objects holding several items is a few
+        bitwise ANDs. The bitmaps are bytearrays, so setting a bit doesn't
+        copy them, and are read as ints to be ANDed"""
+
+    mutable = True  # lists change in place: re-read them on every touch
+
+    def __init__(self, class_name, attribute):
+        """Initializes an empty index on class_name.attribute"""
+        self.class_name = class_name
+        self.attribute = attribute
+        self.attributes = (attribute,)  # the attributes the index reads
+        self.__bitmaps = {}  # item -> bitmap of the objects holding it
+        self.__counts = {}  # item -> number of objects holding it
+        self.__numbers = {}  # key -> number of the object's bit
+        self.__keys = []  # number -> key, None when free
+        self.__free = []  # numbers of removed objects, to reuse
+        self.__objects = {}  # key -> obj
+        self.__items = {}  # key -> items the object is indexed under
+
+    def add(self, key, obj):
+        """Indexes obj under key, or re-indexes it if its items changed"""
+        # not read through obj: a ListAttribute would give it a list
+        value = obj.__dict__.get(self.attribute,
+                                 getattr(type(obj), self.attribute, None))
+        items = set()
+        if type(value) in (list, tuple, set, frozenset):
+            for item in value:
+                try:
+                    hash(item)
+                except TypeError:
+                    continue
+                items.add(item)
+        self.__objects[key] = obj
+        if key not in self.__numbers:
+            number = self.__free.pop() if self.__free else len(self.__keys)
+            if number == len(self.__keys):
+                self.__keys.append(key)
+            else:
+                self.__keys[number] = key
+            self.__numbers[key] = number
+            self.__items[key] = set()
+        number = self.__numbers[key]
+        old = self.__items[key]
+        for item in old - items:
+            self.__clear_bit(item, number)
+        for item in items - old:
+            bitmap = self.__bitmaps.setdefault(item, bytearray())
+            if len(bitmap) <= number >> 3:
+                bitmap.extend(bytes((number >> 3) + 1 - len(bitmap)))
+            bitmap[number >> 3] |= 1 << (number & 7)
+            self.__counts[item] = self.__counts.get(item, 0) + 1
+        self.__items[key] = items
+
+    def remove(self, key):
+        """Removes the object indexed under key, if any"""
+        if key not in self.__numbers:
+            return
+        number = self.__numbers.pop(key)
+        for item in self.__items.pop(key):
+            self.__clear_bit(item, number)
+        self.__keys[number] = None
+        self.__free.append(number)
+        del self.__objects[key]
+
+    def clear(self):
+        """Removes every object from the index"""
+        self.__bitmaps = {}
+        self.__counts = {}
+        self.__numbers = {}
+        self.__keys = []
+        self.__free = []
+        self.__objects = {}
+        self.__items = {}
+
+    def lookup(self, value):
+        """Returns a dictionary of the objects whose attribute holds value"""
+        return self.search([("contains", value)])
+
+    def estimate(self, conditions):
+        """Returns the number of objects search(conditions) returns, or
+            None if the index can't answer any of the (operator, value)
+            conditions on its attribute (see models.engine.query)"""
+        bitmap = self.__bitmap(conditions)
+        return None if bitmap is None else bin(bitmap).count("1")
+
+    def search(self, conditions):
+        """Returns a dictionary of the objects holding every item of the
+            "contains" and "all" conditions"""
+        bits = bin(self.__bitmap(conditions))[:1:-1]
+        found = {}
+        number = bits.find("1")
+        while number >= 0:
+            key = self.__keys[number]
+            found[key] = self.__objects[key]
+            number = bits.find("1", number + 1)
+        return found
+
+    def __bitmap(self, conditions):
+        """Returns the AND of the bitmaps of the items of the "contains"
+            and "all" conditions, or None if there are none"""
+        items = []
+        for op, value in conditions:
+            if op == "contains":
+                items.append(value)
+            elif op == "all":
+                items.extend(value)
+        if not items:
+            return None
+        try:
+            items.sort(key=lambda item: self.__counts.get(item, 0))
+        except TypeError:
+            return None
+        bitmap = -1
+        for item in items:
+            bitmap &= int.from_bytes(self.__bitmaps.get(item, b""), "little")
+            if not bitmap:
+                break
+        return bitmap
+
+    def __clear_bit(self, item, number):
+        """Clears the bit of the object numbered number in the bitmap of
+            item, dropping the bitmap once no object holds item"""
+        self.__counts[item] -= 1
+        if not self.__counts[item]:
+            del self.__counts[item]
+            del self.__bitmaps[item]
+        else:
+            self.__bitmaps[item][number >> 3] &= ~(1 << (number & 7)) & 0xFF
+
+
+class _Last:
+    """Sorts after every key, so (value, _Last()) sorts after every entry
+        of value"""
+
+    def __lt__(self, other):
+        """Returns False: nothing sorts after _Last"""
+        return False
+
+    def __gt__(self, other):
+        """Returns True: _Last sorts after everything"""
+        return True
+
+
+class SortedIndex:
+    """Keeps the objects of one class sorted by one attribute (numbers by
+        default, or the other kinds of values given), so finding the
+        objects whose value lies in a range costs O(log n + number of
+        matches). Added objects wait in a list until the next read, so
+        building the index (at reload) is one sort, not n insertions"""
+
+    def __init__(self, class_name, attribute, kinds=(int, float)):
+        """Initializes an empty index on class_name.attribute"""
+        self.class_name = class_name
+        self.attribute = attribute
+        self.attributes = (attribute,)  # the attributes the index reads
+        self.kinds = tuple(kinds)  # types of the values indexed
+        self.__entries = []  # sorted (value, key) pairs
+        self.__added = []  # (value, key) pairs not in __entries yet
+        self.__objects = {}  # key -> obj
+        self.__values = {}  # key -> value the object is indexed under
+
+    def add(self, key, obj):
+        """Indexes obj under key, or re-indexes it if its value changed"""
+        value = getattr(obj, self.attribute, None)
+        if not self.__sortable(value):
+            value = None
+        if key in self.__values:
+            if self.__values[key] == value:
+                self.__objects[key] = obj
+                return
+            self.remove(key)
+        if value is not None:
+            self.__added.append((value, key))
+        self.__objects[key] = obj
+        self.__values[key] = value
+
+    def remove(self, key):
+        """Removes the object indexed under key, if any"""
+        if key not in self.__values:
+            return
+        value = self.__values.pop(key)
+        del self.__objects[key]
+        if value is not None:
+            entries = self.__sorted()
+            del entries[bisect_left(entries, (value, key))]
+
+    def clear(self):
+        """Removes every object from the index"""
+        self.__entries = []
+        self.__added = []
+        self.__objects = {}
+        self.__values = {}
+
+    def lookup(self, value):
+        """Returns a dictionary of the objects whose attribute equals value"""
+        return self.search([("eq", value)]) if self.__sortable(value) else {}
+
+    def estimate(self, conditions):
+        """Returns the number of objects search(conditions) returns, or
+            None if the index can't answer any of the (operator, value)
+            conditions on its attribute (see models.engine.query)"""
+        bounds = self.__bounds(conditions)
+        if bounds is None:
+            return None
+        start, end = bounds
+        return max(0, end - start)
+
+    def search(self, conditions):
+        """Returns a dictionary of the objects whose value lies within all
+            the "eq", "lt", "lte", "gt" and "gte" conditions, in order"""
+        start, end = self.__bounds(conditions)
+        return {key: self.__objects[key]
+                for _, key in self.__entries[start:end]}
+
+    def ordered(self, conditions=(), count=None, reverse=False):
+        """Returns the (value, key, obj) of the objects within the range
+            conditions in order of value, highest first when reverse, and
+            at most count of them"""
+        start, end = self.__bounds(conditions) or (0, len(self.__sorted()))
+        if count is not None:
+            if reverse:
+                start = max(start, end - count)
+            else:
+                end = min(end, start + count)
+        entries = self.__entries[start:end]
+        if reverse:
+            entries.reverse()
+        return [(value, key, self.__objects[key]) for value, key in entries]
+
+    def __sorted(self):
+        """Returns __entries, merging the added entries in first"""
+        if len(self.__added) > 16:
+            self.__entries.extend(self.__added)
+            self.__entries.sort()
+        else:
+            for entry in self.__added:
+                insort(self.__entries, entry)
+        self.__added = []
+        return self.__entries
+
+    def __bounds(self, conditions):
+        """Returns the slice of __entries within the range conditions, or
+            None if there are none with a value of the indexed kinds"""
+        entries = self.__sorted()
+        start, end = 0, len(entries)
+        found = False
+        for op, value in conditions:
+            if op not in ("eq", "lt", "lte", "gt", "gte") or \
+                    not self.__sortable(value):
+                continue
+            found = True
+            if op in ("eq", "gte"):
+                start = max(start, bisect_left(entries, (value,)))
+            elif op == "gt":
+                start = max(start, bisect_left(entries, (value, _Last())))
+            if op in ("eq", "lte"):
+                end = min(end, bisect_left(entries, (value, _Last())))
+            elif op == "lt":
+                end = min(end, bisect_left(entries, (value,)))
+        return (start, end) if found else None
+
+    def __sortable(self, value):
+        """Returns True if value can be sorted with the indexed values"""
+        return type(value) in self.kinds and value == value
+
+
+class GridIndex:
+    """Buckets the objects of one class by the cell of a latitude/longitude
+        grid they lie in, so finding the objects inside a box or nearest to
+        a point only reads the cells around it instead of every object"""
+
+    def __init__(self, class_name, attributes=("latitude", "longitude"),
+                 cell=1.0):
+        """Initializes an empty index on the (latitude, longitude)
+            attributes of class_name, with cells of about cell degrees"""
+        self.class_name = class_name
+        self.attributes = tuple(attributes)  # the attributes the index reads
+        self.__rows = max(1, round(180 / cell))
+        self.__columns = max(1, round(360 / cell))
+        self.__height = 180 / self.__rows  # degrees of latitude per row
+        self.__width = 360 / self.__columns  # degrees of longitude per column
+        self.__cells = {}  # (row, column) -> {key: obj}
+        self.__positions = {}  # key -> (latitude, longitude) indexed under
+
+    def add(self, key, obj):
+        """Indexes obj under key, or re-indexes it if it moved"""
+        point = position(obj, self.attributes)
+        if key in self.__positions:
+            if self.__positions[key] == point:
+                self.__cells[self.__cell(*point)][key] = obj
+                return
+            self.remove(key)
+        if point is None:
+            return
+        self.__cells.setdefault(self.__cell(*point), {})[key] = obj
+        self.__positions[key] = point
+
+    def remove(self, key):
+        """Removes the object indexed under key, if any"""
+        if key not in self.__positions:
+            return
+        cell = self.__cell(*self.__positions.pop(key))
+        bucket = self.__cells[cell]
+        del bucket[key]
+        if not bucket:
+            del self.__cells[cell]
+
+    def clear(self):
+        """Removes every object from the index"""
+        self.__cells = {}
+        self.__positions = {}
+
+    def within(self, south, west, north, east):
+        """Returns a dictionary of the objects inside the box, which
+            crosses the antimeridian when west > east"""
+        check_box(south, west, north, east)
+        if west > east:
+            found = self.within(south, west, north, 180)
+            found.update(self.within(south, -180, north, east))
+            return found
+        if south > north:
+            return {}
+        (bottom, left), (top, right) = (self.__cell(max(south, -90), west),
+                                        self.__cell(min(north, 90), east))
+        if (top - bottom + 1) * (right - left + 1) > len(self.__cells):
+            cells = [cell for cell in self.__cells
+                     if bottom <= cell[0] <= top and left <= cell[1] <= right]
+        else:
+            cells = [(row, column) for row in range(bottom, top + 1)
+                     for column in range(left, right + 1)]
+        found = {}
+        for cell in cells:
+            for key, obj in self.__cells.get(cell, {}).items():
+                latitude, longitude = self.__positions[key]
+                if south <= latitude <= north and west <= longitude <= east:
+                    found[key] = obj
+        return found
+
+    def nearest(self, latitude, longitude, count=1):
+        """Returns the (distance, key, obj) of the count objects nearest to
+            the point, nearest first. Rings of cells around the point are
+            read until no cell further out can hold a nearer object"""
+        if count < 1:
+            return []
+        row, column = self.__cell(latitude, longitude)
+        best = []  # heap of (-distance, key, obj) of the nearest so far
+        seen = set()
+        remaining = len(self.__cells)  # non-empty cells not read yet
+        radius = 0
+        while remaining:
+            cells = self.__ring(row, column, radius) - seen
+            last = len(cells) >= remaining
+            if last:
+                cells = set(self.__cells) - seen
+            for cell in cells:
+                seen.add(cell)
+                bucket = self.__cells.get(cell)
+                if bucket is None:
+                    continue
+                remaining -= 1
+                for key, obj in bucket.items():
+                    item = (-distance(latitude, longitude,
+                                      *self.__positions[key]), key, obj)
+                    if len(best) < count:
+                        heapq.heappush(best, item)
+                    elif item[:2] > best[0][:2]:
+                        heapq.heapreplace(best, item)
+            if last or len(best) == count and -best[0][0] <= self.__reach(
+                    latitude, longitude, row, column, radius):
+                break
+            radius += 1
+        return sorted(((-d, key, obj) for d, key, obj in best),
+                      key=lambda f: f[:2])
+
+    def __cell(self, latitude, longitude):
+        """Returns the (row, column) of the cell holding the point"""
+        return (min(int((latitude + 90) // self.__height), self.__rows - 1),
+                min(int((longitude + 180) // self.__width),
+                    self.__columns - 1))
+
+    def __ring(self, row, column, radius):
+        """Returns the cells radius cells away from (row, column), columns
+            wrapping around the antimeridian"""
+        offsets = [(r, c) for r in (-radius, radius)
+                   for c in range(-radius, radius + 1)]
+        offsets += [(r, c) for c in (-radius, radius)
+                    for r in range(1 - radius, radius)]
+        return {(row + r, (column + c) % self.__columns) for r, c in offsets
+                if 0 <= row + r < self.__rows}
+
+    def __reach(self, latitude, longitude, row, column, radius):
+        """Returns the distance in km from the point to the nearest point
+            outside the cells within radius of (row, column)"""
+        bottom = (row - radius) * self.__height - 90
+        top = (row + radius + 1) * self.__height - 90
+        gaps = [latitude - bottom if bottom > -90 else inf,
+                top - latitude if top < 90 else inf]
+        if 2 * radius + 1 < self.__columns:
+            left = (column - radius) * self.__width - 180
+            right = (column + radius + 1) * self.__width - 180
+            dlon = min(longitude - left, right - longitude)
+            # nearest point of the meridians dlon degrees away or more
+            if dlon >= 90:
+                gaps.append(90 - abs(latitude))
+            else:
+                gaps.append(degrees(asin(sin(radians(dlon))
+                                         * cos(radians(latitude)))))
+        return radians(min(gaps)) * earth_radius
+
+
+def words(text):
+    """Returns the set of lowercase words of text"""
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def find(objects, text, attributes=None):
+    """Returns a dictionary of the objects (a dictionary) whose string
+        attributes (all of them when attributes is None) hold every word of
+        text, by scanning them"""
+    wanted = words(text)
+    found = {}
+    if not wanted:
+        return found
+    for key, obj in objects.items():
+        values = (obj.__dict__.values() if attributes is None else
+                  (getattr(obj, a, None) for a in attributes))
+        have = set()
+        for value in values:
+            if type(value) is str:
+                have |= words(value)
+        if wanted <= have:
+            found[key] = obj
+    return found
+
+
+class TextIndex:
+    """Maps each word of some string attributes of the objects of one class
+        to the keys of the objects holding it (posting lists), so finding
+        the objects holding some words costs O(matches of the rarest word)
+        instead of reading every string. The posting lists can be saved
+        with dump() and read back with load() instead of being rebuilt;
+        version counts the changes, to tell if a dump is out of date"""
+
+    def __init__(self, class_name, attributes):
+        """Initializes an empty index on the attributes of class_name"""
+        self.class_name = class_name
+        self.attributes = tuple(attributes)  # the attributes the index reads
+        self.name = "text:{}.{}".format(class_name, ",".join(attributes))
+        self.version = 0
+        self.__postings = {}  # word -> set of keys
+        self.__texts = {}  # key -> the indexed strings (or None) of its object
+        self.__loaded = {}  # key -> words, for keys read by load(), or None
+
+    def add(self, key, obj):
+        """Indexes obj under key, or re-indexes it if its words changed"""
+        texts = tuple(value if type(value) is str else None
+                      for value in (getattr(obj, attribute, None)
+                                    for attribute in self.attributes))
+        if self.__texts.get(key) == texts:
+            return
+        previous = self.__forget(key)
+        self.__texts[key] = texts
+        found = set()
+        for text in texts:
+            if text is not None:
+                found |= words(text)
+        if found == previous:
+            return
+        self.__discard(key, previous - found)
+        for word in found - previous:
+            self.__postings.setdefault(word, set()).add(key)
+        self.version += 1
+
+    def remove(self, key):
+        """Removes the object indexed under key, if any"""
+        previous = self.__forget(key)
+        if previous:
+            self.__discard(key, previous)
+            self.version += 1
+
+    def clear(self):
+        """Removes every object from the index"""
+        self.__postings = {}
+        self.__texts = {}
+        self.__loaded = {}
+        self.version += 1
+
+    def __len__(self):
+        """Returns the number of words indexed"""
+        return len(self.__postings)
+
+    def find(self, text):
+        """Returns the set of keys of the objects holding every word of
+            text, intersecting the shortest posting lists first"""
+        postings = sorted((self.__postings.get(word, set())
+                           for word in words(text)), key=len)
+        if not postings:
+            return set()
+        found = set(postings[0])
+        for keys in postings[1:]:
+            found &= keys
+        return found
+
+    def dump(self):
+        """Returns the posting lists as a JSON serializable dictionary, the
+            keys numbered to keep it small"""
+        numbers = {}
+        postings = {word: [numbers.setdefault(key, len(numbers))
+                           for key in found]
+                    for word, found in self.__postings.items()}
+        return {"keys": list(numbers), "postings": postings}
+
+    def load(self, state):
+        """Replaces the index with the posting lists returned by dump()"""
+        keys = state["keys"]
+        self.__postings = {word: {keys[number] for number in numbers}
+                           for word, numbers in state["postings"].items()}
+        self.__texts = {}
+        self.__loaded = None
+        self.version += 1
+
+    def __forget(self, key):
+        """Returns the set of words key is indexed under and forgets them,
+            leaving the posting lists to the caller. Only the strings of an
+            object are kept, its words being found again from them, but
+            those of the keys read by load() are rebuilt from the posting
+            lists the first time they are needed"""
+        texts = self.__texts.pop(key, None)
+        if texts is not None:
+            found = set()
+            for text in texts:
+                if text is not None:
+                    found |= words(text)
+            return found
+        if self.__loaded is None:
+            self.__loaded = {}
+            for word, keys in self.__postings.items():
+                for indexed in keys:
+                    self.__loaded.setdefault(indexed, []).append(word)
+        return set(self.__loaded.pop(key, ()))
+
+    def __discard(self, key, found):
+        """Removes key from the posting lists of the words in found"""
+        for word in found:
+            keys = self.__postings[word]
+            keys.discard(key)
+            if not keys:
+                del self.__postings[word]
+
+
+def default_indexes(class_names=()):
+    """Returns new indexes for the attributes the storage engines index,
+        including the timestamps of the classes named in class_names"""
+    return [HashIndex(name, attribute)
+            for name, attributes in foreign_keys.items()
+            for attribute in attributes] + \
+        [UniqueIndex(name, attribute)
+         for name, attributes in unique_attributes.items()
+         for attribute in attributes] + \
+        [SortedIndex(name, attribute)
+         for name, attributes in numeric_attributes.items()
+         for attribute in attributes] + \
+        [GridIndex(name, attributes)
+         for name, attributes in coordinates.items()] + \
+        [BitmapIndex(name, attribute)
+         for name, attributes in list_attributes.items()
+         for attribute in attributes] + \
+        [TextIndex(name, attributes)
+         for name, attributes in text_attributes.items()] + \
+        [SortedIndex(name, attribute, kinds=(datetime,))
+         for name in class_names
+         for attribute in time_attributes]
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+"""This module defines the key index of the FileStorage JSON file
+
+<file>.keys locates the record of every key of the JSON file, so that one
+record can be read without parsing the whole file. It starts with MAGIC,
+then the size and mtime (in ns) of the JSON file it was written with and
+its number of entries, then holds one fixed-size entry per record: the
+8-byte BLAKE2 digest of the key, and the offset and length of the JSON
+value of the record in the file. Entries are sorted by digest for a
+binary search; keys sharing a digest have adjacent entries, which the
+reader tells apart by the records they point to.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+
+MAGIC = b"\x00HBNBK\x01\n"
+
+_header = struct.Struct("<QqQ")  # JSON file size, mtime, number of entries
+_entry = struct.Struct("<8sQQ")  # key digest, value offset, value length
+
+
+def digest(key):
+    """Returns the 8-byte digest entries are sorted by"""
+    return hashlib.blake2b(key.encode(), digest_size=8).digest()
+
+
+def write(path, stamp, spans):
+    """Writes to the file path the index of the (key, start, end) spans of
+        the values of the JSON file of stamp ([size, mtime])"""
+    entries = sorted((digest(key), start, end - start)
+                     for key, start, end in spans)
+    with open(path + ".tmp", "wb") as f:
+        f.write(MAGIC + _header.pack(stamp[0], stamp[1], len(entries)))
+        f.write(b"".join(_entry.pack(*entry) for entry in entries))
+    os.replace(path + ".tmp", path)
+
+
+def load(path, stamp):
+    """Returns the KeyIndex of the file path if it was written for the JSON
+        file of stamp ([size, mtime]), or None"""
+    try:
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):  # missing or empty
+        return None
+    start = len(MAGIC) + _header.size
+    if stamp is None or buf[:len(MAGIC)] != MAGIC or len(buf) < start:
+        buf.close()
+        return None
+    size, mtime, count = _header.unpack_from(buf, len(MAGIC))
+    if [size, mtime] != stamp or len(buf) != start + count * _entry.size:
+        buf.close()
+        return None
+    return KeyIndex(buf, start, count)
+
+
+class KeyIndex:
+    """Reader of a key index file, through a memory map of it"""
+
+    def __init__(self, buf, start, count):
+        """Initializes the reader of the count entries at start in buf"""
+        self.__buf = buf
+        self.__start = start
+        self.__count = count
+
+    def __len__(self):
+        """Returns the number of entries"""
+        return self.__count
+
+    def find(self, key):
+        """Returns the (start, end) spans of the values that may be the
+            record of key: those of the entries sharing its digest"""
+        target = digest(key)
+        low, high = 0, self.__count
+        while low < high:  # first entry with a digest >= target
+            middle = (low + high) // 2
+            if self.__entry(middle)[0] < target:
+                low = middle + 1
+            else:
+                high = middle
+        spans = []
+        while low < self.__count:
+            found, offset, length = self.__entry(low)
+            if found != target:
+                break
+            spans.append((offset, offset + length))
+            low += 1
+        return spans
+
+    def __entry(self, number):
+        """Returns the (digest, offset, length) of entry number"""
+        return _entry.unpack_from(self.__buf,
+                                  self.__start + number * _entry.size)
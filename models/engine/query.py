@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+"""This module defines the predicates understood by storage.filter()
+
+A predicate is a keyword argument <attribute>__<operator>=<value>, or
+<attribute>=<value> for equality, for example:
+    storage.filter(Place, city_id=city.id, price_by_night__lte=100,
+                   max_guest__gte=2, user_id__in=[a.id, b.id],
+                   amenity_ids__all=[wifi.id, pool.id])
+"""
+
+import operator
+
+operators = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "in": lambda value, values: value in values,
+    "contains": lambda value, item: is_list(value) and item in value,
+    "all": lambda value, items: (is_list(value)
+                                 and all(item in value for item in items)),
+}
+
+# operators whose value is a list of values
+list_operators = ("in", "all")
+
+
+def is_list(value):
+    """Returns True if value is a list of values. "contains" and "all"
+        only look into those, as the database storage does: a string
+        attribute never matches them, whatever its substrings"""
+    return type(value) in (list, tuple, set, frozenset)
+
+
+def parse(predicates):
+    """Returns the list of (attribute, operator name, value) conditions of
+        the keyword arguments predicates. Raises ValueError for an unknown
+        __<operator> suffix"""
+    conditions = []
+    for name, value in predicates.items():
+        attribute, _, op = name.rpartition("__")
+        if attribute and op and op not in operators:
+            raise ValueError("unknown operator '{}' in {}".format(op, name))
+        if not attribute or not op:  # no suffix, or a name like __class__
+            attribute, op = name, "eq"
+        if op in list_operators and not is_list(value):
+            raise ValueError("{} needs a list of values".format(name))
+        conditions.append((attribute, op, value))
+    return conditions
+
+
+def test(value, op, operand):
+    """Returns True if value meets the condition op operand; values that
+        can't be compared (a str and an int, say) don't match"""
+    try:
+        return bool(operators[op](value, operand))
+    except TypeError:
+        return False
+
+
+def matches(obj, conditions):
+    """Returns True if obj meets every condition"""
+    for attribute, op, value in conditions:
+        if not test(getattr(obj, attribute, None), op, value):
+            return False
+    return True
+
+
+def plan(indexes, conditions, objects):
+    """Returns the objects to check the conditions against: the matches of
+        the index that narrows the conditions on its attribute down the
+        most, or all objects of the class when no index can answer any
+        condition"""
+    by_attribute = {}
+    for attribute, op, value in conditions:
+        by_attribute.setdefault(attribute, []).append((op, value))
+    best = None
+    best_size = len(objects)
+    for index in indexes:
+        ops = by_attribute.get(getattr(index, "attribute", None))
+        if not ops:
+            continue
+        size = index.estimate(ops)
+        if size is not None and size < best_size:
+            best = (index, ops)
+            best_size = size
+    if best is None:
+        return objects
+    index, ops = best
+    return index.search(ops)
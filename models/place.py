@@ -1,6 +1,6 @@
 #!/usr/bin/python3
 """Defines the Place class."""
-from models.base_model import BaseModel
+from models.base_model import BaseModel, ListAttribute, Relation
 
 
 class Place(BaseModel):
@@ -15,4 +15,6 @@ class Place(BaseModel):
     price_by_night = 0
     latitude = 0.0
     longitude = 0.0
-    amenity_ids = []
+    amenity_ids = ListAttribute()
+    reviews = Relation("Review", "place_id")
+    amenities = Relation("Amenity", "amenity_ids", listed=True)
@@ -1,8 +1,9 @@
 #!/usr/bin/python3
 """State class"""
-from models.base_model import BaseModel
+from models.base_model import BaseModel, Relation
 
 
 class State(BaseModel):
     """represents the name of a state"""
     name = ""
+    cities = Relation("City", "state_id")
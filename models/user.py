@@ -1,6 +1,6 @@
 #!/usr/bin/python3
 """User class"""
-from models.base_model import BaseModel
+from models.base_model import BaseModel, Relation
 
 
 class User(BaseModel):
@@ -9,3 +9,4 @@ class User(BaseModel):
     password = ""
     first_name = ""
     last_name = ""
+    places = Relation("Place", "user_id")
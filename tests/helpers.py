@@ -0,0 +1,17 @@
+#!/usr/bin/python3
+
+"""Helpers shared by the unit tests."""
+
+import os
+import tempfile
+
+
+def use_temp_dir(case):
+    """Runs case (a test, or its class from setUpClass) in a new temporary
+        directory, removed with the files written there once it ends"""
+    directory = tempfile.TemporaryDirectory()
+    add_cleanup = case.addClassCleanup if isinstance(case, type) \
+        else case.addCleanup
+    add_cleanup(directory.cleanup)
+    add_cleanup(os.chdir, os.getcwd())
+    os.chdir(directory.name)
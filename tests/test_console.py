@@ -19,8 +19,14 @@ import unittest
 from models import storage
 from models.engine.file_storage import FileStorage
 from console import HBNBCommand
+from models.city import City
+from models.place import Place
+from models.review import Review
+from models.state import State
+from models.user import User
 from io import StringIO
 from unittest.mock import patch
+from tests.helpers import use_temp_dir
 
 
 class TestHBNBCommandPrompting(unittest.TestCase):
@@ -726,3 +732,179 @@ class TestHBNBCommand_destroy(unittest.TestCase):
             self.assertFalse(HBNBCommand().onecmd(command))
             self.assertNotIn(obj, storage.all())
 
+    def test_destroy_cascade(self):
+        st = State()
+        cities = [City(), City()]
+        for ct in cities:
+            ct.state_id = st.id
+        pl = Place()
+        pl.city_id = cities[0].id
+        rv = Review()
+        rv.place_id = pl.id
+        other = City()
+        with patch("sys.stdout", new=StringIO()) as output:
+            command = "destroy State {} cascade".format(st.id)
+            self.assertFalse(HBNBCommand().onecmd(command))
+            self.assertEqual(str({"State": 1, "City": 2, "Place": 1,
+                                  "Review": 1}), output.getvalue().strip())
+        for obj in (st, cities[0], cities[1], pl, rv):
+            self.assertIsNone(storage.get(type(obj), obj.id))
+        self.assertIs(other, storage.get(City, other.id))
+
+
+def use_new_storage(case):
+    """Runs case in a temporary directory, on a new empty FileStorage"""
+    use_temp_dir(case)
+    new_storage = FileStorage()
+    new_storage._FileStorage__objects = {}
+    new_storage._FileStorage__pending = {}
+    for name in ("models.storage", "console.storage"):
+        patcher = patch(name, new_storage)
+        patcher.start()
+        case.addCleanup(patcher.stop)
+
+
+class TestHBNBCommand_where(unittest.TestCase):
+    """Unittests for testing where from the HBNB command interpreter."""
+
+    def setUp(self):
+        use_new_storage(self)
+
+    def test_where_missing_class(self):
+        correct = "** class name missing **"
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd("where"))
+            self.assertEqual(correct, output.getvalue().strip())
+
+    def test_where_invalid_class(self):
+        correct = "** class doesn't exist **"
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd("where MyModel"))
+            self.assertEqual(correct, output.getvalue().strip())
+
+    def test_where_invalid_condition(self):
+        correct = "** invalid condition: name **"
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd("where Place name"))
+            self.assertEqual(correct, output.getvalue().strip())
+
+    def test_where_unknown_operator(self):
+        correct = "** unknown operator 'between' in price_by_night__between **"
+        command = "where Place price_by_night__between=1"
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd(command))
+            self.assertEqual(correct, output.getvalue().strip())
+
+    def test_where_objects(self):
+        pl = Place()
+        pl.city_id = "where-city"
+        pl.max_guest = 4
+        other = Place()
+        other.city_id = "where-city"
+        command = "where Place city_id=where-city max_guest__gte=3"
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd(command))
+            self.assertEqual(str([str(pl)]), output.getvalue().strip())
+        command = 'where Place city_id__in=x,"where-city" max_guest=4.0'
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd(command))
+            self.assertEqual(str([str(pl)]), output.getvalue().strip())
+
+    def test_where_after_update(self):
+        pl = Place()
+        pl.city_id = "update-city"
+        with patch("sys.stdout", new=StringIO()):
+            HBNBCommand().onecmd("update Place {} price_by_night 80"
+                                 .format(pl.id))
+        self.assertEqual(80, pl.price_by_night)
+        command = "where Place city_id=update-city price_by_night__lt=100"
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd(command))
+            self.assertEqual(str([str(pl)]), output.getvalue().strip())
+
+    def test_update_relationship(self):
+        correct = "** attribute can't be set **"
+        pl = Place()
+        with patch("sys.stdout", new=StringIO()) as output:
+            command = "update Place {} reviews x".format(pl.id)
+            self.assertFalse(HBNBCommand().onecmd(command))
+            self.assertEqual(correct, output.getvalue().strip())
+
+    def test_update_duplicate_email(self):
+        us = User()
+        us.email = us.id + "@update.test"
+        other = User()
+        with patch("sys.stdout", new=StringIO()) as output:
+            command = "update User {} email {}".format(other.id, us.email)
+            self.assertFalse(HBNBCommand().onecmd(command))
+            self.assertIn("is already used by User." + us.id,
+                          output.getvalue())
+        self.assertEqual("", other.email)
+
+    def test_where_amenities(self):
+        pl = Place()
+        pl.amenity_ids = ["where-wifi", "where-pool"]
+        Place().amenity_ids = ["where-wifi"]
+        command = "where Place amenity_ids__all=where-pool,where-wifi"
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd(command))
+            self.assertEqual(str([str(pl)]), output.getvalue().strip())
+
+
+class TestHBNBCommand_spatial(unittest.TestCase):
+    """Unittests for testing near and within from the HBNB command
+    interpreter."""
+
+    def setUp(self):
+        use_new_storage(self)
+
+    def test_near_missing_coordinates(self):
+        correct = "** coordinates missing **"
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd("near Place 1"))
+            self.assertEqual(correct, output.getvalue().strip())
+
+    def test_near_invalid_coordinates(self):
+        correct = "** invalid coordinates **"
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd("near Place 95 0"))
+            self.assertEqual(correct, output.getvalue().strip())
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd("within Place a 0 1 1"))
+            self.assertEqual(correct, output.getvalue().strip())
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd("within Place 0 190 10 -10"))
+            self.assertEqual(correct, output.getvalue().strip())
+
+    def test_near_and_within(self):
+        pl = Place()
+        pl.latitude = -54.8
+        pl.longitude = -68.3
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd("near Place -54 -68"))
+            self.assertEqual(str([str(pl)]), output.getvalue().strip())
+        command = "within Place -55 -69 -54 -68"
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd(command))
+            self.assertEqual(str([str(pl)]), output.getvalue().strip())
+
+
+class TestHBNBCommand_search(unittest.TestCase):
+    """Unittests for testing search from the HBNB command interpreter."""
+
+    def setUp(self):
+        use_new_storage(self)
+
+    def test_search_missing_words(self):
+        correct = "** words missing **"
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd("search Place"))
+            self.assertEqual(correct, output.getvalue().strip())
+
+    def test_search_objects(self):
+        pl = Place()
+        pl.description = "Cosy treehouse by the lake"
+        Place().description = "Cosy flat"
+        with patch("sys.stdout", new=StringIO()) as output:
+            self.assertFalse(HBNBCommand().onecmd("search Place lake COSY"))
+            self.assertEqual(str([str(pl)]), output.getvalue().strip())
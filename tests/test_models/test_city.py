@@ -6,6 +6,9 @@ import os
 import unittest
 import models
 from models.city import City
+from models.place import Place
+from models.review import Review
+from models.state import State
 from datetime import datetime
 from time import sleep
 
@@ -23,6 +26,36 @@ class TestCityClass(unittest.TestCase):
         """Test subclass relationship"""
         self.assertTrue(issubclass(City, models.base_model.BaseModel))
 
+    def test_places(self):
+        """Test the places of a city are found through their city_id"""
+        cy = City()
+        pl = Place()
+        pl.city_id = cy.id
+        Place().city_id = "other"
+        places = cy.places
+        self.assertEqual([pl], list(places))
+        self.assertIn(pl, places)
+        other = Place()
+        self.assertNotIn(other, places)
+        other.city_id = cy.id
+        self.assertEqual(2, len(places))
+        with self.assertRaises(AttributeError):
+            cy.places = []
+
+    def test_state_cities(self):
+        """Test walking from a state to the reviews of its places"""
+        st = State()
+        cy = City()
+        cy.state_id = st.id
+        pl = Place()
+        pl.city_id = cy.id
+        rv = Review()
+        rv.place_id = pl.id
+        self.assertEqual([cy], list(st.cities))
+        self.assertEqual([rv], [review for city in st.cities
+                                for place in city.places
+                                for review in place.reviews])
+
 
 class TestCityInstantiation(unittest.TestCase):
     """Test suite for City instantiation"""
@@ -103,6 +136,14 @@ class TestCityInstantiation(unittest.TestCase):
         self.assertEqual(cy.created_at, dt)
         self.assertEqual(cy.updated_at, dt)
 
+    def test_instantiation_with_relation_kwargs(self):
+        """Test a saved value named like a relationship is dropped"""
+        dt_iso = datetime.today().isoformat()
+        cy = City(id="345", created_at=dt_iso, updated_at=dt_iso,
+                  places=["old"])
+        self.assertNotIn("places", cy.__dict__)
+        self.assertEqual([], list(cy.places))
+
     def test_instantiation_with_None_kwargs(self):
         """Test instantiation with None keyword arguments"""
         with self.assertRaises(TypeError):
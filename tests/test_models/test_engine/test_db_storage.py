@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+"""Unit tests for DBStorage class."""
+
+import os
+import unittest
+import models
+from unittest.mock import patch
+from models.base_model import BaseModel
+from models.engine.db_storage import DBStorage
+from models.user import User
+from models.state import State
+from models.city import City
+from models.place import Place
+
+
+class TestDBStorage(unittest.TestCase):
+    """Test suite for the methods of the DBStorage class."""
+
+    def setUp(self):
+        """Use a DBStorage on a test database as models.storage."""
+        self.storage = DBStorage()
+        self.storage.configure(db_path="test_hbnb.db")
+        self.storage.reload()
+        patcher = patch.object(models, "storage", self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """Remove the test database."""
+        self.storage.reload()
+        try:
+            os.remove("test_hbnb.db")
+        except FileNotFoundError:
+            pass
+
+    def reopen(self):
+        """Return a new storage on the same database."""
+        storage = DBStorage()
+        storage.configure(db_path="test_hbnb.db")
+        storage.reload()
+        return storage
+
+    def test_configure_unknown_option(self):
+        """Test configure rejects options it doesn't know."""
+        with self.assertRaises(TypeError):
+            self.storage.configure(path="x.db")
+
+    def test_new_and_save(self):
+        """Test saved objects can be read back by another storage."""
+        us = User()
+        us.email = "a@b.c"
+        us.save()
+        other = self.reopen()
+        self.assertEqual("a@b.c", other.get(User, us.id).email)
+        self.assertEqual(us.to_dict(), other.get("User", us.id).to_dict())
+
+    def test_all(self):
+        """Test all with and without a class, saved or not."""
+        bm = BaseModel()
+        bm.save()
+        us = User()
+        self.assertEqual({"BaseModel." + bm.id, "User." + us.id},
+                         set(self.storage.all()))
+        self.assertEqual(["User." + us.id], list(self.storage.all(User)))
+        self.assertIs(bm, self.storage.all("BaseModel")["BaseModel." + bm.id])
+
+    def test_count(self):
+        """Test count includes unsaved changes."""
+        User().save()
+        us = User()
+        State()
+        self.assertEqual(2, self.storage.count(User))
+        self.assertEqual(3, self.storage.count())
+        self.storage.delete(us)
+        self.assertEqual(1, self.storage.count("User"))
+
+    def test_get_same_instance(self):
+        """Test get returns the instance already in use."""
+        us = User()
+        us.save()
+        self.assertIs(us, self.storage.get(User, us.id))
+        self.assertIsNone(self.storage.get(User, "nope"))
+
+    def test_update_and_delete(self):
+        """Test changes and deletions are written by save."""
+        us = User()
+        st = State()
+        self.storage.save()
+        us.email = "x@y.z"
+        self.storage.delete(st)
+        self.assertIsNone(self.storage.get(State, st.id))
+        self.storage.save()
+        other = self.reopen()
+        self.assertEqual("x@y.z", other.get(User, us.id).email)
+        self.assertIsNone(other.get(State, st.id))
+        self.assertIsNone(self.storage.get(State, st.id))
+
+    def test_batch_rollback(self):
+        """Test a batch that raises puts the saved state back."""
+        us = User()
+        us.email = "a@b.c"
+        st = State()
+        self.storage.save()
+        with self.assertRaises(ValueError):
+            with self.storage.batch():
+                us.email = "x@y.z"
+                self.storage.delete(st)
+                created = BaseModel()
+                raise ValueError("abort")
+        self.assertEqual("a@b.c", us.email)
+        self.assertIs(st, self.storage.get(State, st.id))
+        self.assertIsNone(self.storage.get(BaseModel, created.id))
+        self.assertIsNone(self.reopen().get(BaseModel, created.id))
+
+    def test_lookup(self):
+        """Test lookup finds saved and unsaved objects by attribute."""
+        saved = City()
+        saved.state_id = "s1"
+        saved.save()
+        unsaved = City()
+        unsaved.state_id = "s1"
+        City().state_id = "s2"
+        found = self.storage.lookup(City, "state_id", "s1")
+        self.assertEqual({"City." + saved.id, "City." + unsaved.id},
+                         set(found))
+        self.assertIs(saved, found["City." + saved.id])
+        with self.assertRaises(ValueError):
+            self.storage.lookup(City, "state_id') = 1 --", "s1")
+
+    def test_filter(self):
+        """Test filter runs equality, range and membership predicates."""
+        cheap = Place()
+        cheap.city_id = "c1"
+        cheap.price_by_night = 50
+        free = Place()
+        free.city_id = "c1"
+        dear = Place()
+        dear.city_id = "c2"
+        dear.price_by_night = 300
+        self.storage.save()
+        unsaved = Place()
+        unsaved.city_id = "c1"
+        unsaved.price_by_night = 80
+        found = self.storage.filter(Place, city_id="c1",
+                                    price_by_night__lt=100)
+        self.assertEqual({cheap, free, unsaved}, set(found.values()))
+        found = self.storage.filter(Place, price_by_night__gte=50,
+                                    city_id__in=["c2", "c3"])
+        self.assertEqual([dear], list(found.values()))
+        found = self.storage.filter(Place, price_by_night__ne=0)
+        self.assertEqual({cheap, dear, unsaved}, set(found.values()))
+
+    def test_unique_email(self):
+        """Test duplicate emails are rejected and get_by finds users."""
+        us = User()
+        us.email = "a@b.c"
+        us.save()
+        other = User()
+        with self.assertRaises(ValueError):
+            other.email = "a@b.c"
+        self.assertEqual("", other.email)
+        self.assertIs(us, self.storage.get_by(User, email="a@b.c"))
+        self.assertIsNone(self.storage.get_by(User, email="x@y.z"))
+
+    def test_filter_amenities(self):
+        """Test filter on the items of a list attribute."""
+        both = Place()
+        both.amenity_ids = ["wifi", "pool"]
+        both.save()
+        wifi = Place()
+        wifi.amenity_ids = ["wifi"]
+        Place()
+        self.storage.save()
+        found = self.storage.filter(Place, amenity_ids__all=["pool", "wifi"])
+        self.assertEqual([both], list(found.values()))
+        found = self.storage.filter(Place, amenity_ids__contains="wifi")
+        self.assertEqual({both, wifi}, set(found.values()))
+
+    def test_filter_contains_only_lists(self):
+        """Test contains and all look into lists only, not strings."""
+        place = Place()
+        place.name = "wifi"
+        place.save()
+        self.assertEqual({}, self.storage.filter(Place, name__contains="wifi"))
+        self.assertEqual({}, self.storage.filter(Place, name__all=["wifi"]))
+
+    def test_within_and_nearest(self):
+        """Test position queries on saved and unsaved places."""
+        paris = Place()
+        paris.latitude, paris.longitude = 48.86, 2.35
+        paris.save()
+        london = Place()
+        london.latitude, london.longitude = 51.51, -0.13
+        Place()
+        self.assertEqual({paris, london},
+                         set(self.storage.within(Place, 40, -5, 55,
+                                                 5).values()))
+        self.assertEqual([london, paris],
+                         self.storage.nearest(Place, 52, 0, 2))
+        with self.assertRaises(ValueError):
+            self.storage.within(Place, 0, 190, 10, -10)
+
+    def test_search(self):
+        """Test search finds the words in the text attributes."""
+        pl = Place()
+        pl.name = "Sunny loft"
+        pl.save()
+        Place().description = "sunny"
+        found = self.storage.search(Place, "loft sunny")
+        self.assertEqual([pl], list(found.values()))
+
+    def test_newest_and_since(self):
+        """Test time queries on saved and unsaved objects."""
+        places = []
+        for i in range(3):
+            pl = Place()
+            pl.updated_at = pl.updated_at.replace(year=2000 + i)
+            places.append(pl)
+            if i == 1:
+                self.storage.save()
+        self.assertEqual(places[:0:-1], self.storage.newest(Place, 2))
+        self.assertEqual(places[1:], self.storage.since(places[0].updated_at))
+        self.assertEqual([places[1]],
+                         self.storage.since(places[0].updated_at, Place,
+                                            until=places[1].updated_at))
+        found = self.storage.filter(Place,
+                                    updated_at__lte=places[1].updated_at)
+        self.assertEqual(set(places[:2]), set(found.values()))
+
+    def test_cascade(self):
+        """Test cascade deletes saved and unsaved dependents."""
+        st = State()
+        ct = City()
+        ct.state_id = st.id
+        self.storage.save()
+        pl = Place()
+        pl.city_id = ct.id
+        other = City()
+        self.assertEqual({"State": 1, "City": 1, "Place": 1},
+                         self.storage.cascade(st))
+        storage = self.reopen()
+        self.assertEqual(["City." + other.id], list(storage.all()))
+
+
+if __name__ == "__main__":
+    unittest.main()
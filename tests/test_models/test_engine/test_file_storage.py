@@ -3,16 +3,53 @@
 """Unit tests for FileStorage class."""
 
 import unittest
+import json
 import os
+import sys
+import zlib
 import models
+from datetime import datetime
+from io import BytesIO, StringIO
+from threading import Thread
+from time import sleep
+from unittest.mock import patch
 from models.base_model import BaseModel
-from models.engine.file_storage import FileStorage
+from models.engine import binary, compression, key_index
+from models.engine.file_storage import FileStorage, convert
+from models.engine.file_storage import iter_json_object, iter_records
+from models.engine.indexes import BitmapIndex, SortedIndex, TextIndex
+from models.engine.indexes import distance, nearest
 from models.user import User
 from models.state import State
 from models.place import Place
 from models.city import City
 from models.amenity import Amenity
 from models.review import Review
+from tests.helpers import use_temp_dir
+
+
+def run_threads(case, target, count):
+    """Runs target in count threads at once and fails case if any of them
+        raised"""
+    errors = []
+
+    def run():
+        try:
+            target()
+        except Exception as error:
+            errors.append(error)
+    threads = [Thread(target=run) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    case.assertEqual([], errors)
+
+
+def switch_often(case):
+    """Makes threads switch as often as possible until case ends"""
+    case.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+    sys.setswitchinterval(1e-6)
 
 
 class TestFileStorageInitialization(unittest.TestCase):
@@ -45,23 +82,8 @@ class TestFileStorageMethods(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        """Set up class method."""
-        try:
-            os.rename("file.json", "tmp")
-        except FileNotFoundError:
-            pass
-
-    @classmethod
-    def tearDownClass(cls):
-        """Tear down class method."""
-        try:
-            os.remove("file.json")
-        except FileNotFoundError:
-            pass
-        try:
-            os.rename("tmp", "file.json")
-        except FileNotFoundError:
-            pass
+        """Run the tests in a temporary directory."""
+        use_temp_dir(cls)
         FileStorage._FileStorage__objects = {}
 
     def test_all(self):
@@ -69,9 +91,29 @@ class TestFileStorageMethods(unittest.TestCase):
         self.assertEqual(dict, type(models.storage.all()))
 
     def test_all_with_arg(self):
-        """Test all method with argument."""
-        with self.assertRaises(TypeError):
-            models.storage.all("Oladapo")
+        """Test all method with a class or class name argument."""
+        bm = BaseModel()
+        us = User()
+        self.assertIn("User." + us.id, models.storage.all(User))
+        self.assertNotIn("BaseModel." + bm.id, models.storage.all(User))
+        self.assertIn("BaseModel." + bm.id, models.storage.all("BaseModel"))
+        self.assertEqual({}, models.storage.all("Oladapo"))
+
+    def test_count(self):
+        """Test count method with and without a class."""
+        users = models.storage.count(User)
+        total = models.storage.count()
+        User()
+        self.assertEqual(users + 1, models.storage.count("User"))
+        self.assertEqual(total + 1, models.storage.count())
+        self.assertEqual(0, models.storage.count("Oladapo"))
+
+    def test_delete(self):
+        """Test delete removes the object from all and its class."""
+        us = User()
+        models.storage.delete(us)
+        self.assertNotIn("User." + us.id, models.storage.all())
+        self.assertNotIn("User." + us.id, models.storage.all(User))
 
     def test_new(self):
         """Test if new method adds object to __objects."""
@@ -189,6 +231,1595 @@ class TestFileStorageMethods(unittest.TestCase):
         self.assertIn("Review." + rv.id, objs)
 
 
+class TestIterJsonObject(unittest.TestCase):
+    """Unit tests for the streaming JSON reader used by reload."""
+
+    def test_small_chunks(self):
+        """Test pairs are decoded across chunk boundaries."""
+        d = {"BaseModel.1": {"id": "1", "name": "a } b"},
+             "User.2": {"id": "2", "ids": [1, 22, {"x": "y"}]}}
+        text = json.dumps(d, indent=2)
+        for size in (1, 3, 64):
+            pairs = list(iter_json_object(StringIO(text), size))
+            self.assertEqual(list(d.items()), pairs)
+
+    def test_empty_object(self):
+        """Test an empty object yields nothing."""
+        self.assertEqual([], list(iter_json_object(StringIO(" {} "), 1)))
+
+    def test_invalid(self):
+        """Test truncated or malformed files raise ValueError."""
+        for text in ("", "[]", '{"a": 1', '{"a": 1,}', '{1: 2}'):
+            with self.assertRaises(ValueError):
+                list(iter_json_object(StringIO(text), 2))
+
+
+class TestFileStorageDirtyTracking(unittest.TestCase):
+    """Unit tests for the encoding cache of the FileStorage class."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run the tests in a temporary directory."""
+        use_temp_dir(cls)
+
+    def test_clean_objects_are_not_encoded(self):
+        """Test save reuses the encoding of objects that didn't change."""
+        bm = BaseModel()
+        us = User()
+        models.storage.save()
+        encoded = models.storage._FileStorage__encoded
+        self.assertIn("BaseModel." + bm.id, encoded)
+        with patch.object(BaseModel, "to_dict") as to_dict:
+            models.storage.save()
+        to_dict.assert_not_called()
+
+    def test_save_in_chunks(self):
+        """Test save writes valid JSON when flushing several chunks."""
+        storage = FileStorage()
+        storage._FileStorage__objects = {}
+        storage._FileStorage__chunk_size = 10
+        objs = [BaseModel() for i in range(5)]
+        for obj in objs:
+            storage.new(obj)
+        storage.save()
+        with open("file.json", "r") as f:
+            saved = json.load(f)
+        self.assertEqual({"BaseModel." + obj.id: obj.to_dict()
+                          for obj in objs}, saved)
+        storage._FileStorage__objects = {}
+        storage.save()
+        with open("file.json", "r") as f:
+            self.assertEqual({}, json.load(f))
+
+    def test_assignment_marks_dirty(self):
+        """Test assigning an attribute drops the cached encoding."""
+        bm = BaseModel()
+        models.storage.save()
+        bm.name = "Holberton"
+        encoded = models.storage._FileStorage__encoded
+        self.assertNotIn("BaseModel." + bm.id, encoded)
+        models.storage.save()
+        with open("file.json", "r") as f:
+            self.assertIn("Holberton", f.read())
+
+
+class TestFileStorageJournal(unittest.TestCase):
+    """Unit tests for the journal mode of the FileStorage class."""
+
+    def setUp(self):
+        """Set up a journaled storage with an empty object dictionary."""
+        use_temp_dir(self)
+        self.storage = FileStorage()
+        self.storage.configure(journal=True)
+        self.storage._FileStorage__objects = {}
+        self.storage._FileStorage__pending = {}
+
+    def test_configure_unknown_option(self):
+        """Test configure rejects options it doesn't know."""
+        with self.assertRaises(TypeError):
+            self.storage.configure(journaled=True)
+
+    def test_save_appends_to_journal(self):
+        """Test save only appends the changed objects to the journal."""
+        bm = BaseModel()
+        self.storage.new(bm)
+        self.storage.save()
+        self.assertFalse(os.path.exists("file.json"))
+        us = User()
+        self.storage.new(us)
+        self.storage.save()
+        with open("file.json.journal", "r") as f:
+            lines = f.readlines()
+        self.assertEqual(2, len(lines))
+        self.assertIn("BaseModel." + bm.id, lines[0])
+        self.assertNotIn("BaseModel." + bm.id, lines[1])
+        self.assertIn("User." + us.id, lines[1])
+
+    def test_reload_replays_journal(self):
+        """Test reload applies puts and deletes from the journal."""
+        bm = BaseModel()
+        us = User()
+        self.storage.new(bm)
+        self.storage.new(us)
+        self.storage.save()
+        bm.name = "Holberton"
+        self.storage.touch(bm)
+        self.storage.delete(us)
+        self.storage.save()
+        self.storage.reload()
+        objs = self.storage.all()
+        self.assertEqual("Holberton", objs["BaseModel." + bm.id].name)
+        self.assertNotIn("User." + us.id, objs)
+
+    def test_reload_ignores_torn_record(self):
+        """Test reload skips a partly written last journal record."""
+        bm = BaseModel()
+        self.storage.new(bm)
+        self.storage.save()
+        with open("file.json.journal", "a") as f:
+            f.write('{"put": {"User.')
+        self.storage.reload()
+        self.assertEqual(["BaseModel." + bm.id], list(self.storage.all()))
+        later = [BaseModel(), BaseModel()]
+        for obj in later:
+            self.storage.new(obj)
+            self.storage.save()
+        self.storage.reload()
+        self.assertEqual({"BaseModel." + obj.id for obj in [bm] + later},
+                         set(self.storage.all()))
+
+    def test_failed_append(self):
+        """Test an append that fails halfway is cut off the journal, so the
+            next one is read back."""
+        first, second, third = BaseModel(), BaseModel(), BaseModel()
+        self.storage.new(first)
+        self.storage.save()
+
+        def fail(storage, f):
+            f.write('{"put": {"BaseModel.')
+            f.flush()
+            raise OSError(28, "No space left on device")
+        self.storage.new(second)
+        with patch.object(FileStorage, "_FileStorage__sync", fail):
+            with self.assertRaises(OSError):
+                self.storage.save()
+        self.storage.new(third)
+        self.storage.save()
+        self.storage.reload()
+        self.assertEqual({"BaseModel." + obj.id
+                          for obj in (first, second, third)},
+                         set(self.storage.all()))
+
+    def test_reload_skips_damaged_record(self):
+        """Test reload keeps the records after a damaged journal line."""
+        bm = BaseModel()
+        us = User()
+        self.storage.new(bm)
+        self.storage.save()
+        with open("file.json.journal", "a") as f:
+            f.write('{"put": {"User.\n')
+        self.storage.new(us)
+        self.storage.save()
+        self.storage.reload()
+        self.assertEqual({"BaseModel." + bm.id, "User." + us.id},
+                         set(self.storage.all()))
+
+    def test_compaction(self):
+        """Test the journal is folded into the JSON file past its limit."""
+        self.storage.configure(journal_limit=2)
+        for i in range(3):
+            self.storage.new(BaseModel())
+            self.storage.save()
+        self.assertFalse(os.path.exists("file.json.journal"))
+        with open("file.json", "r") as f:
+            self.assertEqual(3, f.read().count("BaseModel."))
+        self.storage.reload()
+        self.assertEqual(3, len(self.storage.all()))
+
+
+class TestFileStorageSnapshot(unittest.TestCase):
+    """Unit tests for the background snapshot mode of FileStorage."""
+
+    def setUp(self):
+        """Set up a snapshotting storage with an empty object dictionary."""
+        use_temp_dir(self)
+        self.storage = FileStorage()
+        self.storage.configure(snapshot=True, snapshot_changes=3,
+                               snapshot_interval=60.0)
+        self.storage._FileStorage__objects = {}
+
+    def tearDown(self):
+        """Flush pending changes."""
+        self.storage.snapshot()
+
+    def wait_for_snapshots(self, count):
+        """Wait until the background thread has written count snapshots."""
+        for i in range(100):
+            if self.storage.snapshot_stats()["snapshots"] >= count:
+                return
+            sleep(0.02)
+        self.fail("no snapshot written")
+
+    def test_save_does_not_write(self):
+        """Test save below the thresholds leaves the file alone."""
+        self.storage.new(BaseModel())
+        self.storage.save()
+        self.assertFalse(os.path.exists("file.json"))
+        self.assertEqual(1, self.storage.snapshot_stats()["pending_changes"])
+
+    def test_change_threshold(self):
+        """Test a snapshot is written once enough changes are pending."""
+        for i in range(3):
+            self.storage.new(BaseModel())
+            self.storage.save()
+        self.wait_for_snapshots(1)
+        with open("file.json", "r") as f:
+            self.assertEqual(3, f.read().count("BaseModel."))
+        stats = self.storage.snapshot_stats()
+        self.assertEqual(0, stats["pending_changes"])
+        self.assertEqual(os.path.getsize("file.json"), stats["last_bytes"])
+
+    def test_failed_snapshot(self):
+        """Test a failed write keeps the changes pending and is retried."""
+        self.storage.configure(snapshot_interval=0.05)
+        replace = os.replace
+        calls = []
+
+        def fail_once(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise OSError(28, "No space left on device")
+            return replace(*args)
+
+        with patch("os.replace", fail_once):
+            bm = BaseModel()
+            self.storage.new(bm)
+            self.storage.save()
+            self.wait_for_snapshots(1)
+        stats = self.storage.snapshot_stats()
+        self.assertEqual(1, stats["failures"])
+        self.assertIn("No space left", stats["last_error"])
+        self.assertEqual(0, stats["pending_changes"])
+        with open("file.json", "r") as f:
+            self.assertIn("BaseModel." + bm.id, f.read())
+
+    def test_snapshots_while_changing(self):
+        """Test snapshots taken while other threads change objects."""
+        switch_often(self)
+        self.storage.configure(snapshot_interval=0.01, fsync=False)
+
+        def create_and_save():
+            for i in range(200):
+                bm = BaseModel()
+                self.storage.new(bm)
+                self.storage.touch(bm)
+                self.storage.save()
+        run_threads(self, create_and_save, 4)
+        self.storage.snapshot()
+        stats = self.storage.snapshot_stats()
+        self.assertEqual(0, stats["failures"], stats["last_error"])
+        self.assertGreater(stats["snapshots"], 1)
+        storage = FileStorage()
+        storage.reload()
+        self.assertEqual(800, len(storage.all()))
+
+    def test_interval_threshold(self):
+        """Test a snapshot is written once a change is old enough."""
+        self.storage.configure(snapshot_interval=0.05)
+        self.storage.new(BaseModel())
+        self.storage.save()
+        self.wait_for_snapshots(1)
+        self.assertTrue(os.path.exists("file.json"))
+
+    def test_explicit_snapshot(self):
+        """Test snapshot writes the file and updates the stats."""
+        bm = BaseModel()
+        self.storage.new(bm)
+        self.storage.snapshot()
+        with open("file.json", "r") as f:
+            self.assertIn("BaseModel." + bm.id, f.read())
+        stats = self.storage.snapshot_stats()
+        self.assertEqual(1, stats["snapshots"])
+        self.assertEqual(stats["last_bytes"], stats["total_bytes"])
+
+
+class TestFileStorageAtomicSave(unittest.TestCase):
+    """Unit tests for atomic saves and group commit in FileStorage."""
+
+    def setUp(self):
+        """Set up a storage with an empty object dictionary."""
+        use_temp_dir(self)
+        self.storage = FileStorage()
+        self.storage._FileStorage__objects = {}
+
+    def test_failed_save_keeps_file(self):
+        """Test a save that fails midway leaves the previous file."""
+        bm = BaseModel()
+        self.storage.new(bm)
+        self.storage.save()
+        self.storage.new(User())
+        with patch.object(FileStorage, "_FileStorage__sync",
+                          side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.storage.save()
+        with open("file.json", "r") as f:
+            self.assertEqual(["BaseModel." + bm.id], list(json.load(f)))
+
+    def test_reload_installs_ready_snapshot(self):
+        """Test reload finishes a save interrupted before the rename."""
+        bm = BaseModel()
+        with open("file.json.ready", "w") as f:
+            json.dump({"BaseModel." + bm.id: bm.to_dict()}, f)
+        with open("file.json.journal", "w") as f:
+            f.write('{"delete": "BaseModel.' + bm.id + '"}\n')
+        self.storage.reload()
+        self.assertIn("BaseModel." + bm.id, self.storage.all())
+        self.assertFalse(os.path.exists("file.json.ready"))
+        self.assertFalse(os.path.exists("file.json.journal"))
+
+    def test_group_commit(self):
+        """Test concurrent saves are coalesced into fewer writes."""
+        self.storage.configure(commit_window=0.1)
+
+        def create_and_save():
+            self.storage.new(BaseModel())
+            self.storage.save()
+        run_threads(self, create_and_save, 5)
+        self.assertLess(self.storage.snapshot_stats()["snapshots"], 5)
+        with open("file.json", "r") as f:
+            self.assertEqual(5, len(json.load(f)))
+
+    def test_group_commit_without_window(self):
+        """Test saves made while a write is under way share the next one."""
+        sync = FileStorage._FileStorage__sync
+        count = 8
+
+        def slow_sync(storage, f):
+            # hold the first write until every thread has asked to save
+            for i in range(200):
+                if self.storage._FileStorage__requested >= count:
+                    break
+                sleep(0.01)
+            sync(storage, f)
+
+        def create_and_save():
+            self.storage.new(BaseModel())
+            self.storage.save()
+        with patch.object(FileStorage, "_FileStorage__sync", slow_sync):
+            run_threads(self, create_and_save, count)
+        self.assertEqual(2, self.storage.snapshot_stats()["snapshots"])
+        with open("file.json", "r") as f:
+            self.assertEqual(count, len(json.load(f)))
+
+    def test_saves_while_changing(self):
+        """Test saves from several threads changing objects at once."""
+        switch_often(self)
+        self.storage.configure(fsync=False)
+        for journal in (False, True):
+            self.storage.configure(journal=journal)
+
+            def create_and_save():
+                for i in range(100):
+                    bm = BaseModel()
+                    self.storage.new(bm)
+                    self.storage.touch(bm)
+                    self.storage.save()
+            run_threads(self, create_and_save, 4)
+        storage = FileStorage()
+        storage.reload()
+        self.assertEqual(800, len(storage.all()))
+
+
+class TestFileStorageBatch(unittest.TestCase):
+    """Unit tests for the batch context manager of FileStorage."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run the tests in a temporary directory."""
+        use_temp_dir(cls)
+
+    def test_batch_defers_saves(self):
+        """Test saves in a batch are written once at the end."""
+        models.storage.save()
+        with models.storage.batch():
+            bm = BaseModel()
+            bm.save()
+            us = User()
+            us.save()
+            with open("file.json", "r") as f:
+                self.assertNotIn("BaseModel." + bm.id, f.read())
+        with open("file.json", "r") as f:
+            content = f.read()
+        self.assertIn("BaseModel." + bm.id, content)
+        self.assertIn("User." + us.id, content)
+
+    def test_batch_rollback(self):
+        """Test a batch that raises undoes its changes and saves nothing."""
+        kept = BaseModel()
+        kept.name = "Holberton"
+        gone = User()
+        models.storage.save()
+        with self.assertRaises(ValueError):
+            with models.storage.batch():
+                kept.name = "School"
+                kept.number = 89
+                models.storage.delete(gone)
+                created = State()
+                created.save()
+                raise ValueError("abort")
+        self.assertEqual("Holberton", kept.name)
+        self.assertFalse(hasattr(kept, "number"))
+        self.assertIs(gone, models.storage.all()["User." + gone.id])
+        self.assertIn("User." + gone.id, models.storage.all(User))
+        self.assertNotIn("State." + created.id, models.storage.all())
+        with open("file.json", "r") as f:
+            self.assertNotIn("State." + created.id, f.read())
+        models.storage.save()
+        with open("file.json", "r") as f:
+            saved = json.load(f)
+        self.assertEqual("Holberton", saved["BaseModel." + kept.id]["name"])
+
+
+class TestFileStorageLazy(unittest.TestCase):
+    """Unit tests for the lazy reload mode of FileStorage."""
+
+    def setUp(self):
+        """Save a few objects, then reload them lazily."""
+        use_temp_dir(self)
+        storage = FileStorage()
+        storage._FileStorage__objects = {}
+        self.bm = BaseModel()
+        self.us = User()
+        self.us.email = self.us.id + "@b.c"
+        storage.new(self.bm)
+        storage.new(self.us)
+        storage.save()
+        self.storage = FileStorage()
+        self.storage.configure(lazy=True)
+        self.storage.reload()
+
+    def test_reload_builds_nothing(self):
+        """Test reload keeps records without building instances."""
+        self.assertEqual({}, self.storage._FileStorage__objects)
+        self.assertEqual(2, self.storage.count())
+        self.assertEqual(1, self.storage.count(User))
+
+    def test_get_builds_one(self):
+        """Test get builds only the instance asked for."""
+        us = self.storage.get(User, self.us.id)
+        self.assertEqual(self.us.id + "@b.c", us.email)
+        self.assertIs(us, self.storage.get("User", self.us.id))
+        self.assertEqual(["User." + self.us.id],
+                         list(self.storage._FileStorage__objects))
+        self.assertIsNone(self.storage.get(User, "nope"))
+
+    def test_all_builds_everything(self):
+        """Test all returns every instance."""
+        self.assertEqual(["BaseModel." + self.bm.id],
+                         list(self.storage.all(BaseModel)))
+        self.assertEqual(2, len(self.storage.all()))
+        self.assertEqual(2, self.storage.count())
+
+    def test_save_keeps_records(self):
+        """Test save writes back records that were never built."""
+        self.storage.get(User, self.us.id).email = "x@y.z"
+        self.storage.touch(self.storage.get(User, self.us.id))
+        self.storage.save()
+        with open("file.json", "r") as f:
+            saved = json.load(f)
+        self.assertEqual(self.bm.to_dict(), saved["BaseModel." + self.bm.id])
+        self.assertEqual("x@y.z", saved["User." + self.us.id]["email"])
+
+
+class TestFileStorageShards(unittest.TestCase):
+    """Unit tests for the sharded layout of FileStorage."""
+
+    def setUp(self):
+        """Save a few objects in shards."""
+        use_temp_dir(self)
+        self.storage = FileStorage()
+        self.storage._FileStorage__objects = {}
+        self.storage.configure(shards=True, fsync=False)
+        self.objs = [State(), State(), City(), User()]
+        for obj in self.objs:
+            self.storage.new(obj)
+        self.storage.save()
+
+    def manifest(self):
+        """Return the shard name -> file name manifest of the JSON file."""
+        with open("file.json", "r") as f:
+            return json.load(f)["__shards__"]
+
+    def reopen(self, **options):
+        """Return a new storage that reloaded the files."""
+        storage = FileStorage()
+        storage.configure(**options)
+        storage.reload()
+        return storage
+
+    def test_layout(self):
+        """Test each class goes to its own file and reads back."""
+        shards = self.manifest()
+        self.assertEqual(["City", "State", "User"], sorted(shards))
+        self.assertEqual(sorted(shards.values()),
+                         sorted(os.listdir("file.json.d")))
+        with open(os.path.join("file.json.d", shards["State"]), "r") as f:
+            self.assertEqual(2, len(json.load(f)))
+        storage = self.reopen()
+        self.assertEqual({obj.id: obj.to_dict() for obj in self.objs},
+                         {obj.id: obj.to_dict()
+                          for obj in storage.all().values()})
+
+    def test_changed_shards(self):
+        """Test a save only writes the shards that changed."""
+        before = self.manifest()
+        self.objs[2].name = "Paris"
+        self.storage.touch(self.objs[2])
+        self.storage.delete(self.objs[3])
+        self.storage.save()
+        after = self.manifest()
+        self.assertEqual(before["State"], after["State"])
+        self.assertNotEqual(before["City"], after["City"])
+        self.assertNotIn("User", after)
+        self.assertEqual(sorted(after.values()),
+                         sorted(os.listdir("file.json.d")))
+        storage = self.reopen()
+        self.assertEqual("Paris", storage.get(City, self.objs[2].id).name)
+        self.assertIsNone(storage.get(User, self.objs[3].id))
+
+    def test_hashed_shards(self):
+        """Test a class larger than shard_size is split by key hash."""
+        self.storage.configure(shard_size=2)
+        users = [User() for _ in range(4)]
+        for us in users:
+            self.storage.new(us)
+        self.storage.save()
+        shards = self.manifest()
+        self.assertEqual(["City", "State"],
+                         [name for name in sorted(shards) if "of" not in name])
+        self.assertTrue(all(name.endswith("of4") for name in shards
+                            if name.startswith("User.")))
+        storage = self.reopen(lazy=True)
+        self.assertEqual(5, storage.count(User))
+        self.assertEqual(users[0].to_dict(),
+                         storage.get(User, users[0].id).to_dict())
+
+    def test_parallel_reload(self):
+        """Test the shards read by worker processes give the same objects
+            in the same order."""
+        serial = self.reopen()
+        with patch.object(FileStorage, "_FileStorage__parallel_size", 0):
+            parallel = self.reopen(shard_workers=2)
+        self.assertEqual(list(serial.all()), list(parallel.all()))
+        self.assertEqual([obj.to_dict() for obj in serial.all().values()],
+                         [obj.to_dict() for obj in parallel.all().values()])
+
+    def test_journal(self):
+        """Test the journal is replayed over the shards, and the changed
+            shards are written at the next snapshot."""
+        self.storage.configure(journal=True)
+        self.objs[0].name = "Texas"
+        self.storage.touch(self.objs[0])
+        self.storage.save()
+        storage = self.reopen(shards=True, fsync=False)
+        self.assertEqual("Texas", storage.get(State, self.objs[0].id).name)
+        before = self.manifest()
+        storage.snapshot()
+        after = self.manifest()
+        self.assertNotEqual(before["State"], after["State"])
+        self.assertEqual(before["City"], after["City"])
+        self.assertFalse(os.path.exists("file.json.journal"))
+
+    def test_unshard(self):
+        """Test turning the option off writes a single file again."""
+        self.storage.configure(shards=False)
+        self.storage.save()
+        self.assertEqual(4, len(self.reopen().all()))
+        with open("file.json", "r") as f:
+            self.assertNotIn("__shards__", json.load(f))
+        self.assertFalse(os.path.exists("file.json.d"))
+
+
+class TestBinaryFormat(unittest.TestCase):
+    """Unit tests for the binary format of models.engine.binary."""
+
+    def roundtrip(self, records, chunk_size=1 << 16):
+        """Return the (key, __dict__) of the records written and read back."""
+        f = BytesIO()
+        binary.dump(records, f)
+        f.seek(0)
+        return [(key, obj.__dict__) for key, obj in
+                binary.load(f, {"Place": Place}, chunk_size)]
+
+    def test_values(self):
+        """Test every kind of value reads back the same."""
+        values = {"id": "1", "created_at": datetime(1969, 7, 20, 20, 17),
+                  "updated_at": datetime(2017, 9, 28, 21, 3, 54, 52298),
+                  "number_rooms": -3, "price_by_night": 2 ** 70,
+                  "latitude": 48.86, "name": "Café " * 20, "city_id": "1",
+                  "amenity_ids": ["a", "b", "a"], "extra": {"x": [None]},
+                  "flags": [True, False]}
+        self.assertEqual([("Place.1", values)],
+                         self.roundtrip([("Place", values)]))
+
+    def test_tables(self):
+        """Test records share the string and field tables, across chunks."""
+        records = [("Place", {"id": str(i), "city_id": "c1"})
+                   for i in range(50)]
+        records.append(("Place", {"id": "x", "description": "new field"}))
+        found = self.roundtrip(records, chunk_size=3)
+        self.assertEqual([("Place." + values["id"], values)
+                          for _, values in records], found)
+        f = BytesIO()
+        binary.dump(records, f)
+        self.assertEqual(1, f.getvalue().count(b"c1"))
+
+    def test_errors(self):
+        """Test truncated or foreign files are rejected."""
+        f = BytesIO()
+        binary.dump([("Place", {"id": "1"})], f)
+        with self.assertRaises(ValueError):
+            list(binary.load(BytesIO(f.getvalue()[:-1]), {"Place": Place}))
+        with self.assertRaises(ValueError):
+            list(binary.load(BytesIO(b"{}"), {"Place": Place}))
+        with self.assertRaises(TypeError):
+            binary.dump([("Place", {"id": object()})], BytesIO())
+        with self.assertRaises(ValueError):
+            list(binary.walk(f.getvalue()[:-1]))
+
+    def test_walk(self):
+        """Test records are keyed first and decoded later from a buffer."""
+        f = BytesIO()
+        records = [("Place", {"name": "n" * 100, "id": str(i)})
+                   for i in range(3)]
+        binary.dump(records, f)
+        buf = f.getvalue()
+        decoder = binary.Decoder({"Place": Place})
+        spans = dict(filter(None, (decoder.decode(*frame, build=False)
+                                   for frame in binary.walk(buf))))
+        self.assertEqual(["Place.0", "Place.1", "Place.2"], list(spans))
+        key, obj = decoder.record(buf, *spans["Place.1"])
+        self.assertEqual(("Place.1", records[1][1]), (key, obj.__dict__))
+
+
+class TestFileStorageBinary(unittest.TestCase):
+    """Unit tests for the binary format option of FileStorage."""
+
+    def setUp(self):
+        """Save a few objects in the binary format."""
+        use_temp_dir(self)
+        self.storage = FileStorage()
+        self.storage._FileStorage__objects = {}
+        self.storage.configure(format="binary", fsync=False)
+        st = State()
+        st.name = "California"
+        ct = City()
+        ct.state_id = st.id
+        pl = Place()
+        pl.amenity_ids = ["a", "b"]
+        pl.latitude = 37.77
+        self.objs = [st, ct, pl]
+        for obj in self.objs:
+            self.storage.new(obj)
+        self.storage.save()
+
+    def check(self, storage):
+        """Assert storage holds the saved objects."""
+        self.assertEqual({obj.id: str(obj) for obj in self.objs},
+                         {obj.id: str(obj) for obj in storage.all().values()})
+
+    def test_reload(self):
+        """Test the file is binary and reads back the same objects."""
+        with open("file.json", "rb") as f:
+            self.assertEqual(binary.MAGIC, f.read(len(binary.MAGIC)))
+        storage = FileStorage()
+        storage.configure(lazy=True)
+        storage.reload()
+        self.check(storage)
+
+    def test_convert(self):
+        """Test converting to JSON and back keeps the objects."""
+        convert("file.json", "file.txt", "json")
+        with open("file.txt", "r") as f:
+            saved = json.load(f)
+        self.assertEqual({"State." + self.objs[0].id: self.objs[0].to_dict(),
+                          "City." + self.objs[1].id: self.objs[1].to_dict(),
+                          "Place." + self.objs[2].id: self.objs[2].to_dict()},
+                         saved)
+        convert("file.txt", "file.bin")
+        with open("file.json", "rb") as a, open("file.bin", "rb") as b:
+            self.assertEqual(a.read(), b.read())
+        with self.assertRaises(ValueError):
+            convert("file.txt", "file.bin", "xml")
+
+    def test_shards(self):
+        """Test shards are written in the binary format too."""
+        self.storage.configure(shards=True)
+        self.storage.save()
+        self.assertTrue(all(name.endswith(".bin")
+                            for name in os.listdir("file.json.d")))
+        storage = FileStorage()
+        storage.reload()
+        self.check(storage)
+
+
+class TestFileStorageCompression(unittest.TestCase):
+    """Unit tests for the compression of the FileStorage files."""
+
+    def setUp(self):
+        """Set up a storage holding a few objects."""
+        use_temp_dir(self)
+        self.storage = FileStorage()
+        self.storage._FileStorage__objects = {}
+        self.storage.configure(fsync=False)
+        self.objs = [State(), City(), Place()]
+        self.objs[1].name = "Paris " * 50
+        for obj in self.objs:
+            self.storage.new(obj)
+
+    def codec(self, path):
+        """Return the codec the header of the file path shows."""
+        with open(path, "rb") as f:
+            return compression.detect(f.read(6))
+
+    def check(self, storage):
+        """Assert storage holds the saved objects."""
+        self.assertEqual({obj.id: str(obj) for obj in self.objs},
+                         {obj.id: str(obj) for obj in storage.all().values()})
+
+    def test_codecs(self):
+        """Test every codec, in every format and layout, reads back."""
+        for codec in compression.codecs:
+            for options in ({}, {"format": "binary"}, {"shards": True}):
+                with self.subTest(codec=codec, **options):
+                    self.storage.configure(compression=codec, **options)
+                    self.storage.snapshot()
+                    self.assertEqual(codec, self.codec("file.json"))
+                    storage = FileStorage()
+                    storage.reload()
+                    self.check(storage)
+                    self.storage.configure(format="json", shards=False)
+        with self.assertRaises(ValueError):
+            self.storage.configure(compression="zip")
+
+    def test_extension(self):
+        """Test the extension of the file path picks the codec."""
+        with patch.object(FileStorage, "_FileStorage__file_path",
+                          "file.json.gz"):
+            self.storage.save()
+            self.assertEqual("gzip", self.codec("file.json.gz"))
+            storage = FileStorage()
+            storage.reload()
+            self.check(storage)
+
+    def test_convert(self):
+        """Test convert compresses, and reads compressed files."""
+        self.storage.configure(compression="lzma")
+        self.storage.save()
+        convert("file.json", "file.bin", "binary", "zlib")
+        self.assertEqual("zlib", self.codec("file.bin"))
+        with open("file.bin", "rb") as f:
+            self.assertEqual(3, len(list(iter_records(f, 1 << 16))))
+
+    def test_zlib_file(self):
+        """Test small reads, seek(0) and truncated zlib streams."""
+        data = bytes(range(256)) * 100
+        packed = zlib.compress(data)
+        f = compression.reader(BytesIO(packed))
+        self.assertEqual(data[:10], f.read(10))
+        self.assertEqual(data[10:], f.read())
+        f.seek(0)
+        self.assertEqual(data, f.read())
+        with self.assertRaises(EOFError):
+            compression.reader(BytesIO(packed[:-4])).read()
+        self.assertIsNone(compression.detect(b'{"Sta'))
+        self.assertIsNone(compression.detect(binary.MAGIC))
+
+
+class TestFileStorageMmap(unittest.TestCase):
+    """Unit tests for the mmap option of FileStorage."""
+
+    def setUp(self):
+        """Save a few objects, without the journal."""
+        use_temp_dir(self)
+        self.storage = FileStorage()
+        self.storage._FileStorage__objects = {}
+        self.storage.configure(fsync=False)
+        self.objs = [State(), City(), Place()]
+        self.objs[0].name = "California"
+        self.objs[2].amenity_ids = ["a", "b"]
+        for obj in self.objs:
+            self.storage.new(obj)
+        self.storage.save()
+
+    def reopen(self, **options):
+        """Return a new storage reloaded through a memory map."""
+        storage = FileStorage()
+        storage.configure(mmap=True, **options)
+        storage.reload()
+        return storage
+
+    def check(self, storage):
+        """Assert storage holds the saved objects."""
+        self.assertEqual({obj.id: str(obj) for obj in self.objs},
+                         {obj.id: str(obj) for obj in storage.all().values()})
+
+    def test_reload(self):
+        """Test both formats read back through the map, lazily or not."""
+        for options in ({}, {"lazy": True}, {"format": "binary"},
+                        {"format": "binary", "lazy": True}):
+            with self.subTest(**options):
+                self.storage.configure(**options)
+                self.storage.snapshot()
+                storage = self.reopen(**options)
+                spans = storage._FileStorage__spans
+                self.assertEqual(3 if options.get("lazy") else 0, len(spans))
+                self.check(storage)
+                self.assertEqual({}, storage._FileStorage__spans)
+                self.storage.configure(format="json", lazy=False)
+
+    def test_lazy_get(self):
+        """Test a record is decoded from its span when asked for."""
+        storage = self.reopen(lazy=True)
+        st = storage.get(State, self.objs[0].id)
+        self.assertEqual("California", st.name)
+        self.assertEqual(2, len(storage._FileStorage__spans))
+        start, end = storage._FileStorage__spans["Place." + self.objs[2].id]
+        buf = storage._FileStorage__mapped[0]
+        self.assertEqual(self.objs[2].to_dict(), json.loads(buf[start:end]))
+
+    def test_lazy_save_unlocked(self):
+        """Test a save reads the records left in the map once the lock is
+            released."""
+        storage = self.reopen(lazy=True)
+        lock = storage.lock()
+        read = FileStorage._FileStorage__mapped_entry
+        held = []
+
+        def spy(*args):
+            held.append(lock._is_owned())
+            return read(*args)
+        with patch.object(FileStorage, "_FileStorage__mapped_entry",
+                          staticmethod(spy)):
+            storage.save()
+        self.assertEqual([False] * 3, held)
+        self.check(self.reopen())
+
+    def test_lazy_save(self):
+        """Test records left in the map are written back unchanged."""
+        with open("file.json", "r") as f:
+            before = json.load(f)
+        for options in ({}, {"format": "binary"}):
+            with self.subTest(**options):
+                self.storage.configure(**options)
+                self.storage.snapshot()
+                storage = self.reopen(lazy=True)
+                st = storage.get(State, self.objs[0].id)
+                st.name = "Nevada"
+                storage.touch(st)
+                storage.configure(format="json")
+                storage.save()
+                with open("file.json", "r") as f:
+                    after = json.load(f)
+                self.assertEqual("Nevada",
+                                 after["State." + self.objs[0].id]["name"])
+                after["State." + self.objs[0].id]["name"] = "California"
+                self.assertEqual(before, after)
+
+    def test_journal(self):
+        """Test journaled changes override the mapped records."""
+        self.storage.configure(journal=True)
+        self.objs[0].name = "Oregon"
+        self.storage.touch(self.objs[0])
+        self.storage.delete(self.objs[1])
+        self.storage.save()
+        storage = self.reopen(lazy=True)
+        self.assertEqual(["Place." + self.objs[2].id],
+                         list(storage._FileStorage__spans))
+        self.assertEqual("Oregon", storage.get(State, self.objs[0].id).name)
+        self.assertIsNone(storage.get(City, self.objs[1].id))
+
+    def test_unmapped(self):
+        """Test compressed and non-ASCII files are read without a map."""
+        self.storage.configure(compression="gzip")
+        self.storage.snapshot()
+        storage = self.reopen(lazy=True)
+        self.assertIsNone(storage._FileStorage__mapped)
+        self.check(storage)
+        self.storage.configure(compression="")
+        self.objs[0].name = "Québec"
+        self.storage.touch(self.objs[0])
+        self.storage.snapshot()
+        with open("file.json", "r") as f:
+            text = f.read().replace("\\u00e9", "\u00e9")
+        with open("file.json", "w", encoding="utf-8") as f:
+            f.write(text)
+        storage = self.reopen(lazy=True)
+        self.assertIsNone(storage._FileStorage__mapped)
+        self.check(storage)
+        self.check(self.reopen())
+
+    def test_spans(self):
+        """Test iter_json_object gives the positions of the values."""
+        text = json.dumps({"a": {"b": [1, 2]}, "c": "d" * 10, "e": None})
+        for chunk_size in (1, 5, 1 << 16):
+            spans = dict(iter_json_object(StringIO(text), chunk_size,
+                                          spans=True))
+            self.assertEqual({"a": {"b": [1, 2]}, "c": "d" * 10, "e": None},
+                             {key: json.loads(text[start:end])
+                              for key, (start, end) in spans.items()})
+
+
+class TestFileStorageKeyIndex(unittest.TestCase):
+    """Unit tests for the key_index option of FileStorage."""
+
+    def setUp(self):
+        """Save a few objects with their key index."""
+        use_temp_dir(self)
+        self.storage = FileStorage()
+        self.storage._FileStorage__objects = {}
+        self.storage.configure(key_index=True, fsync=False)
+        self.objs = [State(), City(), Place()]
+        self.objs[0].name = "Île-de-France"
+        for obj in self.objs:
+            self.storage.new(obj)
+        self.storage.save()
+
+    def reopen(self, **options):
+        """Return a new storage reloaded with the key index."""
+        storage = FileStorage()
+        storage.configure(key_index=True, fsync=False, **options)
+        storage.reload()
+        return storage
+
+    def test_write(self):
+        """Test the index locates the value of every record."""
+        stat = os.stat("file.json")
+        keys = key_index.load("file.json.keys",
+                              [stat.st_size, stat.st_mtime_ns])
+        self.assertEqual(3, len(keys))
+        with open("file.json", "rb") as f:
+            data = f.read()
+        for obj in self.objs:
+            [(start, end)] = keys.find(obj.__class__.__name__ + "." + obj.id)
+            self.assertEqual(obj.to_dict(), json.loads(data[start:end]))
+        self.assertEqual([], keys.find("State.nope"))
+        self.assertIsNone(key_index.load("file.json.keys", [0, 0]))
+
+    def test_get(self):
+        """Test get() reads single records until more is needed."""
+        storage = self.reopen()
+        self.assertEqual({}, storage._FileStorage__objects)
+        st = storage.get(State, self.objs[0].id)
+        self.assertEqual(str(self.objs[0]), str(st))
+        self.assertIs(st, storage.get("State", self.objs[0].id))
+        self.assertIsNone(storage.get(State, "nope"))
+        self.assertEqual(1, len(storage._FileStorage__objects))
+        self.assertEqual(3, len(storage.all()))
+        self.assertIs(st, storage.all()["State." + self.objs[0].id])
+        self.assertIsNone(storage._FileStorage__deferred)
+
+    def test_update_journal(self):
+        """Test a change of a record got alone goes to the journal."""
+        storage = self.reopen(journal=True)
+        pl = storage.get(Place, self.objs[2].id)
+        pl.name = "Loft"
+        storage.touch(pl)
+        storage.delete(storage.get(City, self.objs[1].id))
+        storage.save()
+        self.assertTrue(os.path.exists("file.json.journal"))
+        storage = self.reopen()
+        self.assertEqual("Loft", storage.get(Place, self.objs[2].id).name)
+        self.assertIsNone(storage.get(City, self.objs[1].id))
+        self.assertEqual(2, storage.count())
+
+    def test_update_snapshot(self):
+        """Test a full save keeps the changes made before the file is read."""
+        storage = self.reopen()
+        pl = storage.get(Place, self.objs[2].id)
+        pl.name = "Loft"
+        storage.touch(pl)
+        storage.save()
+        storage = self.reopen()
+        self.assertEqual("Loft", storage.get(Place, self.objs[2].id).name)
+        self.assertIsNotNone(storage._FileStorage__deferred)
+        self.assertEqual(3, len(storage.all()))
+
+    def test_stale(self):
+        """Test an index of another file, or none, means a full reload."""
+        with open("file.json", "a") as f:
+            f.write(" ")
+        storage = self.reopen()
+        self.assertIsNone(storage._FileStorage__deferred)
+        self.assertEqual(3, len(storage._FileStorage__objects))
+        os.remove("file.json.keys")
+        for options in ({"compression": "gzip"}, {"format": "binary"}):
+            with self.subTest(**options):
+                self.storage.configure(**options)
+                self.storage.snapshot()
+                self.assertFalse(os.path.exists("file.json.keys"))
+                self.storage.configure(compression="", format="json")
+
+    def test_collision(self):
+        """Test keys sharing a digest are told apart by their records."""
+        with patch.object(key_index, "digest", lambda key: b"\0" * 8):
+            self.storage.snapshot()
+            storage = self.reopen()
+            for obj in self.objs:
+                self.assertEqual(str(obj), str(storage.get(
+                    obj.__class__.__name__, obj.id)))
+
+
+class TestFileStorageIndexes(unittest.TestCase):
+    """Unit tests for the foreign key indexes of FileStorage."""
+
+    def setUp(self):
+        """Run the test in a temporary directory."""
+        use_temp_dir(self)
+
+    def test_lookup_new(self):
+        """Test new objects are found by their foreign keys."""
+        st = State()
+        cy = City()
+        cy.state_id = st.id
+        other = City()
+        self.assertEqual({"City." + cy.id: cy},
+                         models.storage.lookup(City, "state_id", st.id))
+        self.assertNotIn("City." + other.id,
+                         models.storage.lookup("City", "state_id", st.id))
+
+    def test_lookup_update(self):
+        """Test changing a foreign key moves the object in the index."""
+        pl = Place()
+        pl.city_id = "1"
+        setattr(pl, "city_id", "2")
+        self.assertEqual({}, models.storage.lookup(Place, "city_id", "1"))
+        self.assertIn("Place." + pl.id,
+                      models.storage.lookup(Place, "city_id", "2"))
+
+    def test_lookup_delete(self):
+        """Test deleted objects leave the index."""
+        rv = Review()
+        rv.place_id = "p1"
+        models.storage.delete(rv)
+        self.assertEqual({}, models.storage.lookup(Review, "place_id", "p1"))
+
+    def test_lookup_reload(self):
+        """Test the indexes are rebuilt by reload."""
+        rv = Review()
+        rv.user_id = "u1"
+        models.storage.save()
+        models.storage.reload()
+        found = models.storage.lookup(Review, "user_id", "u1")
+        self.assertEqual(["Review." + rv.id], list(found))
+        self.assertIsNot(rv, found["Review." + rv.id])
+
+    def test_lookup_without_index(self):
+        """Test attributes without an index are scanned."""
+        us = User()
+        us.first_name = "Betty"
+        self.assertIn("User." + us.id,
+                      models.storage.lookup(User, "first_name", "Betty"))
+
+    def test_cascade(self):
+        """Test cascade deletes the dependents once, in one save."""
+        us = User()
+        pl = Place()
+        pl.user_id = us.id
+        reviews = [Review(), Review()]
+        for rv in reviews:
+            rv.place_id = pl.id
+            rv.user_id = us.id
+        with patch.object(FileStorage, "save") as save:
+            counts = models.storage.cascade(us)
+        save.assert_called_once()
+        self.assertEqual({"User": 1, "Place": 1, "Review": 2}, counts)
+        for obj in [us, pl] + reviews:
+            self.assertNotIn(obj, models.storage.all().values())
+        self.assertEqual({}, models.storage.cascade(us))
+
+
+class TestFileStorageUnique(unittest.TestCase):
+    """Unit tests for the unique email index and get_by."""
+
+    def setUp(self):
+        """Set up a storage holding two users."""
+        use_temp_dir(self)
+        self.storage = FileStorage()
+        self.storage._FileStorage__objects = {}
+        self.users = []
+        for email in ("a@b.c", ""):
+            us = User(id=email or "none", email=email,
+                      created_at="2017-09-28T21:03:54.052298",
+                      updated_at="2017-09-28T21:03:54.052298")
+            self.storage.new(us)
+            self.users.append(us)
+
+    def test_get_by(self):
+        """Test get_by finds a user by email."""
+        self.assertIs(self.users[0], self.storage.get_by(User, email="a@b.c"))
+        self.assertIsNone(self.storage.get_by("User", email="x@y.z"))
+
+    def test_new_duplicate(self):
+        """Test new rejects a second user with the same email."""
+        us = User(id="2", email="a@b.c", created_at="2017-09-28T21:03:54.0",
+                  updated_at="2017-09-28T21:03:54.0")
+        with self.assertRaises(ValueError):
+            self.storage.new(us)
+        self.assertIsNone(self.storage.get(User, "2"))
+        self.storage.new(self.users[0])
+        us.email = ""
+        self.storage.new(us)
+        self.assertEqual(2, len(self.storage.lookup(User, "email", "")))
+
+    def test_touch_duplicate(self):
+        """Test a change to a used email is undone and rejected."""
+        us = self.users[1]
+        us.email = "a@b.c"
+        with self.assertRaises(ValueError):
+            self.storage.touch(us, "email", ("",))
+        self.assertEqual("", us.email)
+        self.assertIs(self.users[0], self.storage.get_by(User, email="a@b.c"))
+        self.users[0].email = "new@b.c"
+        self.storage.touch(self.users[0], "email", ("a@b.c",))
+        us.email = "a@b.c"
+        self.storage.touch(us, "email", ("",))
+        self.assertIs(us, self.storage.get_by(User, email="a@b.c"))
+
+    def test_swap_rollback(self):
+        """Test a batch that swapped emails can be rolled back."""
+        us = self.users[1]
+        with self.assertRaises(RuntimeError):
+            with self.storage.batch():
+                self.users[0].email = "tmp"
+                self.storage.touch(self.users[0], "email", ("a@b.c",))
+                us.email = "a@b.c"
+                self.storage.touch(us, "email", ("",))
+                raise RuntimeError("abort")
+        self.assertIs(self.users[0], self.storage.get_by(User, email="a@b.c"))
+        self.assertEqual("", us.email)
+
+
+class TestFileStorageTimeline(unittest.TestCase):
+    """Unit tests for the newest and since methods."""
+
+    def setUp(self):
+        """Set up a storage holding objects updated a minute apart."""
+        use_temp_dir(self)
+        self.storage = FileStorage()
+        self.storage._FileStorage__objects = {}
+        self.objs = []
+        for i, cls in enumerate([Place, User, Place, State, Place]):
+            date = "2017-09-28T21:0{}:00.0".format(i)
+            obj = cls(id=str(i), created_at=date, updated_at=date)
+            self.storage.new(obj)
+            self.objs.append(obj)
+
+    def test_newest(self):
+        """Test newest returns the latest objects first."""
+        self.assertEqual(self.objs[:1:-1], self.storage.newest(count=3))
+        self.assertEqual([self.objs[4], self.objs[2]],
+                         self.storage.newest(Place, 2, "created_at"))
+        self.assertEqual([], self.storage.newest("Review"))
+
+    def test_since(self):
+        """Test since returns the objects changed in the period, oldest
+            first."""
+        start = self.objs[1].updated_at
+        self.assertEqual(self.objs[2:], self.storage.since(start))
+        self.assertEqual([self.objs[2]],
+                         self.storage.since(start, Place,
+                                            until=self.objs[3].updated_at))
+        self.assertEqual([], self.storage.since(self.objs[4].updated_at))
+
+    def test_touch(self):
+        """Test an object updated again moves to the front."""
+        obj = self.objs[0]
+        previous = obj.updated_at
+        obj.updated_at = self.objs[4].updated_at.replace(hour=22)
+        self.storage.touch(obj, "updated_at", (previous,))
+        self.assertEqual([obj, self.objs[4]], self.storage.newest(Place, 2))
+        self.assertEqual([obj], self.storage.since(self.objs[4].updated_at))
+
+    def test_filter(self):
+        """Test filter answers ranges on the dates through the index."""
+        start = self.objs[1].created_at
+        found = self.storage.filter(Place, created_at__gt=start)
+        self.assertEqual({"Place.2", "Place.4"}, set(found))
+
+    def test_index(self):
+        """Test a datetime index leaves other values out."""
+        index = SortedIndex("Place", "updated_at", kinds=(datetime,))
+        pl = Place(id="a", created_at="2017-09-28T21:00:00.0",
+                   updated_at="2017-09-28T21:00:00.0")
+        pl.updated_at = "nope"
+        index.add("a", pl)
+        index.add("b", self.objs[0])
+        self.assertEqual([(self.objs[0].updated_at, "b", self.objs[0])],
+                         index.ordered())
+        self.assertIsNone(index.estimate([("eq", "nope")]))
+
+
+class TestFileStorageFilter(unittest.TestCase):
+    """Unit tests for the filter method of FileStorage."""
+
+    def setUp(self):
+        """Set up a storage holding a few places."""
+        use_temp_dir(self)
+        self.storage = FileStorage()
+        self.storage._FileStorage__objects = {}
+        self.places = []
+        for i in range(4):
+            pl = Place(id=str(i), created_at="2017-09-28T21:03:54.052298",
+                       updated_at="2017-09-28T21:03:54.052298",
+                       city_id="c{}".format(i % 2), price_by_night=i * 50)
+            self.storage.new(pl)
+            self.places.append(pl)
+        self.storage.new(User())
+
+    def ids(self, objs):
+        """Return the sorted ids of a dictionary of objects."""
+        return sorted(obj.id for obj in objs.values())
+
+    def test_equality(self):
+        """Test equality predicates, with and without __eq."""
+        self.assertEqual(["0", "2"],
+                         self.ids(self.storage.filter(Place, city_id="c0")))
+        self.assertEqual(["1"], self.ids(self.storage.filter(
+            "Place", city_id__eq="c1", price_by_night=50)))
+
+    def test_range(self):
+        """Test range predicates."""
+        found = self.storage.filter(Place, price_by_night__gte=50,
+                                    price_by_night__lt=150)
+        self.assertEqual(["1", "2"], self.ids(found))
+        found = self.storage.filter(Place, price_by_night__ne=0,
+                                    city_id="c1", price_by_night__lte=100)
+        self.assertEqual(["1"], self.ids(found))
+
+    def test_membership(self):
+        """Test membership predicates."""
+        found = self.storage.filter(Place, price_by_night__in=[0, 150])
+        self.assertEqual(["0", "3"], self.ids(found))
+        found = self.storage.filter(Place, city_id__in=("c1", "c9"))
+        self.assertEqual(["1", "3"], self.ids(found))
+        with self.assertRaises(ValueError):
+            self.storage.filter(Place, city_id__in="c1")
+
+    def test_uses_index(self):
+        """Test an indexed condition only checks the objects it returns."""
+        with patch("models.engine.query.matches",
+                   return_value=True) as matches:
+            self.storage.filter(Place, city_id="c0", price_by_night__gt=0)
+        self.assertEqual(2, matches.call_count)
+
+    def test_uncomparable(self):
+        """Test values of another type don't match."""
+        self.assertEqual({}, self.storage.filter(Place,
+                                                 price_by_night__gt="a"))
+
+    def test_unknown_operator(self):
+        """Test an unknown operator suffix is an error, not an equality."""
+        with self.assertRaises(ValueError):
+            self.storage.filter(Place, price_by_night__between=1)
+
+    def test_amenities(self):
+        """Test filtering places on the amenities they all have."""
+        self.places[1].amenity_ids = ["wifi", "pool"]
+        self.storage.touch(self.places[1], "amenity_ids")
+        self.places[3].amenity_ids = ["wifi"]
+        self.storage.touch(self.places[3], "amenity_ids")
+        found = self.storage.filter(Place, amenity_ids__all=["pool", "wifi"])
+        self.assertEqual(["1"], self.ids(found))
+        found = self.storage.filter(Place, amenity_ids__contains="wifi",
+                                    price_by_night__gt=50)
+        self.assertEqual(["3"], self.ids(found))
+        with self.assertRaises(ValueError):
+            self.storage.filter(Place, amenity_ids__all="wifi")
+
+    def test_contains_only_lists(self):
+        """Test contains and all look into lists only, not strings."""
+        self.places[1].name = "wifi lounge"
+        self.storage.touch(self.places[1], "name")
+        self.assertEqual({}, self.storage.filter(Place, name__contains="wifi"))
+        self.assertEqual({}, self.storage.filter(Place, name__all=["wifi"]))
+
+    def test_range_uses_index(self):
+        """Test range conditions on a numeric attribute use its index."""
+        with patch("models.engine.query.matches",
+                   return_value=True) as matches:
+            self.storage.filter(Place, price_by_night__gt=0,
+                                price_by_night__lte=100)
+        self.assertEqual(2, matches.call_count)
+
+    def test_range_update(self):
+        """Test the range index follows changes and deletions."""
+        self.places[0].price_by_night = 120
+        self.storage.touch(self.places[0], "price_by_night")
+        self.storage.delete(self.places[2])
+        found = self.storage.filter(Place, price_by_night__gte=50,
+                                    price_by_night__lt=150)
+        self.assertEqual(["0", "1"], self.ids(found))
+
+
+class TestSortedIndex(unittest.TestCase):
+    """Unit tests for the SortedIndex class."""
+
+    def setUp(self):
+        """Set up an index on places with repeated prices."""
+        self.index = SortedIndex("Place", "price_by_night")
+        for i, price in enumerate([10, 20, 20, 20, 30, "x", 25.5]):
+            self.index.add(str(i), Place(id=str(i), price_by_night=price))
+
+    def test_bounds(self):
+        """Test inclusive and exclusive bounds around repeated values."""
+        self.assertEqual(3, self.index.estimate([("eq", 20)]))
+        self.assertEqual({"1", "2", "3"}, set(self.index.lookup(20)))
+        self.assertEqual({"6", "4"},
+                         set(self.index.search([("gt", 20)])))
+        self.assertEqual(4, self.index.estimate([("lte", 20)]))
+        self.assertEqual(1, self.index.estimate([("lt", 20)]))
+        self.assertEqual(0, self.index.estimate([("gt", 25), ("lt", 25)]))
+
+    def test_unanswerable(self):
+        """Test conditions the index can't answer are left to the scan."""
+        self.assertIsNone(self.index.estimate([("ne", 20)]))
+        self.assertIsNone(self.index.estimate([("eq", "x")]))
+        self.assertEqual({}, self.index.lookup("x"))
+
+    def test_remove(self):
+        """Test removing one of several objects with the same value."""
+        self.index.remove("2")
+        self.index.remove("5")
+        self.assertEqual({"1", "3"}, set(self.index.lookup(20)))
+
+
+class TestBitmapIndex(unittest.TestCase):
+    """Unit tests for the BitmapIndex class."""
+
+    def setUp(self):
+        """Set up an index on places with a few amenities."""
+        self.index = BitmapIndex("Place", "amenity_ids")
+        self.places = {}
+        for i, ids in enumerate([["a", "b", "c"], ["a", "c"], ["b"], [],
+                                 "a"]):
+            pl = Place(id=str(i), amenity_ids=ids)
+            self.index.add(str(i), pl)
+            self.places[str(i)] = pl
+
+    def test_all(self):
+        """Test places holding all the amenities are found."""
+        self.assertEqual({"0", "1"}, set(self.index.search(
+            [("all", ["a", "c"])])))
+        self.assertEqual(1, self.index.estimate([("all", ["a", "c"]),
+                                                 ("contains", "b")]))
+        self.assertEqual({"0", "2"}, set(self.index.lookup("b")))
+        self.assertEqual(0, self.index.estimate([("contains", "z")]))
+        self.assertIsNone(self.index.estimate([("eq", [])]))
+
+    def test_change_and_remove(self):
+        """Test the bitmaps follow changed lists and removed places."""
+        self.places["2"].amenity_ids = ["c"]
+        self.index.add("2", self.places["2"])
+        self.index.remove("0")
+        self.assertEqual({"1", "2"}, set(self.index.lookup("c")))
+        self.assertEqual({}, self.index.lookup("b"))
+        self.index.add("5", Place(id="5", amenity_ids=["b", "c"]))
+        self.assertEqual({"5"}, set(self.index.search([("all", "bc")])))
+
+
+class TestFileStorageSpatial(unittest.TestCase):
+    """Unit tests for the within and nearest methods of FileStorage."""
+
+    def setUp(self):
+        """Set up a storage holding places around the world."""
+        use_temp_dir(self)
+        self.storage = FileStorage()
+        self.storage._FileStorage__objects = {}
+        self.points = {"paris": (48.86, 2.35), "london": (51.51, -0.13),
+                       "fiji": (-17.7, 178.1), "samoa": (-13.8, -172.1),
+                       "pole": (89.9, 10.0), "pole2": (89.9, -170.0)}
+        self.places = {}
+        for name, (lat, lon) in self.points.items():
+            pl = Place(id=name, latitude=lat, longitude=lon)
+            self.storage.new(pl)
+            self.places[name] = pl
+        self.storage.new(Place(id="nowhere", latitude="x"))
+
+    def test_within(self):
+        """Test boxes, including one crossing the antimeridian."""
+        self.assertEqual({"Place.paris", "Place.london"},
+                         set(self.storage.within(Place, 40, -5, 55, 5)))
+        self.assertEqual({"Place.fiji", "Place.samoa"},
+                         set(self.storage.within("Place", -20, 170, 0, -170)))
+        self.assertEqual({}, self.storage.within(Place, 0, 0, 1, 1))
+        for box in ((0, 190, 10, -10), (0, 10, 10, -190), (-91, 0, 0, 1)):
+            with self.assertRaises(ValueError):
+                self.storage.within(Place, *box)
+
+    def test_nearest(self):
+        """Test nearest orders by great-circle distance."""
+        found = self.storage.nearest(Place, 50, 0, 2)
+        self.assertEqual(["london", "paris"], [pl.id for pl in found])
+        found = self.storage.nearest(Place, -15, 179.9)
+        self.assertEqual(["fiji"], [pl.id for pl in found])
+        found = self.storage.nearest(Place, 89.9, 100, 2)
+        self.assertEqual({"pole", "pole2"}, {pl.id for pl in found})
+        self.assertEqual(6, len(self.storage.nearest(Place, 0, 0, 10)))
+        with self.assertRaises(ValueError):
+            self.storage.nearest(Place, 91, 0)
+
+    def test_move_and_delete(self):
+        """Test the index follows moved and deleted places."""
+        self.places["london"].latitude = -33.9
+        self.places["london"].longitude = 18.4
+        self.storage.touch(self.places["london"], "latitude")
+        self.storage.delete(self.places["paris"])
+        self.assertEqual({}, self.storage.within(Place, 40, -5, 55, 5))
+        found = self.storage.nearest(Place, -30, 20)
+        self.assertEqual([self.places["london"]], found)
+
+    def test_matches_scan(self):
+        """Test the index finds what scanning every place finds."""
+        objs = self.storage.all(Place)
+        for lat, lon in [(0, 0), (-89, 179), (45, -179.5), (10, 90)]:
+            self.assertEqual(
+                [f[1] for f in nearest(objs, lat, lon, 4)],
+                ["Place." + pl.id
+                 for pl in self.storage.nearest(Place, lat, lon, 4)])
+        self.assertAlmostEqual(343.5, distance(48.86, 2.35, 51.51, -0.13),
+                               places=0)
+
+
+class TestFileStorageText(unittest.TestCase):
+    """Unit tests for the search method and the saved text indexes."""
+
+    dates = {"created_at": "2017-09-28T21:03:54.052298",
+             "updated_at": "2017-09-28T21:03:54.052298"}
+
+    def setUp(self):
+        """Set up a storage holding a few places and reviews."""
+        use_temp_dir(self)
+        self.storage = FileStorage()
+        self.storage._FileStorage__objects = {}
+        self.storage._FileStorage__pending = {}
+        self.storage.new(Place(**self.dates, id="1", name="Sunny loft",
+                               description="A quiet loft near the park"))
+        self.storage.new(Place(**self.dates, id="2", name="Park view",
+                               description="Noisy but sunny"))
+        self.storage.new(Review(**self.dates, id="3",
+                                text="Quiet, sunny and clean!"))
+        for cls in (Place, Review):  # only built indexes are saved
+            self.storage.search(cls, "")
+
+    def test_search(self):
+        """Test every word must be in one of the indexed attributes."""
+        self.assertEqual(["Place.1", "Place.2"],
+                         sorted(self.storage.search(Place, "SUNNY park")))
+        self.assertEqual(["Place.1"], list(self.storage.search(Place, "loft")))
+        self.assertEqual(["Review.3"],
+                         list(self.storage.search("Review", "clean quiet")))
+        self.assertEqual({}, self.storage.search(Place, "sunny beach"))
+        self.assertEqual({}, self.storage.search(Place, "!?"))
+
+    def test_search_update(self):
+        """Test the index follows changes and deletions."""
+        pl = self.storage.get(Place, "2")
+        pl.description = "Quiet now"
+        self.storage.touch(pl, "description")
+        self.storage.delete(self.storage.get(Place, "1"))
+        self.assertEqual(["Place.2"],
+                         list(self.storage.search(Place, "quiet")))
+        self.assertEqual({}, self.storage.search(Place, "loft"))
+
+    def test_search_without_index(self):
+        """Test classes without a text index are scanned."""
+        us = User(**self.dates, id="4", first_name="Betty",
+                  last_name="Holberton")
+        self.storage.new(us)
+        self.assertEqual({"User.4": us},
+                         self.storage.search(User, "holberton betty"))
+
+    def test_restore(self):
+        """Test reload reads the saved index back instead of rebuilding."""
+        self.storage.save()
+        self.assertTrue(os.path.exists("file.json.indexes"))
+        storage = FileStorage()
+        with patch.object(TextIndex, "add") as add:
+            storage.reload()
+        add.assert_not_called()
+        self.assertEqual(["Place.1", "Place.2"],
+                         sorted(storage.search(Place, "sunny")))
+        self.assertEqual(["Review.3"], list(storage.search(Review, "clean")))
+
+    def test_restore_journal(self):
+        """Test records changed by the journal are indexed again."""
+        self.storage.save()
+        self.storage.configure(journal=True)
+        pl = self.storage.get(Place, "1")
+        pl.name = "Beach hut"
+        self.storage.touch(pl, "name")
+        self.storage.delete(self.storage.get(Place, "2"))
+        self.storage.save()
+        self.storage.configure(journal=False)
+        storage = FileStorage()
+        storage.reload()
+        self.assertEqual(["Place.1"], list(storage.search(Place, "beach")))
+        self.assertEqual(["Place.1"], list(storage.search(Place, "park")))
+        self.assertEqual({}, storage.search(Place, "sunny"))
+
+    def test_stale_index(self):
+        """Test an index saved with another JSON file is rebuilt."""
+        self.storage.save()
+        with open("file.json", "w") as f:
+            pl = Place(**self.dates, id="5", name="Tiny flat")
+            json.dump({"Place.5": pl.to_dict()}, f)
+        storage = FileStorage()
+        storage.reload()
+        self.assertEqual({}, storage.search(Place, "sunny"))
+        self.assertEqual(["Place.5"], list(storage.search(Place, "flat")))
+
+    def test_unbuilt_index(self):
+        """Test reload leaves the indexes empty until a query needs them,
+            and a save doesn't write the text indexes never built."""
+        self.storage.save()
+        os.remove("file.json.indexes")
+        storage = FileStorage()
+        with patch.object(TextIndex, "add") as add:
+            storage.reload()
+            storage.save()
+        add.assert_not_called()
+        self.assertFalse(os.path.exists("file.json.indexes"))
+        self.assertEqual(["Place.1", "Place.2"],
+                         sorted(storage.search(Place, "sunny")))
+        storage.save()
+        self.assertTrue(os.path.exists("file.json.indexes"))
+
+    def test_unchanged_index(self):
+        """Test only the stamp of the saved index is rewritten when no
+            indexed attribute changed."""
+        self.storage.save()
+        written = os.stat("file.json.indexes").st_ino
+        pl = self.storage.get(Place, "1")
+        pl.price_by_night = 80
+        self.storage.touch(pl, "price_by_night")
+        with patch.object(TextIndex, "dump") as dump:
+            self.storage.save()
+        dump.assert_not_called()
+        self.assertEqual(written, os.stat("file.json.indexes").st_ino)
+        storage = FileStorage()
+        with patch.object(TextIndex, "add") as add:
+            storage.reload()
+        add.assert_not_called()
+        self.assertEqual(["Place.1"], list(storage.search(Place, "loft")))
+        pl.name = "Beach hut"
+        self.storage.touch(pl, "name")
+        self.storage.save()
+        self.assertNotEqual(written, os.stat("file.json.indexes").st_ino)
+
+    def test_empty_index(self):
+        """Test no index is saved while there are no words to find."""
+        for key in list(self.storage.all()):
+            self.storage.delete(self.storage.all()[key])
+        self.storage.save()
+        self.assertFalse(os.path.exists("file.json.indexes"))
+
+    def test_unreadable_index(self):
+        """Test an index saved in another format is rebuilt."""
+        self.storage.save()
+        with open("file.json.indexes", "r") as f:
+            stamp = f.readline()
+            saved = json.load(f)
+        saved["indexes"] = {name: {"words": 1} for name in saved["indexes"]}
+        with open("file.json.indexes", "w") as f:
+            f.write(stamp)
+            json.dump(saved, f)
+        storage = FileStorage()
+        storage.reload()
+        self.assertEqual(["Place.1", "Place.2"],
+                         sorted(storage.search(Place, "sunny")))
+
+
 if __name__ == "__main__":
     unittest.main()
 
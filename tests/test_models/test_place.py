@@ -6,6 +6,8 @@ import os
 import unittest
 import models
 from models.place import Place
+from models.amenity import Amenity
+from models.user import User
 from datetime import datetime
 from time import sleep
 
@@ -31,6 +33,26 @@ class TestPlaceClass(unittest.TestCase):
         """Test subclass relationship"""
         self.assertTrue(issubclass(Place, models.base_model.BaseModel))
 
+    def test_amenities(self):
+        """Test the amenities of a place are found through amenity_ids"""
+        pl = Place()
+        wifi = Amenity()
+        pool = Amenity()
+        pl.amenity_ids = [wifi.id, "gone", pool.id]
+        self.assertEqual([wifi, pool], list(pl.amenities))
+        self.assertIn(pool, pl.amenities)
+        self.assertNotIn(Amenity(), pl.amenities)
+        self.assertEqual([], list(Place().amenities))
+
+    def test_user_places(self):
+        """Test the places of a user are found through their user_id"""
+        us = User()
+        pl = Place()
+        pl.user_id = us.id
+        self.assertEqual([pl], list(us.places))
+        models.storage.delete(pl)
+        self.assertEqual(0, len(us.places))
+
 
 class TestPlaceInstantiation(unittest.TestCase):
     """Test suite for Place instantiation"""
@@ -164,6 +186,20 @@ class TestPlaceSave(unittest.TestCase):
         with open("file.json", "r") as f:
             self.assertIn(plid, f.read())
 
+    def test_save_amenity_ids_changed_in_place(self):
+        """Test save indexes the amenity ids appended to the list of one
+            place only"""
+        am = Amenity()
+        pl = Place()
+        other = Place()
+        pl.amenity_ids.append(am.id)
+        pl.save()
+        self.assertEqual([], other.amenity_ids)
+        self.assertEqual([], list(other.amenities))
+        self.assertEqual({"Place." + pl.id: pl},
+                         models.storage.filter(Place,
+                                               amenity_ids__contains=am.id))
+
 
 class TestPlaceToDict(unittest.TestCase):
     """Test suite for to_dict method of Place class"""